@@ -22,21 +22,47 @@
 
 __author__ = 'ck Lux <lux.r.ck@gmail.com>'
 
+import atexit
 import json
 from packagekit.backend import *
 from packagekit.enums import *
-from pyalpm import *
 from pacman import *
+from fileindex import FileIndex, chunks
+from snapshot import Snapshot, SnapshotCache
+from fetch import Fetcher
+from journal import Journal
+from prefetch import Background, cached
+from output import LineBuffer
+import cancel
+import instrument
+import sqlite3
 import sys
 import time
 import os
 
-PREFIX = '/usr/local/share/PackageKit/helpers/pacman/'
+# both can be moved for testing and benchmarks
+PREFIX = os.environ.get('PK_PACMAN_PREFIX', '/usr/local/share/PackageKit/helpers/pacman/')
 GROUPS = PREFIX + 'groups.json'
 BLACKLIST = PREFIX + 'blacklist.json'
 #REPOS = PREFIX + 'repos.json'
 CONF = PREFIX + 'pacman.conf'
-GROUP_MAP = json.load(open(GROUPS, 'r'))
+CACHEDIR = os.environ.get('PK_PACMAN_CACHEDIR', '/var/cache/PackageKit/pacman/')
+FILEINDEX = CACHEDIR + 'files.db'
+REFRESHLOG = CACHEDIR + 'refresh.json'
+SNAPSHOT = CACHEDIR + 'snapshot.db'
+JOURNAL = CACHEDIR + 'journal.json'
+REFRESH_WORKERS = 4
+# pending updates are downloaded in the background after refresh-cache and
+# get-updates, capped at PREFETCH_RATE bytes/s; PK_PACMAN_PREFETCH=0 turns
+# that off
+PREFETCH = os.environ.get('PK_PACMAN_PREFETCH', '1') != '0'
+PREFETCH_RATE = int(os.environ.get('PK_PACMAN_PREFETCH_RATE', 2 << 20))
+PREFETCH_WORKERS = 2
+GROUP_MAP = None
+# per-command timings to this file, see instrument.py; PK_PACMAN_PROFILE
+# may add 'cprofile' dumps or 'tracemalloc' statistics
+INSTRUMENT = os.environ.get('PK_PACMAN_INSTRUMENT')
+PROFILE = os.environ.get('PK_PACMAN_PROFILE')
 '''
 class RepoCfg:
     def __init__(self, cfg):
@@ -58,12 +84,25 @@ class RepoCfg:
 REPOCFG = RepoCfg(REPOS)
 '''
 def load_blacklist(cache, fl):
-    brepos = json.load(open(fl, 'r'))
-    for repo in brepos['blocked']:
+    for repo in blocked_repos(fl):
         cache.set(repo, False)
 
-def update_blacklist(cache, fl):
-    json.dump({'blocked':[v[0].name for k,v in cache.repos.items() if not v[1]]},open(fl, 'w+'))
+def blocked_repos(fl):
+    return json.load(open(fl, 'r'))['blocked']
+
+def group_map():
+    '''PackageKit group -> pacman groups, read on first use.'''
+    global GROUP_MAP
+    if GROUP_MAP is None:
+        GROUP_MAP = json.load(open(GROUPS, 'r'))
+    return GROUP_MAP
+
+def restrict(co, filters):
+    '''only the local db when filters ask for installed packages alone, so
+    no sync db gets loaded.'''
+    if FILTER_INSTALLED in filters:
+        return co.local()
+    return co
 
 #
 # Avaliable filters: installed/~installed; newest/~newest; basename/~basename
@@ -71,15 +110,154 @@ def update_blacklist(cache, fl):
 
 class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
     def __init__(self, cmds, conf):
-        Pacman.__init__(self, conf)
+        self.fileindex = None
+        self.snap = Snapshot(SNAPSHOT)
+        self.rebuild = False
+        self.pending = False
+        # the updates get_updates last asked a prefetch for
+        self.prefetched = frozenset()
+        Pacman.__init__(self, conf, lazy=True)
         PackageKitBaseBackend.__init__(self, cmds)
+        # not 'background': PackageKitBaseBackend uses that name
+        self.prefetcher = Background(CACHEDIR)
+
+    def load(self):
+        Pacman.load(self)
         load_blacklist(self.cache(), BLACKLIST)
 
+    def new_cache(self, handle):
+        return PkgCache(handle, stored=self.stored_index)
+
+    def stored_index(self, kind, db):
+        '''the snapshot's index of db while the snapshot describes the dbs
+        the handle was loaded from, so a fresh helper does not build it
+        again; None otherwise.'''
+        if not kind in ('names', 'tokens') or self.stale() or not self.snap.fresh():
+            return None
+        return self.snap.index(db) if kind == 'names' else self.snap.tokens(db)
+
+    def dispatcher(self, args):
+        '''Run the command given in args, then keep serving tab separated
+        commands read from stdin until 'exit' or EOF.
+
+        The handle, the parsed config and the blacklist stay loaded between
+        commands; they are only rebuilt when the local or sync dbs changed
+        on disk since the previous command.'''
+        if len(args) > 0:
+            self.dispatch(args[0], args[1:])
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
+            line = line.rstrip('\n')
+            if line == 'exit':
+                break
+            if not line:
+                continue
+            args = line.split('\t')
+            self.dispatch(args[0], args[1:])
+
+    def dispatch(self, cmd, args):
+        if self.stale():
+            self.load()
+        cancel.reset()
+        try:
+            self.dispatch_command(cmd, args)
+        except SystemExit:
+            # error() exits the helper; a persistent helper only ends the
+            # current job and waits for the next one.
+            self.finished()
+        except cancel.Cancelled:
+            # whatever was written stays written; indexes are only stored
+            # once complete and file index updates are rolled back
+            self.error(ERROR_TRANSACTION_CANCELLED, 'cancelled', exit=False)
+            self.finished()
+        if self.rebuild:
+            self.update_snapshot()
+        if self.pending:
+            self.start_prefetch()
+
+    def snapshot(self):
+        '''a SnapshotCache for read-only queries while no handle is loaded,
+        or None. A missing or stale snapshot is rebuilt once the current
+        job has finished.'''
+        if self.loaded():
+            return None
+        if not self.snap.fresh():
+            self.rebuild = True
+            return None
+        return SnapshotCache(self.snap, blocked_repos(BLACKLIST))
+
+    def update_snapshot(self):
+        self.rebuild = False
+        if self.snap.fresh():
+            return
+        if self.stale():
+            self.load()
+        paths = [stamp[0] for stamp in self.dbstamp()]
+        try:
+            os.makedirs(CACHEDIR, exist_ok=True)
+            self.snap.build(self.handle, paths)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def start_prefetch(self):
+        '''download the pending updates in a detached process, see
+        prefetch.py.'''
+        self.pending = False
+        if not PREFETCH:
+            return
+        try:
+            os.makedirs(CACHEDIR, exist_ok=True)
+            blocked = blocked_repos(BLACKLIST)
+        except (OSError, ValueError):
+            return
+        self.prefetcher.start(self.conf, PREFETCH_RATE, PREFETCH_WORKERS, blocked)
+
+    def file_index(self, repos=[]):
+        '''the on-disk FileIndex, brought up to date with the local db and
+        the .files databases of repos.'''
+        if not self.fileindex:
+            try:
+                os.makedirs(CACHEDIR, exist_ok=True)
+            except OSError:
+                pass
+            self.fileindex = FileIndex(FILEINDEX)
+        dbpath = self.handle.dbpath
+        self.fileindex.update_local(dbpath)
+        self.fileindex.update_sync(dbpath, [r for r in repos if r != 'local'])
+        return self.fileindex
+
+    def fetcher(self):
+        def progress(job, overall):
+            if job.data and not job.optional and job.total:
+                percent = 100 if job.finished else 100 * job.done // job.total
+                self.item_progress(self.pid(job.data), STATUS_DOWNLOAD, percent)
+            self.percentage(overall)
+            self.speed(int(fetcher.rate()))
+        fetcher = Pacman.fetcher(self)
+        fetcher.progress = progress
+        return fetcher
+
     def package(self, pkg, info=None):
+        '''one pre-formatted line per package, straight into the buffered
+        stdout.'''
         if not info:
             info = INFO_AVAILABLE if not pkg.installdate else INFO_INSTALLED
-        summary = pkg.desc
-        super().package(self.pid(pkg), info, summary)
+        instrument.count('packages')
+        with instrument.phase('output'):
+            sys.stdout.write('package\t%s\t%s\t%s\n' % (info, self.pid(pkg), pkg.desc))
+            sys.stdout.flush()
+
+    def finished(self):
+        PackageKitBaseBackend.finished(self)
+        sync_output()
+
+    def error(self, err, description, exit=True):
+        try:
+            PackageKitBaseBackend.error(self, err, description, exit)
+        finally:
+            sync_output()
 
     #
     # Backend Action Methods
@@ -89,19 +267,24 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
         dn = pkg.db.name
         if dn == 'local':
             dn = 'installed'
-        return pkg.name + ';' + pkg.version + ';' + pkg.arch + ';' + dn
+        return '%s;%s;%s;%s' % (pkg.name, pkg.version, pkg.arch, dn)
 
-    def pkg(self, pid):
-        pn, pv, pa, pi = pid.split(';')
-        co = self.cache()
-        return co.repo(pi).first(pn, [('=',pv)])
+    def packages(self, pids, co=None):
+        '''the packages of pids, resolved in one pass; every id that does
+        not resolve gets its own error without ending the job. Returns
+        ([(pid, pkg)], missing).'''
+        found, missing = (co or self.cache()).packages(pids)
+        for pid, err, message in missing:
+            self.error(err, message, exit=False)
+        return found, missing
 
     def backend(fn=None, flags={'status':STATUS_QUERY,'allow_cancel':True}):
         def _bcommand(func):
             def _cmd(self, *args, **kwargs):
-                self.status(flags['status'])
-                self.allow_cancel(flags['allow_cancel'])
-                func(self, *args, **kwargs)
+                with instrument.command(func.__name__, args):
+                    self.status(flags['status'])
+                    self.allow_cancel(flags['allow_cancel'])
+                    func(self, *args, **kwargs)
             return _cmd
         if not fn:
             return _bcommand
@@ -109,22 +292,23 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
 
     def search(func):
         def _search(self, filters, keys):
-            c = self.cache()
+            c = restrict(self.cache(), filters)
             pkgs = func(c, keys)
             for pkg in PkgFilter(filters).filter(pkgs):
-                print(pkg)
                 self.package(pkg)
         return _search
 
     @backend
-    @search
-    def search_name(c, keys):
-        return c.match(keys)
+    def search_name(self, filters, keys):
+        co = restrict(self.snapshot() or self.cache(), filters)
+        for pkg in PkgFilter(filters).filter(co.match(keys)):
+            self.package(pkg)
 
     @backend
-    @search
-    def search_details(c, keys):
-        return c.search(keys)
+    def search_details(self, filters, keys):
+        co = restrict(self.snapshot() or self.cache(), filters)
+        for pkg in PkgFilter(filters).filter(co.search(keys)):
+            self.package(pkg)
 
     @backend
     @search
@@ -132,44 +316,33 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
         pgrp = set()
         for grp in groups:
             try:
-                pgrp = pgrp.union(GROUP_MAP[grp])
+                pgrp = pgrp.union(group_map()[grp])
             except:
                 continue
         return c.groups(pgrp)
             
     @backend
     def search_file(self, filters, files):
-        '''Works only for installed packages.'''
-        if FILTER_NOT_INSTALLED in filters:
+        '''Installed packages are always searchable, available ones only for
+        repos whose file lists were fetched ('pacman -Fy').'''
+        co = self.cache()
+        if FILTER_INSTALLED in filters:
+            co = co.local()
+        elif FILTER_NOT_INSTALLED in filters:
+            co = co.online()
+        repos = [db.name for db in co.dbs()]
+        index = self.file_index(repos)
+        if FILTER_NOT_INSTALLED in filters and not any(index.has(r) for r in repos):
             self.error(ERROR_CANNOT_GET_FILELIST,
-                       "search-file isn't available with ~installed filter")
+                       "no file lists available, run 'pacman -Fy' first")
             return
-        
-        pkgs = self.cache().local().all()
-        
-        for i,f in enumerate(files):
-            if f[0] == '/':
-                files[i] = f[1:]
-
-        def _match(pkg, keys):
-            for key in keys:
-                flag = False
-                for f in pkg.files:
-                    if re.match(key, f[0]):
-                        flag = True
-                        break
-                if not flag:
-                    return False
-            return True
-
-        for pkg in pkgs:
-            if _match(pkg, files):
-                self.package(pkg)
+        # the index answers in sets; keep the output the same from run to run
+        for pkg in sorted(PkgFilter(filters).filter(co.owners(index, files)), key=self.pid):
+            self.package(pkg)
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     def get_update_detail(self, pids):
         c = self.cache()
-        oo = c.online()
         lo = c.local()
         updates = []
         obsolutes = ""
@@ -182,15 +355,9 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
         state = ""
         issued = ""
         updated = ""
-        for pid in pids:
-            lpid = pid.split(';')
-            pk = None
-            if len(lpid) == 4:
-                pn, pv, pa, pi = lpid
-                pk = oo.first(pn,[('=',pv)])
-            if not pk:
-                self.error(ERROR_INTERNAL_ERROR, "could not find %s" % pid)
-                return
+        found, missing = self.packages(pids, c.online())
+        for pid, pk in found:
+            pn = pk.name
             updates = []
             updated = 0
             for lk in lo.get(pn):
@@ -209,65 +376,88 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
 
     def deps(func):
         def _pkg(self, filters, pids, recursive):
-            c = self.cache()
-            for pid in pids:
-                try:
-                    pn, pv, pa, pi = pid.split(';')
-                    pk = c.first(pn, [('=', pv)])
-                    if not pk:
-                        raise NameError
-                except:
-                    self.error(ERROR_INTERNAL_ERROR, "could not find %s" % pid)
-                    return
-                pd = func(self, pk, recursive)
-                for p in pd:
-                    self.package(p)
+            found, missing = self.packages(pids)
+            pkgs = [pk for pid, pk in found]
+            for p in PkgFilter(filters).filter(func(self, pkgs, recursive)):
+                self.package(p)
         return _pkg
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     @deps
-    def depends_on(self, pkg, recursive):
-        return self.calc_dependson(pkg, recursive)
+    def depends_on(self, pkgs, recursive):
+        return self.calc_dependson(pkgs, recursive)
 
     @backend
     def get_packages(self, filters):
-        pkgs = PkgFilter(filters).filter(self.cache().all())
+        co = restrict(self.snapshot() or self.cache(), filters)
+        pkgs = PkgFilter(filters).filter(co.listing())
         for pkg in pkgs:
             self.package(pkg)
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     @deps
-    def required_by(self, pkg, recursive):
-        return self.calc_requiredby(pkg, recursive)
+    def required_by(self, pkgs, recursive):
+        return self.calc_requiredby(pkgs, recursive)
 
-    # Don't know how to get it right...
     @backend
     def what_provides(self, filters, provides_type, values):
-        c = self.cache()
-        for pkg in c.provide(values):
+        pkgs = restrict(self.cache(), filters).provide(values)
+        for pkg in PkgFilter(filters).filter(pkgs):
             self.package(pkg)
 
-    @backend(flags={'status':STATUS_REFRESH_CACHE, 'allow_cancel':False})
+    @backend(flags={'status':STATUS_REFRESH_CACHE, 'allow_cancel':True})
     def refresh_cache(self, force):
-        self.cache().refresh(force)
+        '''Repos are fetched concurrently; downloads land next to the old
+        databases and are only swapped in at the end, once their
+        signatures passed SigLevel, so cancelling leaves the old state
+        behind.'''
+        def progress(job, overall):
+            # signatures come in a round of their own, after the databases
+            if job.optional:
+                return
+            if job.total:
+                percent = 100 if job.finished else 100 * job.done // job.total
+                self.item_progress(job.key + ';;;' + job.key, STATUS_DOWNLOAD_REPOSITORY, percent)
+            self.percentage(overall)
+        self.percentage(0)
+        try:
+            os.makedirs(CACHEDIR, exist_ok=True)
+        except OSError:
+            pass
+        try:
+            results = self.cache().refresh(force, Fetcher(REFRESH_WORKERS, progress=progress),
+                                           Journal(JOURNAL), self.siglevels())
+        except LockError as e:
+            self.error(ERROR_CANNOT_GET_LOCK, str(e))
+            return
+        try:
+            with open(REFRESHLOG, 'w') as fp:
+                json.dump({'time': time.time(), 'generation': Journal(JOURNAL).generation(),
+                           'repos': dict(
+                    (r.key, {'seconds': r.seconds, 'bytes': r.bytes,
+                             'changed': r.changed, 'error': r.error})
+                    for r in results.values())}, fp, indent=1)
+        except OSError:
+            pass
+        self.percentage(100)
+        self.rebuild = True
+        self.pending = any(r.changed for r in results.values())
+        failed = sorted(r.key for r in results.values() if r.error)
+        if failed:
+            self.error(ERROR_REPO_NOT_AVAILABLE, 'could not refresh %s: %s' % (
+                ', '.join(failed), '; '.join(results[k].error for k in failed)))
 
     # Don't support transaction_flags...
     def trans(func):
         def _trans(self, flags, pids, *args, **kwargs):
-            c = self.cache()
-            pkgs = []
-            try:
-                for pid in pids:
-                    pn, pv, pa, pi = pid.split(';')
-                    pk = c.repo(pi).first(pn,[('=',pv)])
-                if not pk:
-                    raise Exception
-                pkgs.append(pk)
-            except Exception as e:
-                self.error(ERROR_PACKAGE_NOT_FOUND, 'Error, could not find %s' % pid)
+            found, missing = self.packages(pids)
+            if missing:
+                # never run a transaction on part of what was asked for
                 return
+            pkgs = [pk for pid, pk in found]
             c0 = TRANSACTION_FLAG_ONLY_TRUSTED in flags and False
             c1 = TRANSACTION_FLAG_SIMULATE in flags
+            self.rebuild = not c1
             func(self, c0, c1, pkgs, *args, **kwargs)
         return _trans
 
@@ -282,11 +472,11 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
                 pkgs.remove(pkg)
                 continue
         if simulate:
-            for pkg in pkgs:
-                deps = [pkg] + self.calc_dependson(pkg, True)
-                for p in deps:
-                    if p.db.name != 'local':
-                        self.package(p, INFO_INSTALLING)
+            seen = set()
+            for p in pkgs + self.calc_dependson(pkgs, True):
+                if p.db.name != 'local' and not pkgkey(p) in seen:
+                    seen.add(pkgkey(p))
+                    self.package(p, INFO_INSTALLING)
             return
         self.install(pkgs)
 
@@ -295,22 +485,18 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
 
     @backend
     def resolve(self, filters, values):
-        co = self.cache()
-        pkgs = []
-        for value in values:
-            pkgs += list(co.get(value))
-        for pkg in PkgFilter(filters).filter(pkgs):
+        co = restrict(self.snapshot() or self.cache(), filters)
+        missing = []
+        for pkg in PkgFilter(filters).filter(co.resolve(values, missing)):
             self.package(pkg)
+        if missing:
+            # all at once, after everything that did resolve
+            self.error(ERROR_PACKAGE_NOT_FOUND, 'could not resolve %s' % ', '.join(missing),
+                       exit=False)
 
     @backend(flags={'status':STATUS_RUNNING, 'allow_cancel':False})
     @trans
     def remove_packages(self, only_trusted, simulate, pkgs, allowdeps, autoremove):
-        def unneeded(pkgs, blacklist):
-            for pkg in pkgs:
-                rd = set(pkg.compute_requiredby())
-                rd.difference_update(blacklist)
-                if not len(rd) and pkg.reason == PKG_REASON_DEPEND:
-                    yield pkg
         self.status(STATUS_REMOVE)
         lo = self.cache().local()
         for pkg in pkgs:
@@ -319,19 +505,16 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
                 pkgs.remove(pkg)
                 continue
         if simulate:
-            rdeps = set()
-            rdeps = rdeps.union(set([pkg] + self.calc_requiredby(pkg, True)))
-            if allowdeps:
-                ddeps = []
-                blacklist = set([p.name for p in rdeps])
-                for dep in rdeps:
-                    ddeps += list(unneeded(self.calc_dependson(dep, False), blacklist))
-                rdeps = rdeps.union(ddeps)
+            rdeps = pkgs + self.calc_requiredby(pkgs, True)
+            if allowdeps or autoremove:
+                rdeps += self.calc_orphans(rdeps)
+            seen = set()
             for p in rdeps:
-                if p.db.name == 'local':
+                if p.db.name == 'local' and not pkgkey(p) in seen:
+                    seen.add(pkgkey(p))
                     self.package(p, INFO_REMOVING)
             return
-        self.remove(pkgs, {'recurse':allowdeps})
+        self.remove(pkgs, {'recurse':allowdeps or autoremove})
 
     @backend(flags={'status':STATUS_RUNNING, 'allow_cancel':False})
     @trans
@@ -340,52 +523,62 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
         co = self.cache()
         if simulate:
             for pkg in pkgs:
-                if vercmp(co.newest(pkg).version, pkg.version) > 0:
+                if version_key(co.newest(pkg).version) > version_key(pkg.version):
                     self.package(pkg, INFO_UPDATING)
             return
-        self.update(pkgs)
+        self.update([co.newest(pkg) for pkg in pkgs])
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     def get_details(self, pids):
         def pk_group(pkg):
-            for k,v in GROUP_MAP.items():
+            for k,v in group_map().items():
                 if set(pkg.groups).issubset(set(v)):
                     return k
             return GROUP_UNKNOWN
-        co = self.cache()
-        for pid in pids:
-            try:
-                pk = self.pkg(pid)
-                if pk:
-                    self.details(pid, ' '.join(pk.licenses), pk_group(pk), pk.desc, pk.url, "", pk.isize)
-            except:
-                self.error(ERROR_INTERNAL_ERROR, "could not find '%s'" % pid)
+        found, missing = self.packages(pids, self.snapshot())
+        for pid, pk in found:
+            self.details(pid, ' '.join(pk.licenses), pk_group(pk), pk.desc, pk.url, "", pk.isize)
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     def get_files(self, pids):
-        lo = self.cache().local()
+        pis = []
         for pid in pids:
-            try:
-                pn, pv, pa, pi = pid.split(';')
-                pk = lo.first(pn,[('=', pv)])
-                pfl = []
-                for fl in pk.files:
-                    pfl.append(fl[0])
-                self.files(pid, ';'.join(pfl))
-                if not pk:
-                    raise Exception
-            except:
-                self.error(ERROR_INTERNAL_ERROR, "could not find '%s'" % pid)
-                return
+            pi = pid.split(';')
+            if len(pi) == 4:
+                pis.append((pid, pi))
+            else:
+                self.error(ERROR_PACKAGE_ID_INVALID, "invalid package id '%s'" % pid, exit=False)
+        index = self.file_index(list(set(pi[3] for pid, pi in pis if pi[3] != 'installed')))
+        for pid, (pn, pv, pa, pi) in pis:
+            repo = 'local' if pi == 'installed' else pi
+            if not index.known(repo, pn, pv) and index.known('local', pn, pv):
+                # no .files db for repo (or an older one): the installed
+                # package of the same version has the same files
+                repo = 'local'
+            if not index.known(repo, pn, pv):
+                self.error(ERROR_PACKAGE_NOT_FOUND, "could not find '%s'" % pid, exit=False)
+                continue
+            # long lists go out as several lines for the same package
+            for text in chunks(index.files(repo, pn, pv)):
+                self.files(pid, text)
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     def get_updates(self, filters):
-        ipkgs = self.cache().local().all()
-        oldbs = self.cache().dbs()[1:]
-        for pkg in ipkgs:
-            nvp = pyalpm.sync_newversion(pkg, oldbs)
-            if nvp:
-                self.package(nvp, INFO_NORMAL)
+        '''PackageKit polls this; a prefetch only starts when the updates
+        changed since the last one or some are not downloaded yet.'''
+        seen = set()
+        updates = []
+        for pkg, npkg in self.cache().updates():
+            if npkg.name in seen:
+                continue
+            seen.add(npkg.name)
+            updates.append(npkg)
+            self.package(npkg, INFO_NORMAL)
+        ids = frozenset(self.pid(npkg) for npkg in updates)
+        directory = self.handle.cachedirs[0]
+        if ids != self.prefetched or not all(cached(npkg, directory) for npkg in updates):
+            self.pending = bool(updates)
+            self.prefetched = ids
 
 #    def get_distro_upgrades(self):
 
@@ -394,8 +587,18 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
         if repoid == 'core':
             self.error(ERROR_CANNOT_DISABLE_REPOSITORY, "'core' repo can't be disabled")
             return
-        self.cache().set(repoid, enable)
-        update_blacklist(self.cache(), BLACKLIST)
+        # only the blacklist changes; no need to load the handle for it
+        if not repoid in (self.snapshot() or self.cache()).repos:
+            return
+        blocked = set(blocked_repos(BLACKLIST))
+        if enable:
+            blocked.discard(repoid)
+        else:
+            blocked.add(repoid)
+        with open(BLACKLIST, 'w') as fp:
+            json.dump({'blocked': sorted(blocked)}, fp)
+        if self.loaded():
+            self.cache().set(repoid, enable)
 
 #    def repo_set_data(self, repoid, parameter, value):
 #        co = self.cache()
@@ -406,7 +609,7 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
 
     @backend(flags={'status':STATUS_INFO, 'allow_cancel':True})
     def get_repo_list(self, filters):
-        co = self.cache()
+        co = self.snapshot() or self.cache()
         keys = list(co.repos.keys())
         keys.sort()
         for v in [co.repos[key] for key in keys]:
@@ -417,25 +620,23 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
     @backend(flags={'status':STATUS_RUNNING, 'allow_cancel':False})
     def download_packages(self, directory, pids):
         self.status(STATUS_DOWNLOAD)
-        co = self.cache()
-        pkgs = []
-        try:
-            for pid in pids:
-                pn, pv, pa, pi = pid.split(';')
-                pk = co.repo(pi).first(pn,[('=',pv)])
-                if not pk:
-                    raise Exception
-                pkgs.append(pk)
-        except Exception as e:
-            self.error(ERROR_PACKAGE_NOT_FOUND, 'Error, cound not find %s' % pid)
+        found, missing = self.packages(pids)
+        if missing:
             return
+        pkgs = [pk for pid, pk in found]
         if not directory:
             directory = os.getcwd()
         if not os.access(directory, os.W_OK):
             self.error(ERROR_INTERNAL_ERROR, "directory '%s' isn't writable'" % directory)
             return
-        flags = {'directory': directory}
-        self.download(pkgs, flags)
+        import pyalpm
+        try:
+            self.download(pkgs, directory)
+        except pyalpm.error as e:
+            # what prefetch() could not get libalpm could not either, or a
+            # file failed its checksum or signature
+            self.error(ERROR_PACKAGE_DOWNLOAD_FAILED, 'could not download: %s' % e)
+            return
         for pkg in pkgs:
             pname = pkg.filename
             self.files(self.pid(pkg), os.path.abspath(directory) + '/' + pname)
@@ -444,7 +645,16 @@ class PackageKitPacmanBackend(PackageKitBaseBackend, Pacman):
 #    def get_categories(self):
 #    def repair_system(self, transaction_flags):
 
+def sync_output():
+    if isinstance(sys.stdout, LineBuffer):
+        sys.stdout.sync()
+
 def main():
+    sys.stdout = LineBuffer(sys.stdout)
+    cancel.install()
+    atexit.register(sync_output)
+    if INSTRUMENT:
+        instrument.enable(INSTRUMENT, PROFILE)
     backend = PackageKitPacmanBackend("", CONF)
     backend.dispatcher(sys.argv[1:])
 
@@ -0,0 +1,1291 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Benchmarks for the pacman backend helper.
+
+    bench.py startup [-n JOBS] [COMMAND ARG...]
+    bench.py names [-n PACKAGES] [KEY...]
+    bench.py deps [-n PACKAGES] [-f FANOUT]
+    bench.py vercmp [-n VERSIONS]
+    bench.py refresh [-r REPOS] [-s KBYTES] [-l LATENCY_MS] [-w WORKERS]
+    bench.py download [-p PACKAGES] [-s KBYTES] [-l LATENCY_MS] [-w WORKERS]
+    bench.py output [-n LINES] [--helper]
+    bench.py search [-n PACKAGES] [TERMS...]
+    bench.py roots [-n PACKAGES] [--roots N]
+    bench.py files [-n PACKAGES] [--files N] [--big N]
+    bench.py cancel [-n PACKAGES] [--repeat N]
+    bench.py cold [-n PACKAGES] [--target MS] [-o OUT.json]
+    bench.py commands [-n PACKAGES] [--files N] [--fanout N] [-o OUT.json] [...]
+
+The commands benchmark runs the real helper (pyalpm and the packagekit
+python module are needed) against synthetic databases generated in a
+temporary root, through the PK_PACMAN_PREFIX and PK_PACMAN_CACHEDIR
+overrides.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import argparse
+import functools
+import io
+import json
+import os
+import random
+import signal
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alpmBackend.py')
+SYLLABLES = ['lib', 'py', 'thon', 'gtk', 'qt', 'kde', 'gnome', 'x', 'font',
+             'perl', 'ruby', 'go', 'rust', 'tex', 'live', 'core', 'utils',
+             'devel', 'doc', 'git', 'ssl', 'crypt', 'media', 'audio', 'vid',
+             'net', 'tools', 'data', 'base', 'plugin', 'theme', 'icon']
+
+def synthetic_names(count, seed=0):
+    '''count distinct package-like names such as 'python-gtk-utils12'.'''
+    rnd = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        parts = [''.join(rnd.choice(SYLLABLES) for j in range(rnd.randint(1, 3)))
+                 for i in range(rnd.randint(1, 3))]
+        names.add('-'.join(parts) + str(rnd.randint(0, 99)))
+    return sorted(names)
+
+def timed(func, repeat=5):
+    '''best wall time of repeat calls to func, and its last result.'''
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best, result
+
+def helper(args=[], **kwargs):
+    return subprocess.Popen([sys.executable, HELPER] + args,
+                            stdout=subprocess.PIPE, universal_newlines=True,
+                            **kwargs)
+
+def read_job(proc):
+    '''read helper output up to the end of one job; return the time the
+    first line arrived.'''
+    first = None
+    for line in proc.stdout:
+        if first is None:
+            first = time.perf_counter()
+        if line.rstrip('\n') == 'finished':
+            break
+    return first
+
+def bench_startup(opts):
+    '''one spawn per job against one persistent helper serving every job.'''
+    cmd = opts.command or ['get-repo-list', 'none']
+    spawn = []
+    for i in range(opts.jobs):
+        t0 = time.perf_counter()
+        proc = helper(cmd, stdin=subprocess.DEVNULL)
+        first = read_job(proc)
+        proc.wait()
+        spawn.append((first - t0, time.perf_counter() - t0))
+
+    persistent = []
+    proc = helper(stdin=subprocess.PIPE)
+    for i in range(opts.jobs):
+        t0 = time.perf_counter()
+        proc.stdin.write('\t'.join(cmd) + '\n')
+        proc.stdin.flush()
+        first = read_job(proc)
+        persistent.append((first - t0, time.perf_counter() - t0))
+    proc.stdin.write('exit\n')
+    proc.stdin.close()
+    proc.wait()
+
+    def summary(runs):
+        first = sorted(r[0] for r in runs)
+        total = sorted(r[1] for r in runs)
+        return {'first_line_ms': first[len(first) // 2] * 1000,
+                'job_ms': total[len(total) // 2] * 1000,
+                'total_s': sum(total)}
+    return {'command': cmd, 'jobs': opts.jobs,
+            'spawn': summary(spawn), 'persistent': summary(persistent)}
+
+def bench_names(opts):
+    '''search-name over a synthetic repo: regex scan against NameIndex.
+    cold_ms is the first search of a helper that builds the index,
+    stored_ms one that reads the snapshot's grams table instead, index_ms
+    every later search in the same helper.'''
+    from pacman import NameIndex
+    from snapshot import Snapshot
+    handle = synthetic_handle(opts.packages, repos=1, installed=0)
+    db = handle.get_syncdbs()[0]
+    names = [p.name for p in db.pkgcache]
+    keys = opts.keys or ['gtk', 'python-gtk', 'fontcore', 'x', 'zzz']
+    build, index = timed(lambda: NameIndex(names), 1)
+    result = {'packages': len(names), 'build_ms': build * 1000, 'keys': {}}
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        path = os.path.join(tmp, 'snapshot.db')
+        Snapshot(path).build(handle, [])
+        def stored(key):
+            snap = Snapshot(path)
+            try:
+                return list(snap.index(db.name).match([key]))
+            finally:
+                snap.close()
+        for key in keys:
+            scan, found = timed(lambda: [n for n in names if re.search(key, n, re.IGNORECASE)])
+            indexed, hits = timed(lambda: list(index.match([key])))
+            cold, r = timed(lambda: list(NameIndex(names).match([key])), 1)
+            warm, r = timed(lambda: stored(key))
+            assert len(hits) == len(found) and r == hits
+            result['keys'][key] = {'matches': len(found), 'scan_ms': scan * 1000,
+                                   'cold_ms': cold * 1000, 'stored_ms': warm * 1000,
+                                   'index_ms': indexed * 1000}
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+class FakeDB(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakePkg(object):
+    '''just enough of a pyalpm Package for the pure-python parts.'''
+    def __init__(self, name, version, db, depends=(), provides=()):
+        self.name = name
+        self.version = version
+        self.arch = 'x86_64'
+        self.db = db
+        self.depends = list(depends)
+        self.provides = list(provides)
+
+class FakeHandle(object):
+    '''a pyalpm Handle over FakePkgs: a local db and sync dbs with name
+    lookups and pkgcache, enough for PkgCache and Snapshot.build().'''
+    def __init__(self, local, sync):
+        self.dbs = [local] + sync
+        for db in self.dbs:
+            db.byname = dict((p.name, p) for p in db.pkgcache)
+            db.get_pkg = db.byname.get
+
+    def get_localdb(self):
+        return self.dbs[0]
+
+    def get_syncdbs(self):
+        return self.dbs[1:]
+
+def synthetic_handle(count, repos=3, installed=0.3, seed=0):
+    '''count packages spread over repos sync dbs, installed of them in
+    the local db (a tenth of those at an older version), every field
+    Snapshot stores filled in.'''
+    rnd = random.Random(seed)
+    local = FakeDB('local')
+    local.pkgcache = []
+    sync = [FakeDB('synth%d' % i) for i in range(repos)]
+    for db in sync:
+        db.pkgcache = []
+    def fill(pkg, installdate):
+        pkg.desc = 'summary of ' + pkg.name
+        pkg.url = pkg.filename = None
+        pkg.licenses = ['GPL']
+        pkg.groups = []
+        pkg.isize = pkg.size = 1024
+        pkg.reason = 0
+        pkg.installdate = installdate
+        pkg.builddate = 1500000000
+        return pkg
+    for i, name in enumerate(synthetic_names(count, seed)):
+        db = sync[i % repos]
+        db.pkgcache.append(fill(FakePkg(name, '1.0-1', db), 0))
+        if rnd.random() < installed:
+            version = '0.9-1' if rnd.random() < 0.1 else '1.0-1'
+            local.pkgcache.append(fill(FakePkg(name, version, local), 1500000000))
+    return FakeHandle(local, sync)
+
+def synthetic_graph(count, fanout, seed=0):
+    '''count packages; package i depends on up to fanout packages after it,
+    a third of them through a versioned virtual name.'''
+    rnd = random.Random(seed)
+    db = FakeDB('extra')
+    names = synthetic_names(count, seed)
+    pkgs = []
+    for i, name in enumerate(names):
+        deps = []
+        for j in range(rnd.randint(0, fanout)):
+            k = rnd.randint(i + 1, count) if i + 1 < count else None
+            if k is None or k >= count:
+                continue
+            deps.append('so-' + names[k] + '>=1' if k % 3 == 0 else names[k])
+        pkgs.append(FakePkg(name, '1.%d-1' % i, db, deps,
+                            ['so-' + name + '=1.%d' % i] if i % 3 == 0 else []))
+    return pkgs
+
+WORDS = ['library', 'tool', 'for', 'the', 'and', 'editor', 'text', 'image',
+         'audio', 'video', 'network', 'client', 'server', 'python', 'bindings',
+         'fast', 'simple', 'terminal', 'emulator', 'compression', 'format',
+         'manager', 'package', 'graphical', 'interface', 'desktop', 'font',
+         'rendering', 'engine', 'parser', 'documentation', 'development']
+
+def synthetic_details(count, seed=0):
+    '''packages with descriptions, provides and groups for search-details.'''
+    rnd = random.Random(seed)
+    db = FakeDB('extra')
+    pkgs = []
+    for i, name in enumerate(synthetic_names(count, seed)):
+        pkg = FakePkg(name, '1.%d-1' % i, db, (), ['lib%s.so=1-64' % name] if i % 5 == 0 else [])
+        pkg.desc = ' '.join(rnd.choice(WORDS) for j in range(rnd.randint(3, 12)))
+        pkg.groups = ['group%d' % (i % 40)] if i % 4 == 0 else []
+        # the rest of what Snapshot stores
+        pkg.url = pkg.filename = None
+        pkg.licenses = ['GPL']
+        pkg.isize = pkg.size = 1024
+        pkg.reason = pkg.installdate = 0
+        pkg.builddate = 1500000000
+        pkgs.append(pkg)
+    return pkgs
+
+def bench_search(opts):
+    '''search-details: a regex over every name and description (what
+    libalpm's db.search does) against TokenIndex. A helper without a
+    stored index pays for building it on its first search (cold_ms); one
+    reading the snapshot's words table pays for opening it (stored_ms);
+    index_ms is every later search in the same helper.'''
+    from pacman import NameIndex, TokenIndex
+    from snapshot import Snapshot
+    pkgs = synthetic_details(opts.packages)
+    build, (names, tokens) = timed(lambda: (NameIndex(p.name for p in pkgs), TokenIndex(pkgs)), 1)
+    result = {'packages': len(pkgs), 'build_ms': build * 1000, 'terms': {}}
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        db = pkgs[0].db
+        db.pkgcache = pkgs
+        local = FakeDB('local')
+        local.pkgcache = []
+        path = os.path.join(tmp, 'snapshot.db')
+        Snapshot(path).build(FakeHandle(local, [db]), [])
+        def stored(keys):
+            snap = Snapshot(path)
+            try:
+                return snap.tokens(db.name).search(keys, snap.index(db.name))
+            finally:
+                snap.close()
+        for terms in opts.terms or ['editor', 'text editor', 'gtk terminal', 'pyth', 'font rendering engine']:
+            keys = terms.split()
+            regexes = [re.compile(k, re.IGNORECASE) for k in keys]
+            scan, found = timed(lambda: [p for p in pkgs if all(r.search(p.name) or r.search(p.desc)
+                                                                 for r in regexes)])
+            indexed, hits = timed(lambda: tokens.search(keys, names))
+            cold, r = timed(lambda: TokenIndex(pkgs).search(keys, NameIndex(p.name for p in pkgs)), 1)
+            warm, r = timed(lambda: stored(keys))
+            assert r == hits
+            result['terms'][terms] = {'scan_matches': len(found), 'index_matches': len(hits),
+                                      'scan_ms': scan * 1000, 'cold_ms': cold * 1000,
+                                      'stored_ms': warm * 1000, 'index_ms': indexed * 1000}
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_deps(opts):
+    '''full dependency closure of the top of a synthetic graph.'''
+    from pacman import ProvidesIndex, Resolver
+    pkgs = synthetic_graph(opts.packages, opts.fanout)
+    index = ProvidesIndex(pkgs)
+    byname = dict((p.name, p) for p in pkgs)
+
+    class Cache(object):
+        lookups = 0
+        def satisfier(self, name, pexprs=()):
+            Cache.lookups += 1
+            for pname in index.lookup(name, pexprs):
+                return byname[pname]
+
+    edges = [0]
+    def depends(pkg):
+        edges[0] += len(pkg.depends)
+        return pkg.depends
+
+    def closure():
+        Cache.lookups = 0
+        edges[0] = 0
+        return Resolver(Cache(), depends).resolve(pkgs[:1], True)
+    t, out = timed(closure)
+    return {'packages': len(pkgs), 'fanout': opts.fanout, 'closure': len(out),
+            'edges': edges[0], 'satisfier_lookups': Cache.lookups,
+            'resolve_ms': t * 1000}
+
+# pacman's test/util/vercmptest.sh
+VERCMP_CORPUS = [
+    ('1.5.0', '1.5.0', 0), ('1.5.1', '1.5.0', 1), ('1.5.1', '1.5', 1),
+    ('1.5.0-1', '1.5.0-1', 0), ('1.5.0-1', '1.5.0-2', -1),
+    ('1.5.0-1', '1.5.1-1', -1), ('1.5.0-2', '1.5.1-1', -1),
+    ('1.5-1', '1.5.1-1', -1), ('1.5-2', '1.5.1-1', -1), ('1.5-2', '1.5.1-2', -1),
+    ('1.5', '1.5-1', 0), ('1.5-1', '1.5', 0), ('1.1-1', '1.1', 0),
+    ('1.0-1', '1.1', -1), ('1.1-1', '1.0', 1),
+    ('1.5b-1', '1.5-1', -1), ('1.5b', '1.5', -1), ('1.5b-1', '1.5', -1),
+    ('1.5b', '1.5.1', -1),
+    ('1.0a', '1.0alpha', -1), ('1.0alpha', '1.0b', -1), ('1.0b', '1.0beta', -1),
+    ('1.0beta', '1.0rc', -1), ('1.0rc', '1.0', -1),
+    ('1.5.a', '1.5', 1), ('1.5.b', '1.5.a', 1), ('1.5.1', '1.5.b', 1),
+    ('1.5.b-1', '1.5.b', 0), ('1.5-1', '1.5.b', -1),
+    ('2.0', '2_0', 0), ('2.0_a', '2_0.a', 0), ('2.0a', '2.0.a', -1),
+    ('2___a', '2_a', 1),
+    ('0:1.0', '0:1.0', 0), ('0:1.0', '0:1.1', -1), ('1:1.0', '0:1.0', 1),
+    ('1:1.0', '0:1.1', 1), ('1:1.0', '2:1.1', -1),
+    ('1:1.0', '0:1.0-1', 1), ('1:1.0-1', '0:1.1-1', 1),
+    ('0:1.0', '1.0', 0), ('0:1.0', '1.1', -1), ('0:1.1', '1.0', 1),
+    ('1:1.0', '1.0', 1), ('1:1.0', '1.1', 1), ('1:1.1', '1.1', 1),
+]
+
+def synthetic_versions(count, seed=0):
+    rnd = random.Random(seed)
+    out = []
+    for i in range(count):
+        ver = '.'.join(str(rnd.randint(0, 20)) for j in range(rnd.randint(1, 4)))
+        if rnd.random() < 0.2:
+            ver += rnd.choice(['a', 'b', 'rc1', '.r123.gabc', '+git', '_pre'])
+        if rnd.random() < 0.1:
+            ver = '%d:%s' % (rnd.randint(1, 3), ver)
+        out.append('%s-%d' % (ver, rnd.randint(1, 5)))
+    return out
+
+def bench_resolve(opts):
+    '''resolve for a few thousand names in one call: get() per name
+    through the cached generators, against resolve() over the whole set,
+    from the handle and from the snapshot.'''
+    from pacman import PkgCache, PkgFilter
+    from snapshot import Snapshot, SnapshotCache
+    handle = synthetic_handle(opts.packages, seed=opts.seed)
+    rnd = random.Random(opts.seed)
+    known = [p.name for db in handle.get_syncdbs() for p in db.pkgcache]
+    names = rnd.sample(known, min(opts.names, len(known)))
+    unknown = ['missing-%d' % i for i in range(len(names) // 20)]
+    names = names[:len(names) - len(unknown)] + unknown
+    rnd.shuffle(names)
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        snap = Snapshot(os.path.join(tmp, 'snapshot.db'))
+        snap.build(handle, [])
+        result = {'packages': opts.packages, 'names': len(names), 'unknown': len(unknown)}
+        for label, co in (('handle', PkgCache(handle)), ('snapshot', SnapshotCache(snap))):
+            for filters in ([], ['newest']):
+                def each():
+                    return [p for p in PkgFilter(filters).filter(
+                        p for name in names for p in co.get(name))]
+                def bulk():
+                    missing = []
+                    return [p for p in PkgFilter(filters).filter(co.resolve(names, missing))], missing
+                t_each, r_each = timed(each, opts.repeat)
+                t_bulk, (r_bulk, missing) = timed(bulk, opts.repeat)
+                key = label + ('_' + '_'.join(filters) if filters else '')
+                result[key] = {'per_name_ms': t_each * 1000, 'bulk_ms': t_bulk * 1000,
+                               'packages': len(r_bulk), 'unresolved': len(missing),
+                               'same': [(p.name, p.version, p.db.name) for p in r_each] ==
+                                       [(p.name, p.version, p.db.name) for p in r_bulk]}
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_listing(opts):
+    '''get-packages style listings, with and without the newest filter
+    (which keeps every package until the end): from the snapshot, full
+    Records against PkgRecords; with --handle also the Packages of a real
+    handle on synthetic databases, for comparison. Time and tracemalloc
+    peak.'''
+    import tracemalloc
+    from pacman import Pacman, PkgFilter
+    from snapshot import Snapshot, SnapshotCache
+    def measure(func):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        count = func()
+        seconds = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {'seconds': seconds, 'peak_kb': peak // 1024, 'packages': count}
+    def listings(kinds):
+        out = dict()
+        for filters in ([], ['newest']):
+            for label, pkgs in kinds:
+                # what the helper keeps of each package: its output line
+                run = lambda: len(['%s;%s;%s;%s\t%s\t%s' % (p.name, p.version, p.arch, p.db.name,
+                                                           p.installdate, p.desc)
+                                   for p in PkgFilter(filters).filter(pkgs())])
+                run()
+                out[label + ('_newest' if filters else '')] = measure(run)
+        return out
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        result = {'packages': opts.packages}
+        handle = synthetic_handle(opts.packages, seed=opts.seed)
+        for db in handle.dbs:
+            for pkg in db.pkgcache:
+                pkg.depends = ['dep%d>=1.0' % i for i in range(opts.fanout)]
+                pkg.provides = ['so-%s=1' % pkg.name]
+        snap = Snapshot(os.path.join(tmp, 'snapshot.db'))
+        snap.build(handle, [])
+        co = SnapshotCache(snap)
+        result['snapshot'] = listings((('full', co.all), ('records', co.listing)))
+        if opts.handle:
+            synth = Synthetic(os.path.join(tmp, 'root'), opts)
+            result['handle'] = listings((('packages', Pacman(synth.conf).cache().listing),))
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_vercmp(opts):
+    '''pkgver against libalpm: the vercmptest.sh corpus, every pair of
+    installed versions when pyalpm is around, and sort timings.'''
+    import pkgver
+    failed = [c for c in VERCMP_CORPUS if pkgver.vercmp(c[0], c[1]) != c[2] or
+              pkgver.vercmp(c[1], c[0]) != -c[2]]
+    result = {'corpus': len(VERCMP_CORPUS), 'corpus_failed': failed}
+    versions = synthetic_versions(opts.versions)
+    try:
+        import pyalpm
+    except ImportError:
+        pyalpm = None
+    if pyalpm:
+        from pycman.config import PacmanConfig
+        handle = PacmanConfig('/etc/pacman.conf').initialize_alpm()
+        real = sorted(set(p.version for p in handle.get_localdb().pkgcache))
+        mismatch = [(a, b) for a in real for b in real
+                    if pkgver.vercmp(a, b) != pyalpm.vercmp(a, b)]
+        result['installed_pairs'] = len(real) ** 2
+        result['installed_mismatch'] = mismatch[:20]
+        t, r = timed(lambda: sorted(versions, key=functools.cmp_to_key(pyalpm.vercmp)))
+        result['sort_pyalpm_ms'] = t * 1000
+    pkgver.KEYS.clear()
+    t, r = timed(lambda: sorted(versions, key=pkgver.version_key), 1)
+    result['sort_keys_cold_ms'] = t * 1000
+    t, r = timed(lambda: sorted(versions, key=pkgver.version_key))
+    result['sort_keys_cached_ms'] = t * 1000
+    return result
+
+class Mirror(object):
+    '''a loopback HTTP mirror serving root, sleeping latency seconds before
+    each response and between 64k chunks.'''
+    def __init__(self, root, latency=0.0):
+        latency_ = latency
+        class Handler(SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=root, **kwargs)
+            def log_message(self, *args):
+                pass
+            def send_head(self):
+                time.sleep(latency_)
+                rng = self.headers.get('Range', '')
+                path = self.translate_path(self.path)
+                if not rng.startswith('bytes=') or not os.path.isfile(path):
+                    return super().send_head()
+                start = int(rng[6:].split('-')[0])
+                size = os.path.getsize(path)
+                if start >= size:
+                    self.send_error(416)
+                    return None
+                f = open(path, 'rb')
+                f.seek(start)
+                self.send_response(206)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+                self.send_header('Content-Length', str(size - start))
+                self.end_headers()
+                return f
+            def copyfile(self, source, outputfile):
+                while True:
+                    buf = source.read(64 * 1024)
+                    if not buf:
+                        break
+                    outputfile.write(buf)
+                    time.sleep(latency_)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def bench_refresh(opts):
+    '''repo database downloads from a slow loopback mirror, serial against
+    the Fetcher pool used by refresh-cache.'''
+    from fetch import Fetcher, Job
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        mirror_root = os.path.join(tmp, 'mirror')
+        os.makedirs(mirror_root)
+        repos = ['repo%d' % i for i in range(opts.repos)]
+        for repo in repos:
+            with open(os.path.join(mirror_root, repo + '.db'), 'wb') as fp:
+                fp.write(os.urandom(opts.size * 1024))
+        mirror = Mirror(mirror_root, opts.latency / 1000.0)
+        result = {'repos': opts.repos, 'kbytes': opts.size, 'latency_ms': opts.latency}
+        for workers in sorted(set([1, opts.workers])):
+            dest = os.path.join(tmp, 'sync%d' % workers)
+            os.makedirs(dest)
+            jobs = [Job(repo, [mirror.url + '/' + repo + '.db'],
+                        os.path.join(dest, repo + '.db')) for repo in repos]
+            t0 = time.perf_counter()
+            results = Fetcher(workers).fetch(jobs)
+            result['workers_%d' % workers] = {
+                'seconds': time.perf_counter() - t0,
+                'failed': [k for k, r in results.items() if r.error],
+                'per_repo_s': dict((k, round(r.seconds, 3)) for k, r in results.items())}
+        mirror.close()
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_download(opts):
+    '''package downloads from a slow loopback mirror: serial, pooled, and
+    pooled resuming half-downloaded .part files.'''
+    import hashlib
+    from fetch import Fetcher, Job
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        mirror_root = os.path.join(tmp, 'mirror')
+        os.makedirs(mirror_root)
+        files = dict()
+        for i in range(opts.packages):
+            name = 'pkg%d-1.0-1-x86_64.pkg.tar.zst' % i
+            data = os.urandom(opts.size * 1024)
+            with open(os.path.join(mirror_root, name), 'wb') as fp:
+                fp.write(data)
+            files[name] = (len(data), hashlib.sha256(data).hexdigest(), data)
+        mirror = Mirror(mirror_root, opts.latency / 1000.0)
+        result = {'packages': opts.packages, 'kbytes': opts.size, 'latency_ms': opts.latency}
+        runs = [('serial', 1, False), ('parallel', opts.workers, False),
+                ('parallel_resume', opts.workers, True)]
+        for label, workers, resume in runs:
+            dest = os.path.join(tmp, label)
+            os.makedirs(dest)
+            jobs = []
+            for name, (size, sha, data) in files.items():
+                path = os.path.join(dest, name)
+                if resume:
+                    with open(path + '.part', 'wb') as fp:
+                        fp.write(data[:size // 2])
+                jobs.append(Job(name, [mirror.url + '/' + name], path, resume=True,
+                                size=size, sha256=sha))
+            fetcher = Fetcher(workers)
+            t0 = time.perf_counter()
+            results = fetcher.fetch(jobs)
+            result[label] = {'seconds': time.perf_counter() - t0,
+                             'bytes': sum(r.bytes for r in results.values()),
+                             'throughput_kbs': fetcher.rate() / 1024,
+                             'failed': [k for k, r in results.items() if r.error]}
+        mirror.close()
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_prefetch(opts):
+    '''background prefetch: how close a rate capped Fetcher stays to its
+    cap, how fast it lets go once db.lck appears, and the download time
+    left to a transaction with and without a prefetch before it.'''
+    import hashlib
+    from fetch import Fetcher, Job
+    from prefetch import Background
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        mirror_root = os.path.join(tmp, 'mirror')
+        os.makedirs(mirror_root)
+        pkgs = []
+        db = FakeDB('repo')
+        for i in range(opts.packages):
+            name = 'pkg%d-1.0-1-x86_64.pkg.tar.zst' % i
+            data = os.urandom(opts.size * 1024)
+            with open(os.path.join(mirror_root, name), 'wb') as fp:
+                fp.write(data)
+            pkg = FakePkg('pkg%d' % i, '1.0-1', db)
+            pkg.filename = name
+            pkg.size = len(data)
+            pkg.sha256sum = hashlib.sha256(data).hexdigest()
+            pkgs.append(pkg)
+        mirror = Mirror(mirror_root, opts.latency / 1000.0)
+        def jobs(dest):
+            return [Job(p.filename, [mirror.url + '/' + p.filename],
+                        os.path.join(dest, p.filename), resume=True,
+                        size=p.size, sha256=p.sha256sum) for p in pkgs]
+        limit = opts.rate * 1024
+        result = {'packages': opts.packages, 'kbytes': opts.size,
+                  'latency_ms': opts.latency, 'rate_kbs': opts.rate}
+        # the cap
+        dest = os.path.join(tmp, 'capped')
+        os.makedirs(dest)
+        fetcher = Fetcher(opts.workers, limit=limit)
+        t0 = time.perf_counter()
+        fetcher.fetch(jobs(dest))
+        result['capped'] = {'seconds': time.perf_counter() - t0,
+                            'throughput_kbs': fetcher.rate() / 1024}
+        # letting go once db.lck shows up
+        dest = os.path.join(tmp, 'held')
+        os.makedirs(dest)
+        lock = os.path.join(tmp, 'db.lck')
+        fetcher = Fetcher(opts.workers, limit=limit, hold=lambda: os.path.exists(lock))
+        done = []
+        thread = threading.Thread(target=lambda: done.append(fetcher.fetch(jobs(dest))))
+        thread.start()
+        time.sleep(opts.hold / 1000.0)
+        open(lock, 'w').close()
+        t0 = time.perf_counter()
+        thread.join()
+        result['held'] = {'release_ms': (time.perf_counter() - t0) * 1000,
+                          'complete': sum(1 for f in os.listdir(dest) if not f.endswith('.part')),
+                          'partial': sum(1 for f in os.listdir(dest) if f.endswith('.part'))}
+        os.unlink(lock)
+        # what a transaction still has to download
+        for label, before in (('cold', None), ('prefetched', dest)):
+            cachedir = os.path.join(tmp, 'cache-' + label)
+            if before:
+                Fetcher(opts.workers).fetch(jobs(before))
+                shutil.copytree(before, cachedir)
+            else:
+                os.makedirs(cachedir)
+            background = Background(tmp)
+            if os.path.exists(background.statspath):
+                os.unlink(background.statspath)
+            with background.lock():
+                background.account(pkgs, cachedir)
+            todo = [j for j, p in zip(jobs(cachedir), pkgs)
+                    if not (os.path.exists(j.dest) and os.path.getsize(j.dest) == p.size)]
+            t0 = time.perf_counter()
+            Fetcher(opts.workers).fetch(todo)
+            stats = background.stats()
+            result['transaction_' + label] = {'download_seconds': time.perf_counter() - t0,
+                                              'hits': stats['hits'], 'misses': stats['misses']}
+        mirror.close()
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_output(opts):
+    '''package lines per second into a pipe: print and flush per line
+    against LineBuffer; with --helper also get-packages and search-details
+    from the real helper.'''
+    from output import LineBuffer
+    names = synthetic_names(min(opts.lines, 50000))
+    lines = ['package\tavailable\t%s;1.0-1;x86_64;extra\tsummary of %s' % (n, n)
+             for n in names]
+    lines = (lines * (opts.lines // len(lines) + 1))[:opts.lines]
+
+    def drain(fd):
+        with os.fdopen(fd, 'rb') as fp:
+            while fp.read(1 << 16):
+                pass
+
+    def through(make):
+        r, w = os.pipe()
+        reader = threading.Thread(target=drain, args=(r,))
+        reader.start()
+        with os.fdopen(w, 'w') as raw:
+            out = make(raw)
+            t0 = time.perf_counter()
+            for line in lines:
+                print(line, file=out)
+                out.flush()
+            if hasattr(out, 'sync'):
+                out.sync()
+            t = time.perf_counter() - t0
+        reader.join()
+        return len(lines) / t
+
+    result = {'lines': len(lines),
+              'unbuffered_lines_s': through(lambda raw: raw),
+              'linebuffer_lines_s': through(LineBuffer)}
+    if opts.helper:
+        for cmd in (['get-packages', 'none'], ['search-details', 'none', 'lib']):
+            t0 = time.perf_counter()
+            proc = helper(cmd, stdin=subprocess.DEVNULL)
+            count = sum(1 for line in proc.stdout if line.startswith('package\t'))
+            proc.wait()
+            result[cmd[0] + '_lines_s'] = count / (time.perf_counter() - t0)
+    return result
+
+def desc_entry(fields):
+    '''an alpm db 'desc' file from [(FIELD, value or [values])].'''
+    out = []
+    for field, value in fields:
+        if isinstance(value, (list, tuple)):
+            if not value:
+                continue
+            value = '\n'.join(value)
+        out.append('%%%s%%\n%s\n' % (field, value))
+    return '\n'.join(out) + '\n'
+
+def files_entry(paths):
+    return '%FILES%\n' + ''.join(p + '\n' for p in paths) + '\n'
+
+def tar_add(tar, name, text):
+    data = text.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 1500000000
+    tar.addfile(info, io.BytesIO(data))
+
+def bench_journal(opts):
+    '''the refresh change journal: diffing two versions of a repo database
+    and folding many generations with changes_since(), against reading
+    every desc of the new database.'''
+    from journal import Journal
+    rnd = random.Random(opts.seed)
+    names = synthetic_names(opts.packages, opts.seed)
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        def write(path, versions):
+            with tarfile.open(path, 'w:gz') as tar:
+                for name in sorted(versions):
+                    entry = '%s-%s' % (name, versions[name])
+                    tar_add(tar, entry + '/desc', desc_entry(
+                        [('NAME', name), ('VERSION', versions[name]),
+                         ('DESC', 'summary of ' + name)]))
+        journal = Journal(os.path.join(tmp, 'journal.json'))
+        versions = dict((n, '1.0-1') for n in names[:len(names) * 9 // 10])
+        spare = names[len(names) * 9 // 10:]
+        old = os.path.join(tmp, 'old.db')
+        new = os.path.join(tmp, 'new.db')
+        write(old, versions)
+        expected = dict(versions)
+        compare = []
+        for gen in range(opts.generations):
+            for name in rnd.sample(sorted(versions), opts.changes):
+                versions[name] = '1.%d-1' % (gen + 1)
+            for name in rnd.sample(sorted(versions), opts.changes // 4):
+                del versions[name]
+            for i in range(opts.changes // 4):
+                if spare:
+                    versions[spare.pop()] = '1.0-1'
+            write(new, versions)
+            t0 = time.perf_counter()
+            journal.append({'repo': journal.compare(old, new)})
+            compare.append(time.perf_counter() - t0)
+            os.replace(new, old)
+        t0 = time.perf_counter()
+        net = journal.changes_since(0)['repos']['repo']
+        since = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        with tarfile.open(old, 'r:*') as tar:
+            descs = [tar.extractfile(m).read() for m in tar if m.isfile()]
+        full = time.perf_counter() - t0
+        # the folded change applied to the first database gives the last
+        for name, version in net['added'].items():
+            expected[name] = version
+        for name in net['removed']:
+            del expected[name]
+        for name, (a, b) in net['updated'].items():
+            expected[name] = b
+        return {'packages': opts.packages, 'generations': opts.generations,
+                'changes_per_generation': opts.changes,
+                'compare_ms': sorted(compare)[len(compare) // 2] * 1000,
+                'changes_since_0_ms': since * 1000,
+                'read_descs_ms': full * 1000, 'descs': len(descs),
+                'journal_bytes': os.path.getsize(journal.path),
+                'net': dict((k, len(v)) for k, v in net.items()),
+                'fold_matches': expected == versions}
+    finally:
+        shutil.rmtree(tmp)
+
+class Synthetic(object):
+    '''local and sync alpm databases of configurable size in a temporary
+    root, with a pacman.conf and helper prefix pointing at them.
+
+    Packages are spread over opts.repos repos; package i depends on up to
+    opts.fanout packages after it (a third through a 'so-*' provision),
+    every tenth is in a group and opts.installed of them are installed,
+    a tenth of those at an older version so get-updates has work.'''
+    def __init__(self, root, opts):
+        rnd = random.Random(opts.seed)
+        self.root = root
+        self.names = synthetic_names(opts.packages, opts.seed)
+        self.repos = ['synth%d' % i for i in range(opts.repos)]
+        dbpath = os.path.join(root, 'db')
+        self.prefix = os.path.join(root, 'prefix') + '/'
+        for d in ('local', 'sync'):
+            os.makedirs(os.path.join(dbpath, d))
+        for d in ('prefix', 'cache', 'pkgcache', 'fsroot', 'gnupg', 'pkcache'):
+            os.makedirs(os.path.join(root, d))
+        with open(os.path.join(dbpath, 'local', 'ALPM_DB_VERSION'), 'w') as fp:
+            fp.write('9\n')
+
+        count = len(self.names)
+        tars = dict((r, tarfile.open(os.path.join(dbpath, 'sync', r + '.db'), 'w:gz'))
+                    for r in self.repos)
+        ftars = dict((r, tarfile.open(os.path.join(dbpath, 'sync', r + '.files'), 'w:gz'))
+                     for r in self.repos)
+        self.installed = []
+        self.pkgs = []
+        for i, name in enumerate(self.names):
+            repo = self.repos[i % len(self.repos)]
+            version = '1.%d-1' % i
+            deps = []
+            for j in range(rnd.randint(0, opts.fanout)):
+                k = rnd.randint(i + 1, count) if i + 1 < count else count
+                if k < count:
+                    deps.append('so-' + self.names[k] if k % 3 == 0 else self.names[k])
+            provides = ['so-%s=1.%d' % (name, i)] if i % 3 == 0 else []
+            groups = ['synth-group%d' % (i % 5)] if i % 10 == 0 else []
+            paths = ['usr/', 'usr/bin/', 'usr/bin/' + name,
+                     'usr/share/', 'usr/share/' + name + '/']
+            paths += ['usr/share/%s/file%d' % (name, f) for f in range(opts.files)]
+            common = [('NAME', name), ('BASE', name),
+                      ('DESC', 'synthetic package %s for %s' % (name, repo)),
+                      ('URL', 'https://example.org/' + name), ('ARCH', 'x86_64'),
+                      ('BUILDDATE', '1500000000'), ('PACKAGER', 'bench'),
+                      ('ISIZE', str(1024 * (1 + opts.files))),
+                      ('LICENSE', ['custom' if i % 7 == 0 else 'GPL']),
+                      ('GROUPS', groups), ('DEPENDS', deps), ('PROVIDES', provides)]
+            entry = '%s-%s' % (name, version)
+            tar_add(tars[repo], entry + '/desc', desc_entry(
+                [('FILENAME', entry + '-x86_64.pkg.tar.zst'), ('VERSION', version),
+                 ('CSIZE', '1024')] + common))
+            tar_add(ftars[repo], entry + '/files', files_entry(paths))
+            self.pkgs.append((name, version, repo))
+            if rnd.random() < opts.installed:
+                lversion = version if rnd.random() > 0.1 else '1.%d-0' % i
+                lentry = os.path.join(dbpath, 'local', '%s-%s' % (name, lversion))
+                os.makedirs(lentry)
+                with open(os.path.join(lentry, 'desc'), 'w') as fp:
+                    fp.write(desc_entry([('VERSION', lversion),
+                                         ('INSTALLDATE', '1500000000'),
+                                         ('REASON', '0' if i % 4 == 0 else '1'),
+                                         ('SIZE', str(1024 * (1 + opts.files))),
+                                         ('VALIDATION', 'none')] +
+                                        [c for c in common if c[0] != 'ISIZE']))
+                with open(os.path.join(lentry, 'files'), 'w') as fp:
+                    fp.write(files_entry(paths))
+                self.installed.append((name, lversion))
+        for tar in list(tars.values()) + list(ftars.values()):
+            tar.close()
+
+        self.conf = os.path.join(self.prefix, 'pacman.conf')
+        with open(self.conf, 'w') as fp:
+            fp.write('[options]\nRootDir = %s\nDBPath = %s/\nCacheDir = %s/\n'
+                     'LogFile = %s\nGPGDir = %s/\nArchitecture = x86_64\n'
+                     'SigLevel = Never\n\n' % (
+                         os.path.join(root, 'fsroot'), dbpath,
+                         os.path.join(root, 'pkgcache'), os.path.join(root, 'pacman.log'),
+                         os.path.join(root, 'gnupg')))
+            for repo in self.repos:
+                fp.write('[%s]\nServer = file://%s\n\n' % (repo, os.path.join(root, 'mirror')))
+        here = os.path.dirname(os.path.abspath(__file__))
+        shutil.copy(os.path.join(here, 'groups.json'), self.prefix)
+        with open(os.path.join(self.prefix, 'blacklist.json'), 'w') as fp:
+            json.dump({'blocked': []}, fp)
+        self.env = dict(os.environ, PK_PACMAN_PREFIX=self.prefix,
+                        PK_PACMAN_CACHEDIR=os.path.join(root, 'pkcache') + '/')
+
+    def pid(self, i, installed=False):
+        name, version, repo = self.pkgs[i]
+        return '%s;%s;x86_64;%s' % (name, version, 'installed' if installed else repo)
+
+    def commands(self):
+        '''(label, argv) for every dispatcher command worth timing.'''
+        lname, lversion = self.installed[0]
+        linstalled = '%s;%s;x86_64;installed' % (lname, lversion)
+        top = self.pid(0)
+        bottom = self.names[-1]
+        return [
+            ('get-repo-list', ['get-repo-list', 'none']),
+            ('get-packages', ['get-packages', 'none']),
+            ('get-packages-installed', ['get-packages', 'installed']),
+            ('get-packages-newest', ['get-packages', 'newest']),
+            ('search-name', ['search-name', 'none', 'gtk']),
+            ('search-details', ['search-details', 'none', 'synthetic&gtk']),
+            ('search-group', ['search-group', 'none', 'desktop-gnome']),
+            ('search-file', ['search-file', 'installed', '/usr/bin/' + lname]),
+            ('search-file-available', ['search-file', '~installed', '/usr/bin/' + bottom]),
+            ('resolve', ['resolve', 'none', '&'.join(self.names[::max(1, len(self.names) // 200)])]),
+            ('depends-on', ['depends-on', 'none', top, 'true']),
+            ('required-by', ['required-by', 'none', linstalled, 'true']),
+            ('what-provides', ['what-provides', 'none', 'any', 'so-' + self.names[0]]),
+            ('get-details', ['get-details', '&'.join(self.pid(i) for i in range(0, 50))]),
+            ('get-files', ['get-files', linstalled]),
+            ('get-updates', ['get-updates', 'none']),
+            ('get-update-detail', ['get-update-detail', top]),
+        ]
+
+def run_helper(argv, env):
+    '''wall time, peak RSS (kB), package lines and last error of one job.'''
+    t0 = time.perf_counter()
+    proc = helper(argv, stdin=subprocess.DEVNULL, env=env)
+    lines = 0
+    error = None
+    for line in proc.stdout:
+        if line.startswith('package\t'):
+            lines += 1
+        elif line.startswith('error\t'):
+            error = line.rstrip('\n')
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    return {'seconds': time.perf_counter() - t0, 'max_rss_kb': rusage.ru_maxrss,
+            'packages': lines, 'error': error}
+
+def write_local(dbpath, count, files, big=0):
+    '''a local db with count packages of files files each, plus one with
+    big files when big is set; returns the entry of the big one.'''
+    local = os.path.join(dbpath, 'local')
+    os.makedirs(local)
+    for i in range(count):
+        name = 'pkg%d' % i
+        entry = os.path.join(local, name + '-1.0-1')
+        os.makedirs(entry)
+        paths = ['usr/share/%s/%d/file%d' % (name, f // 100, f) for f in range(files)]
+        with open(os.path.join(entry, 'files'), 'w') as fp:
+            fp.write(files_entry(paths))
+    if big:
+        entry = os.path.join(local, 'big-1.0-1')
+        os.makedirs(entry)
+        with open(os.path.join(entry, 'files'), 'w') as fp:
+            fp.write(files_entry('usr/lib/big/%d/%d/file-with-a-longer-name-%d.so' %
+                                 (f // 10000, f // 100, f) for f in range(big)))
+    return 'big-1.0-1'
+
+def bench_files(opts):
+    '''local file lists parsed serially and on a process pool; the file
+    list of one huge package joined into one line and in chunks.'''
+    import tracemalloc
+    import fileindex
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        write_local(tmp, opts.packages, opts.files, opts.big)
+        result = {'packages': opts.packages, 'files': opts.files, 'big': opts.big,
+                  'workers': fileindex.WORKERS}
+        for label, workers in (('serial', 1), ('parallel', fileindex.WORKERS)):
+            fileindex.WORKERS = workers
+            index = fileindex.FileIndex()
+            t, x = timed(lambda: index.update_local(tmp), 1)
+            result[label + '_scan_ms'] = t * 1000
+        out = open(os.devnull, 'w')
+        def joined():
+            out.write('files\tbig\t%s\n' % ';'.join(list(index.files('local', 'big', '1.0-1'))))
+        def chunked():
+            for text in fileindex.chunks(index.files('local', 'big', '1.0-1')):
+                out.write('files\tbig\t%s\n' % text)
+        for label, func in (('joined', joined), ('chunked', chunked)):
+            tracemalloc.start()
+            t, x = timed(func, 1)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result[label] = {'ms': t * 1000, 'peak_kb': peak // 1024}
+        out.close()
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_roots(opts):
+    '''get-updates for many roots with the same repos: one helper per root
+    against roots.py answering for all of them.'''
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        opts.files, opts.fanout, opts.repos = 2, 3, 3
+        synth = Synthetic(os.path.join(tmp, 'root0'), opts)
+        rnd = random.Random(opts.seed)
+        specs = []
+        for i in range(opts.roots):
+            root = os.path.join(tmp, 'root%d' % i)
+            dbpath = os.path.join(root, 'db')
+            conf = os.path.join(root, 'pacman.conf')
+            if i:
+                # same sync dbs, a different share of them installed
+                shutil.copytree(os.path.join(tmp, 'root0', 'db'), dbpath)
+                local = os.path.join(dbpath, 'local')
+                for entry in os.listdir(local):
+                    if entry != 'ALPM_DB_VERSION' and rnd.random() < 0.3:
+                        shutil.rmtree(os.path.join(local, entry))
+                with open(synth.conf) as fp:
+                    text = fp.read().replace(os.path.join(tmp, 'root0', 'db'), dbpath)
+                os.makedirs(os.path.join(root, 'prefix'))
+                with open(conf, 'w') as fp:
+                    fp.write(text)
+            else:
+                shutil.copy(synth.conf, conf)
+            specs.append({'name': 'root%d' % i, 'root': os.path.join(tmp, 'root0', 'fsroot'),
+                          'conf': conf, 'dbpath': dbpath + '/'})
+        with open(os.path.join(tmp, 'roots.json'), 'w') as fp:
+            json.dump(specs, fp)
+
+        t0 = time.perf_counter()
+        rss = 0
+        separate = 0
+        for spec in specs:
+            prefix = os.path.dirname(spec['conf']) + '/prefix/'
+            if not os.path.exists(prefix + 'pacman.conf'):
+                shutil.copy(spec['conf'], prefix + 'pacman.conf')
+                shutil.copy(synth.prefix + 'groups.json', prefix)
+                shutil.copy(synth.prefix + 'blacklist.json', prefix)
+            env = dict(synth.env, PK_PACMAN_PREFIX=prefix,
+                       PK_PACMAN_CACHEDIR=os.path.dirname(spec['conf']) + '/pkcache/')
+            run = run_helper(['get-updates', 'none'], env)
+            separate += run['packages']
+            rss = max(rss, run['max_rss_kb'])
+        helpers_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(HELPER), 'roots.py'),
+                                 os.path.join(tmp, 'roots.json'), 'get-updates'],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        out = json.load(proc.stdout)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        shared_s = time.perf_counter() - t0
+        shared = sum(len(r.get('packages', ())) for r in out.values())
+        return {'roots': opts.roots, 'packages': opts.packages,
+                'helpers': {'seconds': helpers_s, 'max_rss_kb': rss, 'updates': separate},
+                'shared': {'seconds': shared_s, 'max_rss_kb': rusage.ru_maxrss, 'updates': shared,
+                           'errors': dict((k, v['error']) for k, v in out.items() if 'error' in v)}}
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_cancel(opts):
+    '''SIGQUIT a persistent helper as soon as a large listing starts
+    streaming; time until it finished the job and check it still answers
+    the next one.'''
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        opts.files, opts.fanout, opts.repos, opts.installed = 2, 3, 3, 0.3
+        synth = Synthetic(tmp, opts)
+        cmd = ['get-packages', 'none']
+        proc = helper(stdin=subprocess.PIPE, env=synth.env)
+        def send(args):
+            proc.stdin.write('\t'.join(args) + '\n')
+            proc.stdin.flush()
+        def job(cancel_after=None):
+            '''(packages, error, seconds from cancel or start to finished)'''
+            packages = 0
+            error = None
+            t0 = time.perf_counter()
+            for line in proc.stdout:
+                if line.startswith('package\t'):
+                    packages += 1
+                    if packages == cancel_after:
+                        t0 = time.perf_counter()
+                        proc.send_signal(signal.SIGQUIT)
+                elif line.startswith('error\t'):
+                    error = line.split('\t')[1]
+                elif line.rstrip('\n') == 'finished':
+                    break
+            return packages, error, time.perf_counter() - t0
+        send(cmd)
+        full, error, full_s = job()
+        runs = []
+        for i in range(opts.repeat):
+            send(cmd)
+            packages, error, latency = job(cancel_after=1)
+            send(['get-repo-list', 'none'])
+            alive = job()[0] == 0 and proc.poll() is None
+            runs.append({'latency_ms': latency * 1000, 'packages': packages,
+                         'error': error, 'alive': alive})
+        send(['exit'])
+        proc.stdin.close()
+        proc.wait()
+        latencies = sorted(r['latency_ms'] for r in runs)
+        return {'command': cmd, 'packages': full, 'full_ms': full_s * 1000,
+                'median_latency_ms': latencies[len(latencies) // 2],
+                'max_latency_ms': latencies[-1],
+                'cancelled': all(r['error'] == 'transaction-cancelled' for r in runs),
+                'alive': all(r['alive'] for r in runs), 'runs': runs}
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_cold(opts):
+    '''fresh helper to first output line for trivial commands, against
+    generated databases; the first run leaves the metadata snapshot
+    behind, as a refresh would.'''
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        opts.files, opts.fanout, opts.repos, opts.installed = 2, 3, 3, 0.3
+        synth = Synthetic(tmp, opts)
+        imports = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import alpmBackend'],
+                                 cwd=os.path.dirname(HELPER), env=synth.env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 universal_newlines=True).stderr
+        top = [l.split('|') for l in imports.splitlines() if l.startswith('import time:')]
+        import_us = sum(int(l[1]) for l in top if not l[2].startswith('  ') and l[1].strip().isdigit())
+        lname, lversion = synth.installed[0]
+        cmds = [['get-repo-list', 'none'],
+                ['repo-enable', synth.repos[-1], 'true'],
+                ['resolve', 'none', synth.names[0]],
+                ['search-name', 'installed', lname[:4]],
+                ['get-details', '%s;%s;x86_64;installed' % (lname, lversion)]]
+        helper(cmds[0], stdin=subprocess.DEVNULL, env=synth.env).wait()
+        result = {'packages': opts.packages, 'target_ms': opts.target,
+                  'import_ms': import_us / 1000.0, 'commands': {}}
+        for cmd in cmds:
+            runs = []
+            for i in range(opts.repeat):
+                t0 = time.perf_counter()
+                proc = helper(cmd, stdin=subprocess.DEVNULL, env=synth.env)
+                first = read_job(proc)
+                proc.wait()
+                runs.append((first - t0) * 1000)
+            runs.sort()
+            median = runs[len(runs) // 2]
+            result['commands'][cmd[0]] = {'first_line_ms': median, 'best_ms': runs[0],
+                                          'ok': median <= opts.target}
+        result['ok'] = all(c['ok'] for c in result['commands'].values())
+        if opts.output:
+            with open(opts.output, 'w') as fp:
+                json.dump(result, fp, indent=2)
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_commands(opts):
+    '''every dispatcher command against generated databases.'''
+    tmp = tempfile.mkdtemp(prefix='pk-bench-')
+    try:
+        t0 = time.perf_counter()
+        synth = Synthetic(tmp, opts)
+        result = {'time': time.time(), 'packages': opts.packages,
+                  'installed': len(synth.installed), 'repos': opts.repos,
+                  'files': opts.files, 'fanout': opts.fanout,
+                  'generate_s': time.perf_counter() - t0, 'commands': {}}
+        for label, argv in synth.commands():
+            runs = [run_helper(argv, synth.env) for i in range(opts.repeat)]
+            best = min(runs, key=lambda r: r['seconds'])
+            best['max_rss_kb'] = max(r['max_rss_kb'] for r in runs)
+            result['commands'][label] = best
+        if opts.output:
+            with open(opts.output, 'w') as fp:
+                json.dump(result, fp, indent=2)
+        return result
+    finally:
+        if not opts.keep:
+            shutil.rmtree(tmp)
+
+def main():
+    parser = argparse.ArgumentParser(description='pacman backend benchmarks')
+    sub = parser.add_subparsers(dest='bench')
+    p = sub.add_parser('startup', help='spawn per job vs persistent helper')
+    p.add_argument('-n', '--jobs', type=int, default=20)
+    p.add_argument('command', nargs='*')
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser('names', help='NameIndex against a regex scan')
+    p.add_argument('-n', '--packages', type=int, default=50000)
+    p.add_argument('keys', nargs='*')
+    p.set_defaults(func=bench_names)
+    p = sub.add_parser('deps', help='dependency closure with Resolver')
+    p.add_argument('-n', '--packages', type=int, default=5000)
+    p.add_argument('-f', '--fanout', type=int, default=8)
+    p.set_defaults(func=bench_deps)
+    p = sub.add_parser('resolve', help='resolve thousands of names: per name against bulk')
+    p.add_argument('-n', '--packages', type=int, default=30000)
+    p.add_argument('--names', type=int, default=5000)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_resolve)
+    p = sub.add_parser('listing', help='memory and time of listings: snapshot rows against PkgRecords')
+    p.add_argument('-n', '--packages', type=int, default=30000)
+    p.add_argument('--fanout', type=int, default=6, help='dependencies per package')
+    p.add_argument('--handle', action='store_true', help='also from a real alpm handle')
+    p.add_argument('--files', type=int, default=2, help='files per package, with --handle')
+    p.add_argument('--repos', type=int, default=3)
+    p.add_argument('--installed', type=float, default=0.3, help='fraction installed')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_listing)
+    p = sub.add_parser('vercmp', help='pkgver keys against libalpm vercmp')
+    p.add_argument('-n', '--versions', type=int, default=20000)
+    p.set_defaults(func=bench_vercmp)
+    p = sub.add_parser('refresh', help='parallel db downloads from a slow mirror')
+    p.add_argument('-r', '--repos', type=int, default=6)
+    p.add_argument('-s', '--size', type=int, default=512)
+    p.add_argument('-l', '--latency', type=int, default=20)
+    p.add_argument('-w', '--workers', type=int, default=4)
+    p.set_defaults(func=bench_refresh)
+    p = sub.add_parser('download', help='parallel, resumable package downloads')
+    p.add_argument('-p', '--packages', type=int, default=16)
+    p.add_argument('-s', '--size', type=int, default=1024)
+    p.add_argument('-l', '--latency', type=int, default=5)
+    p.add_argument('-w', '--workers', type=int, default=5)
+    p.set_defaults(func=bench_download)
+    p = sub.add_parser('prefetch', help='rate capped background downloads and db.lck hold')
+    p.add_argument('-p', '--packages', type=int, default=16)
+    p.add_argument('-s', '--size', type=int, default=512)
+    p.add_argument('-l', '--latency', type=int, default=5)
+    p.add_argument('-w', '--workers', type=int, default=2)
+    p.add_argument('-r', '--rate', type=int, default=2048, help='cap in kB/s')
+    p.add_argument('--hold', type=int, default=500, help='ms before db.lck appears')
+    p.set_defaults(func=bench_prefetch)
+    p = sub.add_parser('output', help='protocol line throughput')
+    p.add_argument('-n', '--lines', type=int, default=200000)
+    p.add_argument('--helper', action='store_true')
+    p.set_defaults(func=bench_output)
+    p = sub.add_parser('search', help='search-details: regex scan against TokenIndex')
+    p.add_argument('-n', '--packages', type=int, default=15000)
+    p.add_argument('terms', nargs='*', help='one quoted argument per query')
+    p.set_defaults(func=bench_search)
+    p = sub.add_parser('files', help='file list scans and get-files output')
+    p.add_argument('-n', '--packages', type=int, default=2000)
+    p.add_argument('--files', type=int, default=100, help='files per package')
+    p.add_argument('--big', type=int, default=200000, help='files of the one huge package')
+    p.set_defaults(func=bench_files)
+    p = sub.add_parser('journal', help='refresh change journal: diff and changes_since')
+    p.add_argument('-n', '--packages', type=int, default=10000)
+    p.add_argument('-g', '--generations', type=int, default=20)
+    p.add_argument('-c', '--changes', type=int, default=200, help='version bumps per generation')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_journal)
+    p = sub.add_parser('roots', help='get-updates over many roots, shared sync dbs')
+    p.add_argument('-n', '--packages', type=int, default=5000)
+    p.add_argument('--roots', type=int, default=20)
+    p.add_argument('--installed', type=float, default=0.3, help='fraction installed')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_roots)
+    p = sub.add_parser('cancel', help='cancel latency of a streaming listing')
+    p.add_argument('-n', '--packages', type=int, default=30000)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_cancel)
+    p = sub.add_parser('cold', help='fresh helper to first output, trivial commands')
+    p.add_argument('-n', '--packages', type=int, default=5000)
+    p.add_argument('--target', type=float, default=50.0, help='ms to first output')
+    p.add_argument('--repeat', type=int, default=11)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('-o', '--output', help='also write the results here')
+    p.set_defaults(func=bench_cold)
+    p = sub.add_parser('commands', help='every command on synthetic databases')
+    p.add_argument('-n', '--packages', type=int, default=5000)
+    p.add_argument('--files', type=int, default=20, help='files per package')
+    p.add_argument('--fanout', type=int, default=6, help='max dependencies per package')
+    p.add_argument('--repos', type=int, default=3)
+    p.add_argument('--installed', type=float, default=0.3, help='fraction installed')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--keep', action='store_true', help='keep the temporary root')
+    p.add_argument('-o', '--output', help='also write the results here')
+    p.set_defaults(func=bench_commands)
+    opts = parser.parse_args()
+    if not hasattr(opts, 'func'):
+        parser.print_help()
+        return 1
+    json.dump(opts.func(opts), sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''cooperative cancellation.
+
+PackageKit cancels a job by sending the helper SIGQUIT. The handler only
+sets a flag; long loops call check() (or iterate through checkpoints())
+and raise Cancelled at the next checkpoint, so a cancelled job unwinds
+through the normal exception paths and the helper stays usable for the
+next job. The latency is bounded by EVERY iterations of the slowest loop
+plus the longest single libalpm call.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import signal
+
+EVERY = 64
+REQUESTED = False
+
+class Cancelled(Exception):
+    pass
+
+def request(signum=None, frame=None):
+    global REQUESTED
+    REQUESTED = True
+
+def reset():
+    global REQUESTED
+    REQUESTED = False
+
+def install():
+    '''cancel on SIGQUIT instead of dumping core.'''
+    signal.signal(signal.SIGQUIT, request)
+
+def check():
+    if REQUESTED:
+        raise Cancelled()
+
+def checkpoints(it, every=EVERY):
+    '''it, checking for cancellation every every items.'''
+    n = 0
+    for item in it:
+        n += 1
+        if n == every:
+            n = 0
+            if REQUESTED:
+                raise Cancelled()
+        yield item
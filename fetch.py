@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import cancel
+import hashlib
+import os
+import threading
+import time
+
+# concurrent.futures, email.utils and urllib are imported where they are
+# used: together they take longer to import than the rest of the helper,
+# and most commands never download anything.
+
+CHUNK = 64 * 1024
+
+class Held(OSError):
+    '''the Fetcher was told to let go; the .part file stays for a resume.'''
+    pass
+
+class Job(object):
+    '''one file to fetch from the first of urls that works.
+
+    The data goes to dest + '.part' and is renamed to dest when complete.
+    With newer set to a path, nothing is fetched unless the remote file is
+    more recent than that path. With resume, an existing .part file is
+    continued with a range request. size and sha256, when known, are
+    checked before the rename; an optional job never counts as failed.
+    data is left for the caller.'''
+    def __init__(self, key, urls, dest, newer=None, resume=False, size=0,
+                 sha256=None, optional=False, data=None):
+        self.key = key
+        self.urls = urls
+        self.dest = dest
+        self.newer = newer
+        self.resume = resume
+        self.size = size
+        self.sha256 = sha256
+        self.optional = optional
+        self.data = data
+        self.done = 0
+        self.total = size
+        self.finished = False
+
+class Result(object):
+    def __init__(self, key):
+        self.key = key
+        self.changed = False
+        self.error = None
+        self.url = None
+        self.bytes = 0
+        self.seconds = 0.0
+
+class Fetcher(object):
+    '''Fetches Jobs in parallel on a bounded pool of threads.
+
+    progress(job, overall) is called, serialized, whenever a job advances;
+    overall is the mean completion of every job in percent. A failing job
+    only fails itself.
+
+    limit caps the aggregate throughput in bytes/s (0: no cap). hold is a
+    callable checked before each job and each chunk; once it returns true
+    every job still running fails with Held and the rest are not started.'''
+    def __init__(self, workers=4, timeout=30, progress=None, limit=0, hold=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.progress = progress
+        self.limit = limit
+        self.hold = hold
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.received = 0
+        self.started = time.time()
+
+    def fetch(self, jobs):
+        '''run jobs and return {key: Result}.'''
+        self.jobs = list(jobs)
+        self.received = 0
+        self.started = time.time()
+        if not self.jobs:
+            return dict()
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max(1, min(self.workers, len(self.jobs)))) as pool:
+            results = list(pool.map(self._run, self.jobs))
+        return dict((r.key, r) for r in results)
+
+    def overall(self):
+        done = 0.0
+        for job in self.jobs:
+            if job.finished:
+                done += 1
+            elif job.total:
+                done += float(job.done) / job.total
+        return int(100 * done / len(self.jobs))
+
+    def rate(self):
+        '''aggregate throughput of the current fetch() in bytes/s.'''
+        elapsed = time.time() - self.started
+        return self.received / elapsed if elapsed > 0 else 0
+
+    def _report(self, job):
+        if not self.progress:
+            return
+        with self.lock:
+            self.progress(job, self.overall())
+
+    def _run(self, job):
+        # urllib has it loaded by the time anything can raise it
+        from http.client import HTTPException
+        result = Result(job.key)
+        t0 = time.time()
+        for url in job.urls:
+            try:
+                self._check()
+                result.changed = self._get(job, url, result)
+                result.url = url
+                result.error = None
+                break
+            except (OSError, ValueError, HTTPException) as e:
+                result.error = '%s: %s' % (url, e)
+        if not job.urls:
+            result.error = 'no server configured'
+        if job.optional:
+            result.error = None
+        result.seconds = time.time() - t0
+        job.finished = True
+        self._report(job)
+        return result
+
+    def _check(self):
+        cancel.check()
+        if self.hold and self.hold():
+            raise Held('held')
+
+    def _throttle(self):
+        '''sleep until the bytes received so far fit under limit.'''
+        if not self.limit:
+            return
+        ahead = float(self.received) / self.limit - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _open(self, job, url, headers):
+        import urllib.error
+        import urllib.request
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            return urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            # 304: not modified; 416: a resumed .part is already complete
+            if e.code in (304, 416):
+                return e.code
+            raise
+
+    def _get(self, job, url, result):
+        '''fetch job from url; False when the remote file was not newer.'''
+        from email.utils import formatdate, parsedate_to_datetime
+        headers = dict()
+        mtime = None
+        part = job.dest + '.part'
+        offset = 0
+        if job.newer and os.path.exists(job.newer):
+            mtime = os.stat(job.newer).st_mtime
+            headers['If-Modified-Since'] = formatdate(mtime, usegmt=True)
+        if job.resume and os.path.exists(part):
+            offset = os.path.getsize(part)
+            headers['Range'] = 'bytes=%d-' % offset
+        resp = self._open(job, url, headers)
+        if resp == 304:
+            return False
+        modified = None
+        if resp == 416:
+            job.done = job.total = offset
+        else:
+            with resp:
+                modified = resp.headers.get('Last-Modified')
+                try:
+                    modified = parsedate_to_datetime(modified).timestamp()
+                except (TypeError, ValueError):
+                    modified = None
+                if mtime and modified and modified <= mtime:
+                    # servers (and file://) that ignore If-Modified-Since
+                    return False
+                if offset and getattr(resp, 'status', None) != 206:
+                    offset = 0
+                length = resp.headers.get('Content-Length')
+                if length and length.isdigit():
+                    job.total = offset + int(length)
+                job.done = offset
+                with open(part, 'ab' if offset else 'wb') as fp:
+                    while True:
+                        chunk = resp.read(CHUNK)
+                        if not chunk:
+                            break
+                        self._check()
+                        fp.write(chunk)
+                        job.done += len(chunk)
+                        with self.lock:
+                            self.received += len(chunk)
+                        self._report(job)
+                        self._throttle()
+        self._verify(job, part)
+        if modified:
+            os.utime(part, (modified, modified))
+        os.replace(part, job.dest)
+        result.bytes = job.done - offset
+        return True
+
+    def _verify(self, job, part):
+        if job.size and os.path.getsize(part) != job.size:
+            size = os.path.getsize(part)
+            if size > job.size:
+                os.unlink(part)
+            raise ValueError('size mismatch (%d, expected %d)' % (size, job.size))
+        if job.sha256:
+            digest = hashlib.sha256()
+            with open(part, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(CHUNK), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != job.sha256:
+                os.unlink(part)
+                raise ValueError('sha256 mismatch')
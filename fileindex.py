@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import cancel
+import os
+import sqlite3
+import sys
+import tarfile
+
+# file lists are parsed in this many processes once there are PARALLEL
+# local entries or two .files databases to read
+WORKERS = min(os.cpu_count() or 1, 8)
+PARALLEL = 256
+# characters of paths per 'files' line of get-files
+CHUNK = 64 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pkgs (
+    id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    stamp INTEGER,
+    UNIQUE (repo, entry));
+CREATE TABLE IF NOT EXISTS files (
+    pkg INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    base TEXT);
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    stamp TEXT);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_base ON files (base);
+CREATE INDEX IF NOT EXISTS files_pkg ON files (pkg);
+'''
+
+def parse_entry(entry):
+    '''split a db entry 'name-pkgver-pkgrel' into (name, version).'''
+    name, ver, rel = entry.rsplit('-', 2)
+    return name, ver + '-' + rel
+
+def parse_files(lines):
+    '''yield the paths listed in the %FILES% section of a db 'files' entry.'''
+    infiles = False
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == '%FILES%':
+            infiles = True
+        elif not line:
+            infiles = False
+        elif infiles:
+            yield line
+
+def basename(path):
+    if path.endswith('/'):
+        return None
+    return path.rsplit('/', 1)[-1]
+
+def read_local(root, entries):
+    '''[(entry, paths)] of local db entries; runs in a worker process.'''
+    out = []
+    for entry in entries:
+        with open(os.path.join(root, entry, 'files'), 'r') as fp:
+            out.append((entry, list(parse_files(fp))))
+    return out
+
+def read_files_db(path):
+    '''[(entry, paths)] of a repo's .files database, [] when unreadable;
+    runs in a worker process.'''
+    out = []
+    try:
+        tar = tarfile.open(path, 'r:*')
+    except (tarfile.TarError, OSError):
+        return out
+    with tar:
+        for member in tar:
+            entry, _, fname = member.name.partition('/')
+            if fname != 'files' or not member.isfile():
+                continue
+            fp = tar.extractfile(member)
+            lines = (l.decode('utf-8', 'replace') for l in fp)
+            out.append((entry, list(parse_files(lines))))
+    return out
+
+def worker():
+    '''start a pool process without the helper's output.'''
+    sys.stdout = sys.__stdout__
+
+def parallel(func, jobs):
+    '''func(*job) for every job on a pool of processes, yielding results
+    in order; a cancel stops the pool without waiting for queued jobs.
+
+    The workers are forked: protocol lines still pending in the helper's
+    LineBuffer would be copied into each and written again when it exits,
+    so they go out first, and the workers drop the buffer.'''
+    from concurrent.futures import ProcessPoolExecutor
+    getattr(sys.stdout, 'sync', sys.stdout.flush)()
+    pool = ProcessPoolExecutor(min(WORKERS, len(jobs)), initializer=worker)
+    try:
+        for result in pool.map(func, *zip(*jobs)):
+            cancel.check()
+            yield result
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+def chunks(paths, size=CHUNK):
+    '''paths joined with ';' into strings of about size characters; at
+    least one, possibly empty.'''
+    chunk = []
+    length = 0
+    sent = False
+    for path in paths:
+        chunk.append(path)
+        length += len(path) + 1
+        if length >= size:
+            yield ';'.join(chunk)
+            sent = True
+            chunk = []
+            length = 0
+    if chunk or not sent:
+        yield ';'.join(chunk)
+
+class FileIndex(object):
+    '''path and basename -> owning package, kept in sqlite.
+
+    The local part follows the per-package entries under local/ and is
+    updated incrementally; the sync part is (re)read from a repo's .files
+    database whenever that file changes.'''
+    def __init__(self, path=':memory:'):
+        try:
+            self.db = sqlite3.connect(path)
+            self.db.executescript(SCHEMA)
+        except sqlite3.Error:
+            # not writable (e.g. not running as root): index in memory
+            self.db = sqlite3.connect(':memory:')
+            self.db.executescript(SCHEMA)
+
+    def _add(self, repo, entry, stamp, paths):
+        name, version = parse_entry(entry)
+        cur = self.db.execute(
+            'INSERT INTO pkgs (repo, entry, name, version, stamp) VALUES (?, ?, ?, ?, ?)',
+            (repo, entry, name, version, stamp))
+        pid = cur.lastrowid
+        self.db.executemany('INSERT INTO files (pkg, path, base) VALUES (?, ?, ?)',
+                            ((pid, p, basename(p)) for p in paths))
+
+    def _drop(self, repo, entries=None):
+        if entries is None:
+            ids = [r[0] for r in self.db.execute(
+                'SELECT id FROM pkgs WHERE repo = ?', (repo,))]
+        else:
+            ids = [r[0] for e in entries for r in self.db.execute(
+                'SELECT id FROM pkgs WHERE repo = ? AND entry = ?', (repo, e))]
+        self.db.executemany('DELETE FROM files WHERE pkg = ?', ((i,) for i in ids))
+        self.db.executemany('DELETE FROM pkgs WHERE id = ?', ((i,) for i in ids))
+
+    def update_local(self, dbpath):
+        '''reindex the local packages whose db entry appeared, vanished or
+        was rewritten since the last update. Like update_sync() it writes
+        in one sqlite transaction, which a cancel rolls back.'''
+        root = os.path.join(dbpath, 'local')
+        seen = dict()
+        for entry in os.listdir(root):
+            try:
+                st = os.stat(os.path.join(root, entry, 'files'))
+            except OSError:
+                continue
+            seen[entry] = st.st_mtime_ns
+        known = dict(self.db.execute(
+            'SELECT entry, stamp FROM pkgs WHERE repo = ?', ('local',)))
+        changed = [e for e, s in seen.items() if known.get(e) != s]
+        with self.db:
+            self._drop('local', [e for e, s in known.items() if seen.get(e) != s])
+            if len(changed) < PARALLEL or WORKERS < 2:
+                for entry in cancel.checkpoints(changed):
+                    with open(os.path.join(root, entry, 'files'), 'r') as fp:
+                        self._add('local', entry, seen[entry], parse_files(fp))
+                return
+            step = -(-len(changed) // (WORKERS * 4))
+            jobs = [(root, changed[i:i+step]) for i in range(0, len(changed), step)]
+            for result in parallel(read_local, jobs):
+                for entry, paths in result:
+                    self._add('local', entry, seen[entry], paths)
+
+    def update_sync(self, dbpath, repos):
+        '''reindex every repo whose .files database changed; repos without
+        one (never fetched with 'pacman -Fy') are simply left out.'''
+        changed = []
+        for repo in repos:
+            path = os.path.join(dbpath, 'sync', repo + '.files')
+            try:
+                st = os.stat(path)
+                stamp = '%d:%d' % (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stamp = None
+            known = self.db.execute('SELECT stamp FROM repos WHERE repo = ?',
+                                    (repo,)).fetchone()
+            if not known or known[0] != stamp:
+                changed.append((repo, path, stamp))
+        loaded = [c for c in changed if c[2]]
+        if len(loaded) < 2 or WORKERS < 2:
+            contents = (read_files_db(path) for repo, path, stamp in loaded)
+        else:
+            contents = parallel(read_files_db, [(path,) for repo, path, stamp in loaded])
+        contents = iter(contents)
+        for repo, path, stamp in changed:
+            with self.db:
+                self._drop(repo)
+                self.db.execute('INSERT OR REPLACE INTO repos (repo, stamp) VALUES (?, ?)',
+                                (repo, stamp))
+                if stamp:
+                    for entry, paths in cancel.checkpoints(next(contents)):
+                        self._add(repo, entry, None, paths)
+
+    def has(self, repo):
+        return self.db.execute('SELECT 1 FROM pkgs WHERE repo = ? LIMIT 1',
+                               (repo,)).fetchone() is not None
+
+    def owners(self, repo, keys):
+        '''(name, version) of the packages in repo that own a match for
+        every key. A key with a '/' matches paths starting with it, any
+        other key matches file basenames.'''
+        found = None
+        for key in keys:
+            key = key.lstrip('/')
+            if '/' in key:
+                rows = self.db.execute(
+                    'SELECT DISTINCT p.name, p.version FROM files f JOIN pkgs p ON f.pkg = p.id '
+                    'WHERE p.repo = ? AND f.path >= ? AND f.path < ?',
+                    (repo, key, key + '\U0010ffff'))
+            else:
+                rows = self.db.execute(
+                    'SELECT DISTINCT p.name, p.version FROM files f JOIN pkgs p ON f.pkg = p.id '
+                    'WHERE p.repo = ? AND f.base = ?', (repo, key))
+            rows = set(rows)
+            found = rows if found is None else found & rows
+            if not found:
+                break
+        return found or set()
+
+    def known(self, repo, name, version):
+        return self.db.execute(
+            'SELECT 1 FROM pkgs WHERE repo = ? AND name = ? AND version = ?',
+            (repo, name, version)).fetchone() is not None
+
+    def files(self, repo, name, version):
+        '''the file list of one package, in db order, as read.'''
+        return (r[0] for r in self.db.execute(
+            'SELECT f.path FROM files f JOIN pkgs p ON f.pkg = p.id '
+            'WHERE p.repo = ? AND p.name = ? AND p.version = ? ORDER BY f.rowid',
+            (repo, name, version)))
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''per-command timings and libalpm call counts.
+
+Off unless enable() is called; phase(), count(), iterate() and wrap_handle()
+then cost next to nothing. When on, every command appends one JSON line to
+the log: wall time, the time spent in each phase, the number of calls made
+through the alpm handle and its dbs, version comparisons and the packages
+emitted. Phases nest and are exclusive: time spent in an inner phase is
+not counted in the outer one. Phases entered between two commands (a
+reload of the handle after the dbs changed) go to the next command.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import collections
+import contextlib
+import json
+import os
+import time
+
+PROFILES = ('cprofile', 'tracemalloc')
+NULL = contextlib.nullcontext()
+
+class Recorder(object):
+    def __init__(self, log, profile=None):
+        self.log = log
+        self.profile = profile
+        self.stack = []
+        self.mark = time.perf_counter()
+        self.serial = 0
+        self.reset()
+
+    def reset(self):
+        self.times = collections.Counter()
+        self.counts = collections.Counter()
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self.stack:
+            self.times[self.stack[-1]] += now - self.mark
+        self.mark = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._switch()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self.stack.pop()
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @contextlib.contextmanager
+    def command(self, name, args):
+        '''record one command; the body runs in the 'query' phase.'''
+        self.serial += 1
+        profiler = None
+        if self.profile == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif self.profile == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        try:
+            with self.phase('query'):
+                yield
+        finally:
+            record = {'time': time.time(), 'pid': os.getpid(), 'command': name,
+                      'args': [str(a) for a in args],
+                      'seconds': time.perf_counter() - t0,
+                      'phases': dict(self.times), 'calls': dict(self.counts),
+                      'packages': self.counts.get('packages', 0)}
+            if profiler:
+                profiler.disable()
+                record['profile'] = '%s.%d.%d.%s.prof' % (self.log, os.getpid(), self.serial, name)
+                profiler.dump_stats(record['profile'])
+            elif self.profile == 'tracemalloc':
+                import tracemalloc
+                snapshot = tracemalloc.take_snapshot()
+                record['memory'] = {'peak': tracemalloc.get_traced_memory()[1],
+                    'top': [{'where': str(s.traceback), 'size': s.size, 'count': s.count}
+                            for s in snapshot.statistics('lineno')[:20]]}
+                tracemalloc.stop()
+            self.write(record)
+            self.reset()
+
+    def write(self, record):
+        try:
+            with open(self.log, 'a') as fp:
+                fp.write(json.dumps(record) + '\n')
+        except OSError:
+            pass
+
+RECORDER = None
+
+def enable(log, profile=None):
+    '''start recording to log; profile may be one of PROFILES.'''
+    global RECORDER
+    RECORDER = Recorder(log, profile if profile in PROFILES else None)
+    count_versions(RECORDER)
+    return RECORDER
+
+def enabled():
+    return RECORDER is not None
+
+def phase(name):
+    if RECORDER is None:
+        return NULL
+    return RECORDER.phase(name)
+
+def count(name, n=1):
+    if RECORDER is not None:
+        RECORDER.counts[name] += n
+
+def command(name, args):
+    if RECORDER is None:
+        return NULL
+    return RECORDER.command(name, args)
+
+def iterate(name, it):
+    '''it, with every step spent in the name phase.'''
+    if RECORDER is None:
+        return it
+    return _iterate(name, it)
+
+def _iterate(name, it):
+    it = iter(it)
+    while True:
+        with RECORDER.phase(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+class CountedDB(object):
+    '''a pyalpm DB counting the calls made through it. Reading pkgcache
+    (a fresh list of every package each time) is counted and timed as
+    'dbload'.'''
+    def __init__(self, db):
+        object.__setattr__(self, '_db', db)
+
+    @property
+    def pkgcache(self):
+        count('pkgcache')
+        with phase('dbload'):
+            return self._db.pkgcache
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        def _call(*args, **kwargs):
+            count(name)
+            return attr(*args, **kwargs)
+        return _call
+
+    def __setattr__(self, name, value):
+        setattr(self._db, name, value)
+
+class CountedHandle(object):
+    '''a pyalpm Handle whose dbs are CountedDBs. Attributes set on it
+    (cachedirs, ...) are set on the handle.'''
+    def __init__(self, handle):
+        object.__setattr__(self, '_handle', handle)
+
+    def get_localdb(self):
+        return CountedDB(self._handle.get_localdb())
+
+    def get_syncdbs(self):
+        return [CountedDB(db) for db in self._handle.get_syncdbs()]
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._handle, name, value)
+
+def wrap_handle(handle):
+    if RECORDER is None:
+        return handle
+    return CountedHandle(handle)
+
+def count_versions(recorder):
+    '''count every comparison of two pkgver.VersionKeys as 'vercmp'.'''
+    import operator
+    import pkgver
+    cmp = pkgver.VersionKey.cmp
+    def counted(op):
+        def _cmp(self, other):
+            recorder.counts['vercmp'] += 1
+            return op(cmp(self, other), 0)
+        return _cmp
+    def _counted_cmp(self, other):
+        recorder.counts['vercmp'] += 1
+        return cmp(self, other)
+    pkgver.VersionKey.cmp = _counted_cmp
+    for name, op in (('__eq__', operator.eq), ('__lt__', operator.lt),
+                     ('__le__', operator.le), ('__gt__', operator.gt),
+                     ('__ge__', operator.ge)):
+        setattr(pkgver.VersionKey, name, counted(op))
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''what each refresh changed in the sync databases.
+
+    journal.py JOURNAL [GENERATION]
+
+Every refresh that replaced at least one database appends a generation
+to the journal: for each replaced repo the packages added, removed and
+updated, as {'added': {name: version}, 'removed': {name: version},
+'updated': {name: [old, new]}}, or None when one of the two databases
+could not be read. The old and new package lists come from the member
+names of the database tarballs, read straight off the tar headers, so
+no desc file is parsed.
+
+Only the last KEEP generations are kept. changes_since(n) folds the
+generations after n into one net change per repo; it is None once n is
+older than what is kept, and whoever asks has to start over.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+from fileindex import parse_entry
+import json
+import os
+import sys
+import tarfile
+import time
+
+KEEP = 100
+BLOCK = 512
+
+def members(fp):
+    '''the member names of the tar archive read from fp.
+
+    tarfile builds a TarInfo per member, which costs several times more
+    than decompressing a repo database; only the name is needed here. GNU
+    long names and pax paths are followed, anything malformed raises
+    ValueError.'''
+    longname = None
+    while True:
+        header = fp.read(BLOCK)
+        if len(header) < BLOCK or header == bytes(BLOCK):
+            return
+        size = int(header[124:136].split(b'\0')[0].strip() or b'0', 8)
+        kind = header[156:157]
+        padded = size + (-size % BLOCK)
+        if kind in (b'L', b'x'):
+            body = fp.read(padded)[:size].decode('utf-8', 'replace')
+            if kind == b'L':
+                longname = body.rstrip('\0')
+            else:
+                for record in body.split('\n'):
+                    key, _, value = record.partition(' ')[2].partition('=')
+                    if key == 'path':
+                        longname = value
+            continue
+        if longname is not None:
+            name = longname
+        else:
+            name = header[:100].rstrip(b'\0').decode('utf-8', 'replace')
+            if header[257:262] == b'ustar' and header[345:346].strip(b'\0'):
+                name = header[345:500].rstrip(b'\0').decode('utf-8', 'replace') + '/' + name
+        longname = None
+        fp.seek(padded, 1)
+        yield name
+
+def opener(path):
+    '''an open function for the compression of path, None for any other
+    than gzip, xz and bzip2.'''
+    with open(path, 'rb') as fp:
+        magic = fp.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        import gzip
+        return gzip.open
+    if magic.startswith(b'\xfd7zXZ'):
+        import lzma
+        return lzma.open
+    if magic.startswith(b'BZh'):
+        import bz2
+        return bz2.open
+    return None
+
+def entries(path):
+    '''{name: version} of the sync database at path; {} when there is no
+    such file, None when it cannot be read.'''
+    if not os.path.exists(path):
+        return dict()
+    out = dict()
+    try:
+        try:
+            op = opener(path)
+            if not op:
+                raise ValueError(path)
+            with op(path, 'rb') as fp:
+                names = list(members(fp))
+        except (ValueError, EOFError):
+            # zstd and whatever members() cannot follow: the slow way
+            with tarfile.open(path, 'r:*') as tar:
+                names = tar.getnames()
+    except (tarfile.TarError, OSError, EOFError):
+        return None
+    for member in names:
+        try:
+            name, version = parse_entry(member.partition('/')[0])
+        except ValueError:
+            continue
+        out[name] = version
+    return out
+
+def diff(old, new):
+    '''the change from {name: version} old to new; None if either is.'''
+    if old is None or new is None:
+        return None
+    return {'added': dict((n, v) for n, v in new.items() if not n in old),
+            'removed': dict((n, v) for n, v in old.items() if not n in new),
+            'updated': dict((n, [v, new[n]]) for n, v in old.items()
+                            if n in new and new[n] != v)}
+
+def empty(change):
+    return change is not None and not any(change.values())
+
+class Journal(object):
+    '''the change journal in a JSON lines file at path, one generation per
+    line.'''
+    def __init__(self, path, keep=KEEP):
+        self.path = path
+        self.keep = keep
+
+    def read(self):
+        out = []
+        try:
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    try:
+                        out.append(json.loads(line))
+                    except ValueError:
+                        # a line cut short by a crash; the rest is fine
+                        continue
+        except OSError:
+            pass
+        return out
+
+    def compare(self, old, new):
+        '''the change from the database file old to new.'''
+        return diff(entries(old), entries(new))
+
+    def generation(self):
+        '''the latest generation, 0 before the first one.'''
+        records = self.read()
+        return records[-1]['generation'] if records else 0
+
+    def append(self, repos):
+        '''record {repo: change} as the next generation and return it; no
+        generation is added when nothing changed or the journal cannot be
+        written.'''
+        records = self.read()
+        generation = records[-1]['generation'] if records else 0
+        repos = dict((r, c) for r, c in repos.items() if not empty(c))
+        if not repos:
+            return generation
+        records.append({'generation': generation + 1, 'time': time.time(), 'repos': repos})
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as fp:
+                for record in records[-self.keep:]:
+                    fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+            os.replace(tmp, self.path)
+        except OSError:
+            return generation
+        return generation + 1
+
+    def changes_since(self, generation):
+        '''{'generation': latest, 'repos': {repo: change}} with the net
+        change of every repo since generation, or None when the journal no
+        longer goes back that far.'''
+        records = self.read()
+        latest = records[-1]['generation'] if records else 0
+        if generation < latest and (not records or records[0]['generation'] > generation + 1):
+            return None
+        states = dict()
+        for record in records:
+            if record['generation'] <= generation:
+                continue
+            for repo, change in record['repos'].items():
+                if change is None:
+                    states[repo] = None
+                    continue
+                state = states.setdefault(repo, dict())
+                if state is None:
+                    continue
+                # name -> [version before generation, version now]
+                for name, version in change['added'].items():
+                    state[name] = [state[name][0] if name in state else None, version]
+                for name, version in change['removed'].items():
+                    state[name] = [state[name][0] if name in state else version, None]
+                for name, (old, new) in change['updated'].items():
+                    state[name] = [state[name][0] if name in state else old, new]
+        out = dict()
+        for repo, state in states.items():
+            if state is None:
+                out[repo] = None
+                continue
+            change = {'added': dict(), 'removed': dict(), 'updated': dict()}
+            for name, (old, new) in state.items():
+                if old == new:
+                    continue
+                if old is None:
+                    change['added'][name] = new
+                elif new is None:
+                    change['removed'][name] = old
+                else:
+                    change['updated'][name] = [old, new]
+            if not empty(change):
+                out[repo] = change
+        return {'generation': latest, 'repos': out}
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    journal = Journal(sys.argv[1])
+    if len(sys.argv) > 2:
+        out = journal.changes_since(int(sys.argv[2]))
+    else:
+        out = {'generation': journal.generation()}
+    json.dump(out, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import time
+
+class LineBuffer(object):
+    '''A stand-in for sys.stdout that batches protocol lines.
+
+    The backend base class flushes after every line; here flush() only
+    holds back 'package' lines, until size characters are pending or
+    interval seconds have passed since the last write out. Any other line
+    (status, percentage, error, ...) goes out with everything before it
+    at once, so progress is never stuck behind a slow query. sync() always
+    writes out and is used at the end of a job. Everything goes through
+    the one buffer, so the order of lines is kept.'''
+    def __init__(self, stream, size=64 * 1024, interval=0.1):
+        self.stream = stream
+        self.size = size
+        self.interval = interval
+        self.pending = []
+        self.length = 0
+        self.last = time.monotonic()
+        # at the start of a line, and is a line other than 'package' pending
+        self.newline = True
+        self.urgent = False
+
+    def write(self, s):
+        if not s:
+            return 0
+        if self.newline and not s.startswith('package\t'):
+            self.urgent = True
+        self.newline = s.endswith('\n')
+        self.pending.append(s)
+        self.length += len(s)
+        return len(s)
+
+    def flush(self):
+        if self.urgent or self.length >= self.size or \
+           time.monotonic() - self.last >= self.interval:
+            self.sync()
+
+    def sync(self):
+        if self.pending:
+            self.stream.write(''.join(self.pending))
+            self.pending = []
+            self.length = 0
+        self.urgent = False
+        self.stream.flush()
+        self.last = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
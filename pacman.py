@@ -23,21 +23,83 @@
 __author__ = 'ck Lux <lux.r.ck@gmail.com>'
 
 from packagekit.enums import *
-from pyalpm import *
-from pycman.config import *
+from pkgver import version_key, vercmp
+from fetch import Fetcher, Job
+import cancel
+import instrument
+import signature
+from array import array
+import bisect
+import collections
+import contextlib
+import os
 import re
 
+class LockError(Exception):
+    pass
+
+@contextlib.contextmanager
+def dblock(handle):
+    '''hold pacman's database lock (db.lck) like libalpm does.'''
+    path = handle.lockfile
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o000)
+    except FileExistsError:
+        raise LockError("unable to lock database, '%s' exists" % path)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
 def pacman(conf=None):
+    from pycman.config import PacmanConfig
     config = PacmanConfig(conf)
     handle = config.initialize_alpm()
     return Pacman(handle)
 
+# pyalpm.PKG_REASON_DEPEND; pyalpm itself is only imported by load()
+PKG_REASON_DEPEND = 1
+
+DEPEXPR = re.compile(r'^(.*?)(<=|>=|<|>|=)(.*)$')
+DEPOPS = {
+    '<': lambda c: c < 0,
+    '<=': lambda c: c <= 0,
+    '=': lambda c: c == 0,
+    '>=': lambda c: c >= 0,
+    '>': lambda c: c > 0,
+}
+
+def parse_dep(expr):
+    '''split 'name[op version]' into (name, op, version); op and version
+    are None for an unversioned expression.'''
+    m = DEPEXPR.match(expr)
+    if not m:
+        return expr, None, None
+    return m.groups()
+
+def dep_satisfied(version, op, ver):
+    '''does a package or provision at version satisfy 'op ver'? As in
+    libalpm, an unversioned provision only satisfies unversioned deps.'''
+    if op is None:
+        return True
+    if version is None:
+        return False
+    return DEPOPS[op](vercmp(version, ver))
+
 class PkgFilter:
+    '''A lazy pipeline over an iterable of packages: the per-package
+    predicates run first and cheapest first, newest last since it has to
+    see every candidate of a name before it can emit one.'''
     def __init__(self, filters=None):
-        self.filters = filters
+        self.filters = filters or []
 
     def filter(self, pkgs):
         filters = self.filters
+        pkgs = cancel.checkpoints(pkgs)
+        if not filters:
+            return pkgs
+        pkgs = instrument.iterate('query', pkgs)
         if FILTER_INSTALLED in filters:
             pkgs = self.filter_install(pkgs, 1)
         elif FILTER_NOT_INSTALLED in filters:
@@ -49,56 +111,375 @@ class PkgFilter:
             pkgs = self.filter_free(pkgs, 0)
 
         if FILTER_NEWEST in filters:
-            pkgs = self.filter_newest(pkgs, 1)
-        return pkgs
+            pkgs = self.filter_newest(pkgs)
+        return instrument.iterate('filter', pkgs)
 
     def filter_install(self, pkgs, flag=1):
-        ou = []
         for p in pkgs:
-            c = p.db.name == 'local'
-            if c == flag:
-                ou.append(p)
-        return ou
+            if (p.db.name == 'local') == flag:
+                yield p
 
     def filter_free(self, pkgs, flag=1):
-        ou = []
         for p in pkgs:
-            c = not re.search('custom','&'.join(p.licenses))
-            if c == flag:
-                ou.append(p)
-        return ou
+            if (not any('custom' in l for l in p.licenses)) == flag:
+                yield p
 
-    def filter_newest(self, pkgs, flag=1):
-        def _pcm(p0, dc):
-            try:
-                pkgs = dc[p0.name]
-                for i,p in enumerate(pkgs):
-                    c0 = vercmp(p0.version, p.version)
-                    if c0 != 0:
-                        c1 = p0.db.name == 'local'
-                        c2 = p.db.name == 'local'
-                        if c1 == c2:
-                            if c0 != 1:
-                                return
-                            pkgs.pop(i)
-                        pkgs.append(p0)
-            except KeyError as e:
-                dc[p0.name] = [p0]
-        
-        dc = dict()
+    def filter_newest(self, pkgs):
+        '''the newest installed package of each name and the newest
+        available one if it is newer still, in the order each (name,
+        installed) pair was first seen. The caches drop an available copy
+        of the installed version before this sees it, so an older copy
+        must not take its place.'''
+        best = dict()
         for p in pkgs:
-            _pcm(p, dc)
-        ou = []
-        for v in dc.values():
-            ou += v
-        return ou
+            key = (p.name, p.db.name == 'local')
+            cur = best.get(key)
+            if cur is None or version_key(p.version) > version_key(cur.version):
+                best[key] = p
+        for (name, installed), p in best.items():
+            local = None if installed else best.get((name, True))
+            if local and version_key(p.version) <= version_key(local.version):
+                continue
+            yield p
+
+class NameIndex(object):
+    '''trigrams of the lowercased package names of one db.
+
+    Literal search keys are narrowed to the names sharing all of their
+    trigrams before the real substring test; keys using regex syntax are
+    compiled once and tested against the remaining names.'''
+    META = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.lower = [n.lower() for n in self.names]
+        grams = dict()
+        for i, n in enumerate(self.lower):
+            for g in set(n[j:j+3] for j in range(len(n) - 2)):
+                try:
+                    grams[g].append(i)
+                except KeyError:
+                    grams[g] = [i]
+        self.grams = grams
+
+    def posting(self, gram):
+        '''positions of the names containing gram.'''
+        return self.grams.get(gram, ())
+
+    def candidates(self, key):
+        if len(key) < 3:
+            return None
+        lists = [self.posting(key[j:j+3]) for j in range(len(key) - 2)]
+        lists.sort(key=len)
+        found = set(lists[0])
+        for l in lists[1:]:
+            if not found:
+                break
+            found.intersection_update(l)
+        return found
+
+    def match(self, keys):
+        '''positions of the names matching every key, in db order.'''
+        literals = []
+        patterns = []
+        for key in keys:
+            if self.META.search(key):
+                patterns.append(re.compile(key, re.IGNORECASE))
+            else:
+                literals.append(key.lower())
+        found = None
+        for key in literals:
+            c = self.candidates(key)
+            if c is not None:
+                found = c if found is None else found & c
+        if found is None:
+            found = range(len(self.names))
+        else:
+            found = sorted(found)
+        for i in found:
+            n = self.lower[i]
+            if all(key in n for key in literals) and \
+               all(p.search(self.names[i]) for p in patterns):
+                yield i
+
+class TokenIndex(object):
+    '''the words of one db's names, descriptions, provides and groups,
+    each with the positions of the packages using it.
+
+    A search term matches a package when it is a prefix of one of its
+    words or, through the db's NameIndex, part of its name; every term
+    has to match. Packages are scored by where their terms matched,
+    names weighing most and whole words more than prefixes.'''
+    WORD = re.compile(r'[a-z0-9]+')
+    DESC, GROUP, PROVIDES, NAME = range(4)
+    WEIGHTS = (1, 2, 4, 8)
+
+    def __init__(self, pkgs):
+        self.names = []
+        postings = dict()
+        findall = self.WORD.findall
+        for pos, pkg in enumerate(pkgs):
+            self.names.append(pkg.name)
+            # each word once per package, under the best field using it
+            fields = dict()
+            for word in findall((pkg.desc or '').lower()):
+                fields[word] = self.DESC
+            for group in pkg.groups:
+                for word in findall(group.lower()):
+                    fields[word] = self.GROUP
+            for expr in pkg.provides:
+                for word in findall(parse_dep(expr)[0].lower()):
+                    fields[word] = self.PROVIDES
+            for word in findall(pkg.name.lower()):
+                fields[word] = self.NAME
+            code = pos * 4
+            for word, field in fields.items():
+                try:
+                    postings[word].append(code + field)
+                except KeyError:
+                    postings[word] = array('l', [code + field])
+        self.postings = postings
+        self.words = sorted(postings)
+
+    def prefixed(self, prefix):
+        '''the words starting with prefix.'''
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            yield self.words[i]
+            i += 1
+
+    def lookup(self, prefix):
+        '''(word, postings) of the words starting with prefix.'''
+        for w in self.prefixed(prefix):
+            yield w, self.postings[w]
+
+    def term(self, term, names):
+        '''{position: score} of the packages matching one term.'''
+        scores = dict()
+        words = self.WORD.findall(term.lower())
+        for i, word in enumerate(words):
+            found = dict()
+            for w, codes in self.lookup(word):
+                bonus = 2 if w == word else 1
+                for code in codes:
+                    pos = code >> 2
+                    score = self.WEIGHTS[code & 3] * bonus
+                    if found.get(pos, 0) < score:
+                        found[pos] = score
+            if i == 0:
+                scores = found
+            else:
+                scores = dict((p, s + found[p]) for p, s in scores.items() if p in found)
+        # part of a name, including names joined with '-' like the term
+        lower = term.lower()
+        try:
+            for pos in names.match([term]):
+                score = self.WEIGHTS[self.NAME] * (4 if self.names[pos].lower() == lower else 1)
+                if scores.get(pos, 0) < score:
+                    scores[pos] = score
+        except re.error:
+            pass
+        return scores
+
+    def search(self, keys, names):
+        '''[(score, position)] of the packages matching every key, best
+        first and in db order among equals; names is the db's NameIndex.'''
+        found = None
+        for key in keys:
+            scores = self.term(key, names)
+            if found is None:
+                found = scores
+            else:
+                found = dict((p, s + scores[p]) for p, s in found.items() if p in scores)
+            if not found:
+                return []
+        return sorted((-s, p) for p, s in (found or {}).items())
+
+class ProvidesIndex(object):
+    '''name -> [(package name, version)] of everything one db provides.
+
+    A package provides its own name at its own version, plus each entry of
+    its provides list ('name' or 'name=version').'''
+    def __init__(self, pkgs):
+        index = dict()
+        def _add(name, pname, version):
+            try:
+                index[name].append((pname, version))
+            except KeyError:
+                index[name] = [(pname, version)]
+        for pkg in pkgs:
+            _add(pkg.name, pkg.name, pkg.version)
+            for expr in pkg.provides:
+                name, op, ver = parse_dep(expr)
+                _add(name, pkg.name, ver if op == '=' else None)
+        self.index = index
+
+    def lookup(self, name, pexprs=()):
+        '''names of the packages satisfying name under every (op, version)
+        in pexprs; a package called name comes before its providers.'''
+        entries = self.index.get(name, ())
+        seen = set()
+        for exact in (True, False):
+            for pname, version in entries:
+                if (pname == name) != exact or pname in seen:
+                    continue
+                if all(dep_satisfied(version, op, ver) for op, ver in pexprs):
+                    # a package may provide its own name besides being it
+                    seen.add(pname)
+                    yield pname
+
+def pkgkey(pkg):
+    return (pkg.name, pkg.version, pkg.arch, pkg.db.name)
+
+class Resolver(object):
+    '''Walks the edges(pkg) dependency expressions of packages with an
+    explicit worklist. Parsed expressions and their satisfiers are
+    memoized for the lifetime of the resolver.'''
+    def __init__(self, cache, edges):
+        self.cache = cache
+        self.edges = edges
+        self.exprs = dict()
+        self.found = dict()
+
+    def parse(self, expr):
+        try:
+            return self.exprs[expr]
+        except KeyError:
+            name, op, ver = parse_dep(expr)
+            self.exprs[expr] = (name, [(op, ver)] if op else [])
+            return self.exprs[expr]
+
+    def satisfier(self, expr):
+        try:
+            return self.found[expr]
+        except KeyError:
+            name, pexprs = self.parse(expr)
+            self.found[expr] = self.cache.satisfier(name, pexprs)
+            return self.found[expr]
+
+    def resolve(self, pkgs, recursive=True):
+        '''the packages reached from pkgs, each once, in breadth-first order
+        of discovery; a start package is only included when reached from
+        another one. Without recursive only direct edges are followed.'''
+        out = []
+        seen = set()
+        expanded = set()
+        work = collections.deque(pkgs)
+        while work:
+            cancel.check()
+            pkg = work.popleft()
+            key = pkgkey(pkg)
+            if key in expanded:
+                continue
+            expanded.add(key)
+            for expr in self.edges(pkg):
+                dep = self.satisfier(expr)
+                if not dep:
+                    continue
+                dkey = pkgkey(dep)
+                if dkey in seen:
+                    continue
+                seen.add(dkey)
+                out.append(dep)
+                if recursive:
+                    work.append(dep)
+        return out
+
+class DepGraph(object):
+    '''dependency graph of the local db, both directions in CSR form: the
+    edges of package i are targets[offsets[i]:offsets[i+1]].
+
+    Every installed package satisfying a dependency gets an edge, like
+    libalpm's compute_requiredby().'''
+    def __init__(self, pkgs, provides):
+        pkgs = list(pkgs)
+        self.names = [p.name for p in pkgs]
+        self.pos = dict((n, i) for i, n in enumerate(self.names))
+        self.reasons = array('b', [p.reason for p in pkgs])
+        deps = [set() for p in pkgs]
+        rdeps = [set() for p in pkgs]
+        for i, pkg in enumerate(cancel.checkpoints(pkgs)):
+            for expr in pkg.depends:
+                name, op, ver = parse_dep(expr)
+                for pname in provides.lookup(name, [(op, ver)] if op else []):
+                    j = self.pos[pname]
+                    deps[i].add(j)
+                    rdeps[j].add(i)
+        self.deps = self._csr(deps)
+        self.rdeps = self._csr(rdeps)
+
+    def _csr(self, adjacency):
+        offsets = array('l', [0])
+        targets = array('l')
+        for edges in adjacency:
+            targets.extend(sorted(edges))
+            offsets.append(len(targets))
+        return offsets, targets
+
+    def _edges(self, csr, i):
+        offsets, targets = csr
+        return targets[offsets[i]:offsets[i+1]]
+
+    def walk(self, names, recursive=True, reverse=True):
+        '''names reached from names, breadth first, like Resolver.resolve.'''
+        csr = self.rdeps if reverse else self.deps
+        start = [self.pos[n] for n in names if n in self.pos]
+        seen = set()
+        out = []
+        work = collections.deque(start)
+        expanded = set()
+        while work:
+            cancel.check()
+            i = work.popleft()
+            if i in expanded:
+                continue
+            expanded.add(i)
+            for j in self._edges(csr, i):
+                if j in seen:
+                    continue
+                seen.add(j)
+                out.append(self.names[j])
+                if recursive:
+                    work.append(j)
+        return out
+
+    def orphans(self, names):
+        '''depend-installed packages left unrequired once names are removed,
+        transitively, in the order they become unrequired.'''
+        gone = set(self.pos[n] for n in names if n in self.pos)
+        work = collections.deque(gone)
+        out = []
+        while work:
+            cancel.check()
+            i = work.popleft()
+            for j in self._edges(self.deps, i):
+                if j in gone or self.reasons[j] != PKG_REASON_DEPEND:
+                    continue
+                if all(k in gone for k in self._edges(self.rdeps, j)):
+                    gone.add(j)
+                    out.append(self.names[j])
+                    work.append(j)
+        return out
 
 class PkgCache(object):
-    def __init__(self, handle, blacklist=[]):
+    '''the dbs of one handle and the indexes built over them.
+
+    sync replaces the handle's own sync dbs, e.g. with equal ones another
+    handle has already loaded (see roots.py). Indexes are keyed by kind,
+    db name and tags[db name], so one indexes dict can be shared between
+    caches whose equally named dbs differ, as long as their tags do.
+    stored(kind, db name), if given, returns an index kept from an earlier
+    process for the db as loaded, or None to have it built.'''
+    def __init__(self, handle, blacklist=[], indexes=None, sync=None, tags=None,
+                 stored=None):
         self.handle = handle
+        self.indexes = dict() if indexes is None else indexes
+        self.stored = stored
+        self.sync = handle.get_syncdbs() if sync is None else sync
+        self.tags = dict() if tags is None else tags
         self._local = handle.get_localdb()
         self.repos = dict()
-        for db in handle.get_syncdbs():
+        for db in self.sync:
             self.repos[db.name] = [db, 1]
         for name in blacklist:
             self.set(name, False)
@@ -119,6 +500,12 @@ class PkgCache(object):
             for pkg in db.pkgcache:
                 yield pkg
 
+    def listing(self):
+        '''what get-packages lists: all() itself. A Package points into the
+        pkgcache the handle keeps loaded anyway; only the snapshot gains
+        from reading less (see SnapshotCache.listing()).'''
+        return self.all()
+
     def set(self, rid, enable):
         if rid == 'local':
             return
@@ -134,6 +521,33 @@ class PkgCache(object):
             if pkg:
                 yield pkg
     
+    def resolve(self, names, missing=None):
+        '''the packages of every name in names, in one loop: like get()
+        for each name in turn, but each name only once and the dbs looked
+        up just once for the whole call. Names no db has are appended to
+        missing, which is complete once the packages are consumed.'''
+        dbs = self.dbs()
+        seen = set()
+        for name in cancel.checkpoints(names):
+            if name in seen:
+                continue
+            seen.add(name)
+            installed = None
+            found = False
+            for db in dbs:
+                pkg = db.get_pkg(name)
+                if not pkg:
+                    continue
+                found = True
+                if db.name == 'local':
+                    installed = pkg.version
+                elif pkg.version == installed:
+                    # the sync copy of an installed package, see cached
+                    continue
+                yield pkg
+            if not found and missing is not None:
+                missing.append(name)
+
     def dbs(self):
         keys = list(self.repos.keys())
         keys.sort()
@@ -142,18 +556,22 @@ class PkgCache(object):
             dbs.insert(0, self._local)
         return dbs
 
+    def view(self, blacklist=[]):
+        return PkgCache(self.handle, blacklist, self.indexes, self.sync, self.tags,
+                        self.stored)
+
     def local(self):
-        c = PkgCache(self.handle)
+        c = self.view()
         c.repos = dict()
         return c
     
     def online(self):
-        c = PkgCache(self.handle, [v.name for k,v in self.repos.items() if not v[1]])
+        c = self.view([k for k,v in self.repos.items() if not v[1]])
         c._local = None
         return c
 
     def repo(self, repo=None):
-        c = PkgCache(self.handle)
+        c = self.view()
         c.repos = {}
         if not repo in ('local', 'installed'):
             c._local = None
@@ -161,26 +579,122 @@ class PkgCache(object):
             c.repos = {repo: [self.repos[repo][0], self.repos[repo][1]]}
         return c
 
+    def syncdbs(self):
+        '''the enabled sync dbs in pacman.conf order.'''
+        return [db for db in self.sync
+                if db.name in self.repos and self.repos[db.name][1]]
+
+    def candidates(self):
+        '''(newest, replaces) over the enabled repos, built once per handle.
+
+        newest maps a name to (version, db) of the package a sysupgrade
+        would pick: the first repo in pacman.conf order carrying it.
+        replaces maps a name to [(op, version, replacer name, db)].'''
+        dbs = self.syncdbs()
+        key = ('candidates',) + tuple((db.name, self.tags.get(db.name)) for db in dbs)
+        try:
+            return self.indexes[key]
+        except KeyError:
+            pass
+        newest = dict()
+        replaces = dict()
+        for db in dbs:
+            for pkg in cancel.checkpoints(db.pkgcache):
+                if not pkg.name in newest:
+                    newest[pkg.name] = (pkg.version, db)
+                for expr in pkg.replaces:
+                    name, op, ver = parse_dep(expr)
+                    try:
+                        replaces[name].append((op, ver, pkg.name, db))
+                    except KeyError:
+                        replaces[name] = [(op, ver, pkg.name, db)]
+        self.indexes[key] = (newest, replaces)
+        return self.indexes[key]
+
+    def upgrade(self, pkg):
+        '''the sync package that would upgrade pkg, or None.'''
+        newest, replaces = self.candidates()
+        try:
+            version, db = newest[pkg.name]
+        except KeyError:
+            return None
+        if version_key(version) > version_key(pkg.version):
+            return db.get_pkg(pkg.name)
+
+    def updates(self):
+        '''(installed, new) for every installed package with a newer version
+        or a replacement in the enabled repos, in one pass over the local
+        db joined against candidates().'''
+        newest, replaces = self.candidates()
+        local = self.handle.get_localdb()
+        for pkg in cancel.checkpoints(local.pkgcache):
+            npkg = self.upgrade(pkg)
+            if npkg:
+                yield pkg, npkg
+            for op, ver, rname, db in replaces.get(pkg.name, ()):
+                if rname != pkg.name and not local.get_pkg(rname) and \
+                   dep_satisfied(pkg.version, op, ver):
+                    yield pkg, db.get_pkg(rname)
+
     def newest(self, key):
-        if not type(key) == Package:
+        if isinstance(key, str):
             key = self.first(key)
         if key:
-            nkey = sync_newversion(key, self.handle.get_syncdbs())
+            nkey = self.upgrade(key)
             if not nkey:
                 return key
             return nkey
     
+    def packages(self, pids):
+        '''look up 'name;version;arch;repo' ids in one pass, exact about
+        all four parts ('installed' is the local db, disabled repos hold
+        nothing). Returns ([(pid, pkg)], [(pid, error, message)]), both in
+        the order of pids.'''
+        dbs = dict((db.name, db) for db in self.dbs())
+        found = []
+        missing = []
+        for pid in pids:
+            try:
+                pn, pv, pa, pi = pid.split(';')
+            except ValueError:
+                missing.append((pid, ERROR_PACKAGE_ID_INVALID, "invalid package id '%s'" % pid))
+                continue
+            db = dbs.get('local' if pi == 'installed' else pi)
+            pkg = db.get_pkg(pn) if db else None
+            if pkg and pkg.version == pv and pkg.arch == pa:
+                found.append((pid, pkg))
+            else:
+                missing.append((pid, ERROR_PACKAGE_NOT_FOUND, "could not find '%s'" % pid))
+        return found, missing
+
+    def provides(self, db):
+        return self.index('provides', db, lambda db: ProvidesIndex(db.pkgcache))
+
     @cached
     def provide(self, keys):
-        for pkg in self.all():
-            flag = True
-            for info in pkg.provides:
-                for key in keys:
-                    if not key in info:
-                        flag = False
-                        break
-                if flag:
-                    yield pkg
+        '''packages satisfying any of keys ('name' or 'name<op>version'),
+        each once however many keys it satisfies.'''
+        seen = set()
+        for key in keys:
+            name, op, ver = parse_dep(key.strip())
+            pexprs = [(op, ver)] if op else []
+            for db in self.dbs():
+                for pname in self.provides(db).lookup(name, pexprs):
+                    if not (db.name, pname) in seen:
+                        seen.add((db.name, pname))
+                        yield db.get_pkg(pname)
+
+    def graph(self):
+        '''the DepGraph of the local db.'''
+        db = self.handle.get_localdb()
+        return self.index('graph', db, lambda db: DepGraph(db.pkgcache, self.provides(db)))
+
+    def satisfier(self, name, pexprs=()):
+        '''the package that would satisfy a dependency on name with every
+        (op, version) in pexprs: installed first, then repos in order.'''
+        for db in self.dbs():
+            for pname in self.provides(db).lookup(name, pexprs):
+                return db.get_pkg(pname)
 
     def first(self, key, pexprs=None):
         for pkg in self.pkgs(key, pexprs):
@@ -218,38 +732,191 @@ class PkgCache(object):
                     for pkg in pgrp[1]:
                         yield pkg
 
-    @cached
     def search(self, keys):
-        ss = "|".join(keys)
-        for db in self.dbs():
-            pkgs = db.search(ss)
-            if pkgs == []:
-                continue
-            for pkg in pkgs:
-                yield pkg
+        '''packages matching every key in their name, description,
+        provides or groups (see TokenIndex), best matches first.'''
+        hits = []
+        for i, db in enumerate(self.dbs()):
+            names = self.index('names', db, lambda db: NameIndex(p.name for p in db.pkgcache))
+            tokens = self.index('tokens', db, lambda db: TokenIndex(db.pkgcache))
+            hits.extend((score, i, pos, db, tokens) for score, pos in tokens.search(keys, names))
+        hits.sort(key=lambda hit: hit[:3])
+        return self._unique(hit[3].get_pkg(hit[4].names[hit[2]]) for hit in hits)
+
+    @cached
+    def _unique(self, pkgs):
+        return pkgs
+
+    def index(self, kind, db, build):
+        '''the kind index of db, taken from stored or else built, once per
+        handle and shared by every view derived from this cache.'''
+        key = (kind, db.name, self.tags.get(db.name))
+        try:
+            return self.indexes[key]
+        except KeyError:
+            pass
+        index = self.stored(kind, db.name) if self.stored else None
+        self.indexes[key] = build(db) if index is None else index
+        return self.indexes[key]
 
     @cached
     def match(self, keys):
-        for pkg in self.all():
-            flag = True
-            for key in keys:
-                if not re.search(key, pkg.name, re.IGNORECASE):
-                    flag = False
-                    break
-            if flag:
-                yield pkg
+        for db in self.dbs():
+            index = self.index('names', db, lambda db: NameIndex(p.name for p in db.pkgcache))
+            for i in index.match(keys):
+                yield db.get_pkg(index.names[i])
 
-    def refresh(self, force=False):
+    @cached
+    def owners(self, index, keys):
+        '''packages owning files that match keys, looked up in a FileIndex.'''
+        for db in self.dbs():
+            for name, version in index.owners(db.name, keys):
+                pkg = db.get_pkg(name)
+                if pkg and pkg.version == version:
+                    yield pkg
+
+    def refresh(self, force=False, fetcher=None, journal=None, levels=None):
+        '''download the enabled repos' databases concurrently, then swap
+        the changed ones in under the db lock. Returns {repo: Result}; a
+        repo that failed keeps its old database and does not stop the
+        others. With a journal.Journal, what the swap changed in each repo
+        goes into it as a new generation.
+
+        The detached signature of each database that changed is fetched
+        next, in one more round, and checked before the swap under the
+        repo's SigLevel in levels ({repo: level} from signature.levels(),
+        pacman's default for the rest): a database failing it is not
+        swapped in, one passing it goes in with its signature or, without
+        one, drops the old signature.'''
+        fetcher = fetcher or Fetcher()
+        levels = levels or dict()
+        sync = os.path.join(self.handle.dbpath, 'sync')
+        gpgdir = getattr(self.handle, 'gpgdir', None) or signature.GPGDIR
+        jobs = []
+        sigs = dict()
         for db in self.online().dbs():
-            db.update(force)
+            path = os.path.join(sync, db.name + '.db')
+            urls = [server + '/' + db.name + '.db' for server in db.servers]
+            jobs.append(Job(db.name, urls, path + '.pk-new', None if force else path))
+        try:
+            results = fetcher.fetch(jobs)
+            for job in jobs:
+                if results[job.key].changed and \
+                   levels.get(job.key, signature.DEFAULT)['database'][0] != 'never':
+                    sigs[job.key] = Job(job.key + '.sig', [u + '.sig' for u in job.urls],
+                                        job.dest[:-len('.pk-new')] + '.sig.pk-new', optional=True)
+            fetcher.fetch(sigs.values())
+            for job in jobs:
+                result = results[job.key]
+                if not result.changed:
+                    continue
+                sig = sigs.get(job.key)
+                result.error = signature.check(job.dest, sig and sig.dest,
+                    levels.get(job.key, signature.DEFAULT)['database'], gpgdir)
+                if result.error:
+                    result.error = '%s: %s' % (job.key + '.db', result.error)
+                    result.changed = False
+            changes = dict()
+            if journal:
+                for job in jobs:
+                    if results[job.key].changed:
+                        changes[job.key] = journal.compare(job.dest[:-len('.pk-new')], job.dest)
+            with dblock(self.handle):
+                for job in jobs:
+                    if not results[job.key].changed:
+                        continue
+                    path = job.dest[:-len('.pk-new')]
+                    os.replace(job.dest, path)
+                    sig = sigs.get(job.key)
+                    if sig and os.path.exists(sig.dest):
+                        os.replace(sig.dest, path + '.sig')
+                    elif os.path.exists(path + '.sig'):
+                        # it does not sign the new database
+                        os.unlink(path + '.sig')
+                if changes:
+                    journal.append(changes)
+        finally:
+            # whatever was not swapped in: failed, unchanged or unchecked
+            for job in jobs + list(sigs.values()):
+                for path in (job.dest, job.dest + '.part'):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        return dict((job.key, results[job.key]) for job in jobs)
 
 class Pacman(object):
-    def __init__(self, conf):
-        self.config = PacmanConfig(conf)
-        self.handle = self.config.initialize_alpm()
-        self.source = PkgCache(self.handle)
+    def __init__(self, conf, lazy=False, root=None, dbpath=None):
+        self.conf = conf
+        # override RootDir and DBPath from conf, for chroots and containers
+        self.root = root
+        self.dbpath = dbpath
+        self.generation = 0
+        self.source = None
+        # a prefetch.Background whose lock transactions take, if any
+        self.prefetcher = None
+        if not lazy:
+            self.load()
+
+    def load(self):
+        '''(re)build the alpm handle and everything derived from it.'''
+        # pyalpm comes in with pycman, on first use only
+        from pycman.config import PacmanConfig
+        with instrument.phase('config'):
+            self._config = PacmanConfig(self.conf)
+            if self.root:
+                self._config.options['RootDir'] = self.root
+            if self.dbpath:
+                self._config.options['DBPath'] = self.dbpath
+        with instrument.phase('handle'):
+            self._handle = instrument.wrap_handle(self._config.initialize_alpm())
+        self.source = self.new_cache(self._handle)
+        self.stamp = self.dbstamp()
+        self.generation += 1
+
+    def new_cache(self, handle):
+        return PkgCache(handle)
+
+    def loaded(self):
+        return self.source is not None
+
+    @property
+    def handle(self):
+        if self.source is None:
+            self.load()
+        return self._handle
+
+    @property
+    def config(self):
+        if self.source is None:
+            self.load()
+        return self._config
+
+    def dbstamp(self):
+        '''stat the config, the local db directory and every sync db file.
+
+        pacman adds and removes a directory under local/ for each package
+        it installs or removes and replaces sync/*.db on refresh, so any
+        change to the installed or available packages gives a new stamp.'''
+        dbpath = self.handle.dbpath
+        paths = [self.conf, os.path.join(dbpath, 'local')]
+        for db in self.handle.get_syncdbs():
+            paths.append(os.path.join(dbpath, 'sync', db.name + '.db'))
+        stamp = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp.append((path, st.st_mtime_ns, st.st_size))
+            except (OSError, TypeError):
+                stamp.append((path, None, None))
+        return tuple(stamp)
+
+    def stale(self):
+        return self.source is not None and self.dbstamp() != self.stamp
 
     def cache(self):
+        if self.source is None:
+            self.load()
         return self.source
 
     def _match(self, keys, val):
@@ -263,82 +930,116 @@ class Pacman(object):
                 ret = False
         return ret
 
-    def dependency(func):
-        def _dependency(self, pkg, recursive=True):
-            def _format(exprs):
-                rr = re.compile(r'<=|>=|<|>|=')
-                pexprs = dict()
-                for expr in exprs:
-                    op = rr.search(expr)
-                    if not op:
-                        pexprs[expr] = []
-                    if op:
-                        op = op.group()
-                        name, ver = expr.split(op)
-                        if not name in pexprs.keys():
-                            pexprs[name] = []
-                        pexprs[name].append((op, ver))
-                return pexprs
-
-            def _package(c, pkgs, out, recursive = True):
-                def _dep(pkgs):
-                    ou = []
-                    for pkg in pkgs:
-                        ou += func(pkg)
-                    return set(ou)
-
-                def _get(pkes):
-                    deps = []
-                    for key, val in pkes.items():
-                        pkg = c.first(key, val)
-                        if pkg:
-                            deps.append(pkg)
-                    return deps
-
-                deps = _get(_format(_dep(pkgs)))
-                if len(deps) < 1:
-                    return
-                for dep in deps:
-                    out.add((dep.name, dep.version, dep.arch, dep.db.name))
-                ddeps = _get(_format(_dep(deps)))
-                if recursive:
-                    ou = set()
-                    for ddep in ddeps:
-                        ou.add((ddep.name, ddep.version, ddep.arch, ddep.db.name))
-                    ou -= out
-                    if len(ou):
-                        _package(c, ddeps, out, recursive)
-            
-            c = self.cache()
-            out = set()
-            _package(c, [pkg], out, recursive)
-            rt = []
-            for o in out:
-                rt.append(c.repo(o[3]).first(o[0], [('=', o[1])]))
-            return rt
-        return _dependency
-
-    @dependency
-    def calc_dependson(pkg):
-        return pkg.depends
-
-    @dependency
-    def calc_requiredby(pkg):
-        return pkg.compute_requiredby()
+    def calc_dependson(self, pkgs, recursive=True):
+        return Resolver(self.cache(), lambda pkg: pkg.depends).resolve(pkgs, recursive)
+
+    def calc_requiredby(self, pkgs, recursive=True):
+        '''installed packages are walked in the local DepGraph; anything
+        else asks libalpm.'''
+        lpkgs = [p for p in pkgs if p.db.name == 'local']
+        spkgs = [p for p in pkgs if p.db.name != 'local']
+        ldb = self.handle.get_localdb()
+        out = [ldb.get_pkg(n) for n in self.cache().graph().walk([p.name for p in lpkgs], recursive)]
+        if spkgs:
+            seen = set(pkgkey(p) for p in out)
+            def requiredby(pkg):
+                instrument.count('compute_requiredby')
+                return pkg.compute_requiredby()
+            for p in Resolver(self.cache(), requiredby).resolve(spkgs, recursive):
+                if not pkgkey(p) in seen:
+                    out.append(p)
+        return out
+
+    def calc_orphans(self, pkgs):
+        '''depend-installed packages nothing requires once pkgs are gone.'''
+        ldb = self.handle.get_localdb()
+        return [ldb.get_pkg(n) for n in self.cache().graph().orphans([p.name for p in pkgs])]
+
+    def siglevels(self):
+        '''{repo: SigLevel} as pacman.conf sets them, see signature.py.'''
+        return signature.levels(self.conf)
+
+    def fetcher(self):
+        '''the Fetcher used for package downloads; ParallelDownloads from
+        pacman.conf sets its connection limit.'''
+        try:
+            workers = int(self.config.options.get('ParallelDownloads', 4))
+        except (TypeError, ValueError):
+            workers = 4
+        return Fetcher(workers)
+
+    def prefetch(self, pkgs, directory, fetcher=None):
+        '''download the sync packages pkgs into directory in parallel,
+        resuming partial files and skipping complete ones. Detached
+        signatures are fetched too when the db does not carry them.
+        Returns {filename: Result} for what had to be fetched.'''
+        jobs = []
+        for pkg in pkgs:
+            if pkg.db.name == 'local' or not pkg.filename:
+                continue
+            path = os.path.join(directory, pkg.filename)
+            if os.path.exists(path) and os.path.getsize(path) == pkg.size:
+                continue
+            urls = [server + '/' + pkg.filename for server in pkg.db.servers]
+            jobs.append(Job(pkg.filename, urls, path, resume=True, size=pkg.size,
+                            sha256=pkg.sha256sum or None, data=pkg))
+            if not pkg.base64_sig and not os.path.exists(path + '.sig'):
+                jobs.append(Job(pkg.filename + '.sig', [u + '.sig' for u in urls],
+                                path + '.sig', optional=True, data=pkg))
+        return (fetcher or self.fetcher()).fetch(jobs)
+
+    def download(self, pkgs, directory):
+        '''fetch pkgs into directory with prefetch(), then hand them to a
+        libalpm downloadonly transaction over directory. That checks every
+        file against its db entry and signature under the repo's SigLevel,
+        and fetches whatever prefetch() could not.'''
+        cachedirs = self.handle.cachedirs
+        self.handle.cachedirs = [directory]
+        try:
+            results = self.prefetch(pkgs, directory)
+            trans = self.handle.init_transaction(force=True, nodeps=True, downloadonly=True)
+            try:
+                for pkg in pkgs:
+                    trans.add_pkg(pkg)
+                trans.prepare()
+                trans.commit()
+            finally:
+                trans.release()
+        finally:
+            self.handle.cachedirs = cachedirs
+        return results
+
+    @contextlib.contextmanager
+    def hold_cache(self, pkgs, directory):
+        '''keep a background prefetch out of directory, and count what it
+        already brought in. db.lck exists by the time a transaction gets
+        here, so a running prefetch is letting go; this waits for it.'''
+        if not self.prefetcher:
+            yield
+            return
+        with self.prefetcher.lock():
+            self.prefetcher.account(pkgs, directory)
+            yield
 
     def transaction(fn=None, flags=dict()):
         def _transaction(func):
             def commit(self, pkgs, cflags=dict()):
                 tr = func(self.handle, cflags)
+                trans = self.handle.init_transaction(**tr['flags'])
                 try:
-                    trans = self.handle.init_transaction(**tr['flags'])
                     for pkg in pkgs:
                         tr['action'](trans, pkg)
                     trans.prepare()
-                    trans.commit()
+                    cachedir = self.handle.cachedirs[0]
+                    with self.hold_cache(trans.to_add, cachedir):
+                        # fetch everything up front in parallel; whatever
+                        # fails is left to libalpm's own downloader, and
+                        # commit() checks every file in the cache against
+                        # its signature before anything is installed
+                        self.prefetch(trans.to_add, cachedir)
+                        trans.commit()
                 finally:
                     trans.release()
-                    self.handle.cachedirs = ['/var/cache/pacman/pkg/']
             return commit
         if not fn:
             return _transaction
@@ -361,17 +1062,6 @@ class Pacman(object):
 
     @transaction
     def update(handle, cflags):
-        def _cmd(trans, pkg):
-            co = self.cache()
-            npk = co.newest(pkg)
-            if npk:
-                trans.add_pkg(npk)
-        return {'flags':{'need':True}, 'action':_cmd}
-
-    @transaction
-    def download(handle, cflags):
         def _cmd(trans, pkg):
             trans.add_pkg(pkg)
-        if 'directory' in cflags.keys():
-            handle.cachedirs = [cflags['directory']]
-        return {'flags':{'force':True, 'nodeps':True, 'downloadonly':True}, 'action':_cmd}
+        return {'flags':{'needed':True}, 'action':_cmd}
@@ -57,7 +57,8 @@ pk_backend_initialize (GKeyFile *conf, PkBackend *backend)
 
 	spawn = pk_backend_spawn_new (conf);
 	pk_backend_spawn_set_name (spawn, "pacman");
-	pk_backend_spawn_set_allow_sigkill (spawn, TRUE);
+	/* the helper handles SIGQUIT itself and stays around for the next job */
+	pk_backend_spawn_set_allow_sigkill (spawn, FALSE);
 }
 
 /**
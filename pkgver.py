@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''pacman version comparison on parsed, cached keys.
+
+A version string is split once into the segments libalpm's rpmvercmp()
+walks; comparing two keys then replays rpmvercmp() on the segments. The
+result is the same as pyalpm.vercmp() for every input, including its
+quirks: a missing pkgrel compares equal to any pkgrel, so '1.0' == '1.0-1'
+and '1.0' == '1.0-2' while '1.0-1' < '1.0-2'.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import functools
+
+DIGITS = frozenset('0123456789')
+ALPHA = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+ALNUM = DIGITS | ALPHA
+
+def segments(s):
+    '''(segments, trailing) for one epoch, version or release string.
+    Each segment is (separator length before it, numeric, value) with
+    numeric values as int; trailing tells whether separators follow the
+    last segment.'''
+    segs = []
+    i = 0
+    n = len(s)
+    while i < n:
+        j = i
+        while j < n and not s[j] in ALNUM:
+            j += 1
+        if j == n:
+            return tuple(segs), True
+        k = j
+        if s[k] in DIGITS:
+            while k < n and s[k] in DIGITS:
+                k += 1
+            segs.append((j - i, 1, int(s[j:k])))
+        else:
+            while k < n and s[k] in ALPHA:
+                k += 1
+            segs.append((j - i, 0, s[j:k]))
+        i = k
+    return tuple(segs), False
+
+def flatten(segs):
+    '''segments() as a plain tuple that orders like rpmvercmp() under
+    native tuple comparison, or None when trailing separators make that
+    impossible. Separator lengths and (numeric, value) pairs alternate;
+    the end is marked by a separator length of 0 and (0.5,), which sorts
+    after an alpha segment directly following and before anything else.'''
+    segs, trailing = segs
+    if trailing:
+        return None
+    flat = []
+    for sep, num, value in segs:
+        flat.append(sep)
+        flat.append((num, value))
+    flat.append(0)
+    flat.append((0.5,))
+    return tuple(flat)
+
+def rpmvercmp(a, b):
+    '''compare two segments() results like libalpm's rpmvercmp().'''
+    if a == b:
+        return 0
+    (sa, ta), (sb, tb) = a, b
+    for x, y in zip(sa, sb):
+        if x[0] != y[0]:
+            return -1 if x[0] < y[0] else 1
+        if x[1] != y[1]:
+            return 1 if x[1] else -1
+        if x[2] != y[2]:
+            return -1 if x[2] < y[2] else 1
+    n = min(len(sa), len(sb))
+    if len(sa) == n and len(sb) == n:
+        return (ta > tb) - (ta < tb)
+    if len(sa) == n:
+        # a ran out: b wins unless what follows in b is an alpha segment
+        seg = sb[n]
+        if ta or seg[0] == 0:
+            return -1 if seg[1] else 1
+        return -1
+    seg = sa[n]
+    if tb or seg[0] == 0:
+        return 1 if seg[1] else -1
+    return 1
+
+def parse_evr(evr):
+    '''split 'epoch:version-release' into its parts as libalpm does; the
+    epoch defaults to '0' and the release may be None.'''
+    i = 0
+    while i < len(evr) and evr[i] in DIGITS:
+        i += 1
+    se = evr.rfind('-', i)
+    if evr[i:i+1] == ':':
+        epoch = evr[:i] or '0'
+        start = i + 1
+    else:
+        epoch = '0'
+        start = 0
+    if se >= 0:
+        return epoch, evr[start:se], evr[se+1:]
+    return epoch, evr[start:], None
+
+@functools.total_ordering
+class VersionKey(object):
+    '''a parsed pacman version, ordered like vercmp().'''
+    __slots__ = ('version', 'epoch', 'ver', 'rel', 'key')
+
+    def __init__(self, version):
+        epoch, ver, rel = parse_evr(version)
+        self.version = version
+        self.epoch = segments(epoch)
+        self.ver = segments(ver)
+        self.rel = None if rel is None else segments(rel)
+        # plain tuple for the usual case: pkgrel present, no trailing
+        # separators; anything else takes the segment by segment path
+        self.key = None
+        if self.rel is not None:
+            key = (flatten(self.epoch), flatten(self.ver), flatten(self.rel))
+            if not None in key:
+                self.key = key
+
+    def cmp(self, other):
+        if self.version == other.version:
+            return 0
+        if self.key is not None and other.key is not None:
+            return (self.key > other.key) - (self.key < other.key)
+        c = rpmvercmp(self.epoch, other.epoch) or rpmvercmp(self.ver, other.ver)
+        if c == 0 and self.rel is not None and other.rel is not None:
+            c = rpmvercmp(self.rel, other.rel)
+        return c
+
+    def __eq__(self, other):
+        return self.cmp(other) == 0
+
+    def __lt__(self, other):
+        if self.key is not None and other.key is not None:
+            return self.key < other.key
+        return self.cmp(other) < 0
+
+    def __hash__(self):
+        # keys comparing equal always share epoch and version segments
+        return hash((self.epoch, self.ver))
+
+    def __repr__(self):
+        return 'VersionKey(%r)' % self.version
+
+KEYS = dict()
+
+def version_key(version):
+    '''the cached VersionKey of version.'''
+    try:
+        return KEYS[version]
+    except KeyError:
+        KEYS[version] = VersionKey(version)
+        return KEYS[version]
+
+def vercmp(a, b):
+    '''-1, 0 or 1 like pyalpm.vercmp(), on cached keys.'''
+    return version_key(a).cmp(version_key(b))
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''background download of pending updates into the package cache.
+
+    prefetch.py CONF STATEDIR RATE WORKERS [BLOCKED_REPO...]
+
+The helper starts this detached after refresh-cache and get-updates. It
+loads its own handle, works out the packages a sysupgrade would install
+and downloads them into the first CacheDir at RATE bytes/s at most (0: no
+cap) over WORKERS connections at a lower CPU priority, so the update
+itself only has to verify and install.
+
+It never competes with a transaction: it does not start while db.lck
+exists and lets go within one chunk once it appears, leaving .part files
+for the transaction to resume. It holds STATEDIR/prefetch.lock while it
+runs; a transaction in the helper takes the same lock before it touches
+the cache, which also keeps a second prefetch from starting meanwhile.
+
+STATEDIR/prefetch.json keeps the last run and how many packages each
+transaction found already downloaded (hits) or had to fetch (misses).
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+from fetch import Fetcher
+from pacman import Pacman
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import time
+
+LOCK = 'prefetch.lock'
+STATS = 'prefetch.json'
+
+def cached(pkg, directory):
+    '''is the complete package file of pkg in directory?'''
+    try:
+        return os.path.getsize(os.path.join(directory, pkg.filename)) == pkg.size
+    except (OSError, TypeError):
+        return False
+
+def pending(cache):
+    '''the sync packages a sysupgrade would install, one per name.'''
+    seen = set()
+    out = []
+    for pkg, npkg in cache.updates():
+        if not npkg.name in seen:
+            seen.add(npkg.name)
+            out.append(npkg)
+    return out
+
+class Background(object):
+    '''the prefetch lock and statistics under statedir.'''
+    def __init__(self, statedir):
+        self.statedir = statedir
+        self.lockpath = os.path.join(statedir, LOCK)
+        self.statspath = os.path.join(statedir, STATS)
+
+    @contextlib.contextmanager
+    def lock(self, wait=True):
+        '''hold the prefetch lock; yields False instead of waiting when
+        wait is false and someone else holds it.'''
+        fd = os.open(self.lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        try:
+            with open(self.statspath, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {'hits': 0, 'misses': 0, 'hit_bytes': 0, 'miss_bytes': 0}
+
+    def save(self, stats):
+        tmp = self.statspath + '.tmp'
+        try:
+            with open(tmp, 'w') as fp:
+                json.dump(stats, fp, indent=1)
+            os.replace(tmp, self.statspath)
+        except OSError:
+            pass
+
+    def account(self, pkgs, directory):
+        '''count pkgs as hits or misses against directory; call with the
+        lock held.'''
+        stats = self.stats()
+        for pkg in pkgs:
+            if pkg.db.name == 'local' or not pkg.filename:
+                continue
+            if cached(pkg, directory):
+                stats['hits'] += 1
+                stats['hit_bytes'] += pkg.size
+            else:
+                stats['misses'] += 1
+                stats['miss_bytes'] += pkg.size
+        self.save(stats)
+
+    def start(self, conf, rate=0, workers=2, blocked=()):
+        '''run prefetch.py detached from the helper; output goes nowhere
+        and the helper does not wait for it.'''
+        import subprocess
+        args = [sys.executable, os.path.abspath(__file__), conf, self.statedir,
+                str(int(rate)), str(int(workers))] + list(blocked)
+        try:
+            with open(os.devnull, 'r+b') as null:
+                return subprocess.Popen(args, stdin=null, stdout=null, stderr=null,
+                                        start_new_session=True, close_fds=True)
+        except OSError:
+            return None
+
+    def run(self, conf, rate=0, workers=2, blocked=()):
+        with self.lock(wait=False) as held:
+            if not held:
+                return None
+            p = Pacman(conf)
+            handle = p.handle
+            locked = lambda: os.path.exists(handle.lockfile)
+            if locked():
+                return None
+            directory = handle.cachedirs[0]
+            pkgs = [pkg for pkg in pending(p.cache().view(blocked))
+                    if not cached(pkg, directory)]
+            t0 = time.time()
+            results = p.prefetch(pkgs, directory, Fetcher(workers, limit=rate, hold=locked))
+            stats = self.stats()
+            stats['last'] = {'time': t0, 'seconds': time.time() - t0,
+                             'packages': len(pkgs),
+                             'fetched': sum(1 for r in results.values() if r.changed),
+                             'bytes': sum(r.bytes for r in results.values()),
+                             'held': locked(),
+                             'errors': dict((k, r.error) for k, r in results.items() if r.error)}
+            self.save(stats)
+            return results
+
+def main():
+    if len(sys.argv) < 5:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    conf, statedir, rate, workers = sys.argv[1:5]
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+    Background(statedir).run(conf, int(rate), int(workers), sys.argv[5:])
+
+if __name__ == '__main__':
+    main()
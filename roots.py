@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''many roots (containers, chroots) queried from one process.
+
+    roots.py ROOTS.json get-updates [FILTERS]
+    roots.py ROOTS.json get-packages [FILTERS]
+    roots.py ROOTS.json resolve FILTERS NAME[&NAME...]
+
+ROOTS.json lists the roots as [{"name": ..., "root": ...}], optionally
+with "conf" (default ROOT/etc/pacman.conf) and "dbpath" (default
+ROOT/var/lib/pacman/). The answer is one JSON object mapping each root's
+name to {"packages": [package ids]} or {"error": message}.
+
+Every root has its own handle and local db. A sync db whose file has the
+same content as one another root already registered is replaced by that
+one, so identical repos are parsed once per process, and so is every
+index built over them.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+from pacman import Pacman, PkgCache, PkgFilter
+from snapshot import digest
+import json
+import os
+import sys
+
+def pid(pkg):
+    dn = pkg.db.name
+    if dn == 'local':
+        dn = 'installed'
+    return '%s;%s;%s;%s' % (pkg.name, pkg.version, pkg.arch, dn)
+
+class SyncPool(object):
+    '''sync dbs by (name, content digest), with the handles they belong
+    to kept alive, and the indexes shared by every root.'''
+    def __init__(self):
+        self.dbs = dict()
+        self.handles = []
+        self.digests = dict()
+        self.indexes = dict()
+
+    def digest(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (path, st.st_mtime_ns, st.st_size)
+        if not key in self.digests:
+            self.digests[key] = digest(path)
+        return self.digests[key]
+
+    def adopt(self, handle, local):
+        '''(sync dbs, tags) for a new handle: each of its sync dbs the pool
+        already has an equal one of is swapped for that one. local tags the
+        handle's local db.'''
+        sync = []
+        tags = {'local': local}
+        provides = False
+        for db in handle.get_syncdbs():
+            sha = self.digest(os.path.join(handle.dbpath, 'sync', db.name + '.db'))
+            if sha is None:
+                # nothing to compare; keep it to this handle
+                sha = (local, db.name)
+            elif (db.name, sha) in self.dbs:
+                db = self.dbs[db.name, sha]
+            else:
+                self.dbs[db.name, sha] = db
+                provides = True
+            sync.append(db)
+            tags[db.name] = sha
+        if provides:
+            self.handles.append(handle)
+        return sync, tags
+
+    def forget(self, tag):
+        '''drop the indexes built for the local db tagged tag.'''
+        for key in [k for k in self.indexes if k[-1] == tag]:
+            del self.indexes[key]
+
+class Root(Pacman):
+    def __init__(self, name, conf, root, dbpath, pool):
+        self.name = name
+        self.pool = pool
+        Pacman.__init__(self, conf, lazy=True, root=root, dbpath=dbpath)
+
+    def new_cache(self, handle):
+        tag = (self.dbpath or handle.dbpath, self.generation)
+        self.pool.forget((tag[0], self.generation - 1))
+        sync, tags = self.pool.adopt(handle, tag)
+        return PkgCache(handle, indexes=self.pool.indexes, sync=sync, tags=tags)
+
+class Roots(object):
+    def __init__(self, specs):
+        self.pool = SyncPool()
+        self.roots = []
+        for spec in specs:
+            root = spec['root']
+            self.roots.append(Root(spec.get('name', root),
+                                   spec.get('conf') or os.path.join(root, 'etc/pacman.conf'),
+                                   root,
+                                   spec.get('dbpath') or os.path.join(root, 'var/lib/pacman/'),
+                                   self.pool))
+
+    def each(self, func):
+        '''{root name: {'packages': func(root)} or {'error': message}}, one
+        root failing does not stop the others.'''
+        out = dict()
+        for root in self.roots:
+            try:
+                if root.stale():
+                    root.load()
+                out[root.name] = {'packages': [pid(p) for p in func(root)]}
+            except Exception as e:
+                out[root.name] = {'error': '%s: %s' % (type(e).__name__, e)}
+        return out
+
+    def updates(self, filters=()):
+        def _updates(root):
+            seen = set()
+            for pkg, npkg in root.cache().updates():
+                if not npkg.name in seen:
+                    seen.add(npkg.name)
+                    yield npkg
+        return self.each(lambda root: PkgFilter(filters).filter(_updates(root)))
+
+    def packages(self, filters=()):
+        return self.each(lambda root: PkgFilter(filters).filter(root.cache().listing()))
+
+    def resolve(self, filters, names):
+        return self.each(lambda root: PkgFilter(filters).filter(root.cache().resolve(names)))
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    with open(sys.argv[1], 'r') as fp:
+        roots = Roots(json.load(fp))
+    cmd = sys.argv[2]
+    args = sys.argv[3:]
+    filters = [f for f in (args[0] if args else 'none').split(';') if f != 'none']
+    if cmd == 'get-updates':
+        out = roots.updates(filters)
+    elif cmd == 'get-packages':
+        out = roots.packages(filters)
+    elif cmd == 'resolve' and len(args) == 2:
+        out = roots.resolve(filters, args[1].split('&'))
+    else:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+    json.dump(out, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
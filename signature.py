@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''pacman's SigLevel, and detached signatures checked against its keyring.
+
+A level is {'package': (check, trust), 'database': (check, trust)} with
+check one of 'never', 'optional' and 'required', and trust 'trustedonly'
+or 'trustall', like pacman.conf(5) describes them.
+'''
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+import glob
+import os
+
+CHECKS = ('never', 'optional', 'required')
+TRUSTS = ('trustedonly', 'trustall')
+# pacman's own: Required DatabaseOptional, TrustedOnly
+DEFAULT = {'package': ('required', 'trustedonly'), 'database': ('optional', 'trustedonly')}
+GPGDIR = '/etc/pacman.d/gnupg/'
+
+def parse(value, base=DEFAULT):
+    '''the SigLevel value applied over the level base.'''
+    out = dict((k, list(v)) for k, v in base.items())
+    for token in value.split():
+        kinds = ('package', 'database')
+        for prefix in ('Package', 'Database'):
+            if token.startswith(prefix):
+                kinds = (prefix.lower(),)
+                token = token[len(prefix):]
+        token = token.lower()
+        for kind in kinds:
+            if token in CHECKS:
+                out[kind][0] = token
+            elif token in TRUSTS:
+                out[kind][1] = token
+    return dict((k, tuple(v)) for k, v in out.items())
+
+def lines(path, depth=0):
+    '''the settings in the pacman.conf at path, Include files read in
+    place.'''
+    try:
+        with open(path, 'r') as fp:
+            content = fp.readlines()
+    except OSError:
+        return
+    for line in content:
+        line = line.split('#', 1)[0].strip()
+        key, _, value = line.partition('=')
+        if key.strip() == 'Include' and depth < 10:
+            for include in sorted(glob.glob(value.strip())):
+                for line in lines(include, depth + 1):
+                    yield line
+        elif line:
+            yield line
+
+def levels(conf):
+    '''{repo: level} for every repo in the pacman.conf at conf; a repo's
+    own SigLevel applies over the one under [options].'''
+    settings = dict()
+    section = None
+    for line in lines(conf):
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+            settings.setdefault(section, [])
+            continue
+        key, _, value = line.partition('=')
+        if key.strip() == 'SigLevel' and section:
+            settings[section].append(value.strip())
+    base = DEFAULT
+    for value in settings.pop('options', []):
+        base = parse(value, base)
+    out = dict()
+    for repo, values in settings.items():
+        out[repo] = base
+        for value in values:
+            out[repo] = parse(value, out[repo])
+    return out
+
+def verify(path, sig, gpgdir=GPGDIR, trust='trustedonly'):
+    '''None when sig is a good signature of path by a key in the keyring
+    at gpgdir, one it fully trusts unless trust is 'trustall'; else what
+    is wrong with it.'''
+    import subprocess
+    try:
+        proc = subprocess.run(['gpg', '--homedir', gpgdir, '--batch', '--no-tty',
+                               '--status-fd', '1', '--verify', sig, path],
+                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60)
+    except (OSError, subprocess.SubprocessError) as e:
+        return 'cannot verify signature: %s' % e
+    status = set(line.split()[1] for line in proc.stdout.splitlines()
+                 if line.startswith('[GNUPG:] ') and len(line.split()) > 1)
+    if not ('GOODSIG' in status and 'VALIDSIG' in status):
+        return 'invalid signature'
+    if trust != 'trustall' and not status & set(['TRUST_FULLY', 'TRUST_ULTIMATE']):
+        return 'signature from an untrusted key'
+    return None
+
+def check(path, sig, level, gpgdir=GPGDIR):
+    '''None when the file at path passes level, a (check, trust) pair,
+    with the signature file sig (None or missing: it has none); else
+    what is wrong with it.'''
+    need, trust = level
+    if need == 'never':
+        return None
+    if not sig or not os.path.exists(sig):
+        return 'missing signature' if need == 'required' else None
+    return verify(path, sig, gpgdir, trust)
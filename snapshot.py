@@ -0,0 +1,465 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+__author__ = 'ck Lux <lux.r.ck@gmail.com>'
+
+from packagekit.enums import ERROR_PACKAGE_ID_INVALID, ERROR_PACKAGE_NOT_FOUND
+from pacman import NameIndex, TokenIndex
+from pkgver import vercmp
+from array import array
+import cancel
+import hashlib
+import json
+import os
+import sqlite3
+
+# bumped with SCHEMA; a snapshot of another version is never fresh
+VERSION = 4
+SCHEMA = '''
+CREATE TABLE pkgs (
+    db TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    arch TEXT,
+    desc TEXT,
+    url TEXT,
+    licenses TEXT,
+    groups TEXT,
+    depends TEXT,
+    provides TEXT,
+    isize INTEGER,
+    size INTEGER,
+    filename TEXT,
+    reason INTEGER,
+    installdate INTEGER,
+    builddate INTEGER,
+    PRIMARY KEY (db, seq));
+CREATE INDEX pkgs_name ON pkgs (name, db);
+CREATE TABLE repos (
+    seq INTEGER PRIMARY KEY,
+    name TEXT NOT NULL);
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+CREATE TABLE names (
+    db TEXT PRIMARY KEY,
+    names TEXT NOT NULL);
+CREATE TABLE grams (
+    db TEXT NOT NULL,
+    gram TEXT NOT NULL,
+    seqs BLOB NOT NULL,
+    PRIMARY KEY (db, gram)) WITHOUT ROWID;
+CREATE TABLE words (
+    db TEXT NOT NULL,
+    word TEXT NOT NULL,
+    codes BLOB NOT NULL,
+    PRIMARY KEY (db, word)) WITHOUT ROWID;
+'''
+
+COLUMNS = ('name', 'version', 'arch', 'desc', 'url', 'licenses', 'groups',
+           'depends', 'provides', 'isize', 'size', 'filename', 'reason',
+           'installdate', 'builddate')
+LISTS = ('licenses', 'groups', 'depends', 'provides')
+# the columns of a PkgRecord, in its order but for db
+BRIEF = ('name', 'version', 'arch', 'desc', 'installdate', 'licenses')
+# names per query of Snapshot.named(), under SQLITE_MAX_VARIABLE_NUMBER
+BATCH = 500
+
+def digest(path):
+    '''sha256 of a file, or of the sorted listing of a directory.'''
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        h.update('\n'.join(sorted(os.listdir(path))).encode('utf-8', 'replace'))
+    else:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def stamp(paths):
+    '''[path, mtime, size, digest] of each path; None for missing ones.'''
+    out = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            out.append([path, st.st_mtime_ns, st.st_size, digest(path)])
+        except OSError:
+            out.append([path, None, None, None])
+    return out
+
+class DBName(object):
+    '''stands in for pkg.db: the pid and the filters only need its name.'''
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+class Record(object):
+    '''one package read back from a Snapshot, with the attributes of a
+    pyalpm Package the read-only commands use.'''
+    __slots__ = ('db',) + COLUMNS
+
+    def __init__(self, db, row):
+        self.db = db
+        for k, v in zip(COLUMNS, row):
+            if k in LISTS:
+                v = v.split('\n') if v else []
+            setattr(self, k, v)
+
+class PkgRecord(object):
+    '''what the listing commands filter and print of a package, without
+    the dependency lists and the rest of a Record.'''
+    __slots__ = ('name', 'version', 'arch', 'db', 'desc', 'installdate', 'licenses')
+
+    def __init__(self, name, version, arch, db, desc, installdate, licenses):
+        self.name = name
+        self.version = version
+        self.arch = arch
+        self.db = db
+        self.desc = desc
+        self.installdate = installdate
+        self.licenses = licenses
+
+class StoredNames(NameIndex):
+    '''the NameIndex of one db as Snapshot.build() stored it in the grams
+    table, looked up one trigram at a time.'''
+    def __init__(self, snap, db):
+        self.snap = snap
+        self.db = db
+        self._lower = None
+
+    @property
+    def names(self):
+        return self.snap.names(self.db)
+
+    @property
+    def lower(self):
+        if self._lower is None:
+            self._lower = [n.lower() for n in self.names]
+        return self._lower
+
+    def posting(self, gram):
+        row = self.snap.open().execute('SELECT seqs FROM grams WHERE db = ? AND gram = ?',
+                                       (self.db, gram)).fetchone()
+        return array('l', row[0]) if row else ()
+
+class StoredTokens(TokenIndex):
+    '''the TokenIndex of one db as Snapshot.build() stored it in the words
+    table: each lookup is a range query there, so nothing is built or read
+    in full when a process starts.'''
+    def __init__(self, snap, db):
+        self.snap = snap
+        self.db = db
+
+    @property
+    def names(self):
+        return self.snap.names(self.db)
+
+    def lookup(self, prefix):
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        for word, codes in self.snap.open().execute(
+                'SELECT word, codes FROM words WHERE db = ? AND word >= ? AND word < ?',
+                (self.db, prefix, end)):
+            yield word, array('l', codes)
+
+class Snapshot(object):
+    '''package metadata of the local and every sync db in one sqlite file.
+
+    build() writes it from a live handle next to path and renames it in
+    place. It records [path, mtime, size, digest] of the files the handle
+    was loaded from; fresh() restats them and only hashes a file whose
+    mtime or size moved, so touching a db without changing it does not
+    invalidate the snapshot. Readers map it with sqlite's mmap.'''
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.dbnames = dict()
+        self.indexes = dict()
+
+    def build(self, handle, paths):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        db = sqlite3.connect(tmp)
+        try:
+            db.executescript(SCHEMA)
+            dbs = [handle.get_localdb()] + list(handle.get_syncdbs())
+            with db:
+                db.executemany('INSERT INTO repos (seq, name) VALUES (?, ?)',
+                               enumerate(d.name for d in dbs[1:]))
+                for d in dbs:
+                    db.executemany('INSERT INTO pkgs VALUES (%s)' % ','.join('?' * (len(COLUMNS) + 2)),
+                                   ((d.name, i) + self.row(pkg) for i, pkg in enumerate(d.pkgcache)))
+                    # the search indexes, built here once per generation
+                    # rather than in every helper that searches
+                    names = NameIndex(p.name for p in d.pkgcache)
+                    db.execute('INSERT INTO names VALUES (?, ?)', (d.name, '\n'.join(names.names)))
+                    db.executemany('INSERT INTO grams VALUES (?, ?, ?)',
+                                   ((d.name, g, array('l', l).tobytes()) for g, l in names.grams.items()))
+                    tokens = TokenIndex(d.pkgcache)
+                    db.executemany('INSERT INTO words VALUES (?, ?, ?)',
+                                   ((d.name, w, c.tobytes()) for w, c in tokens.postings.items()))
+                db.execute('INSERT INTO meta VALUES (?, ?)', ('stamp', json.dumps(stamp(paths))))
+                db.execute('INSERT INTO meta VALUES (?, ?)', ('version', str(VERSION)))
+            # without statistics sqlite answers 'db = ? AND name = ?'
+            # by walking the whole db in seq order
+            db.execute('ANALYZE')
+        finally:
+            db.close()
+        os.replace(tmp, self.path)
+        self.close()
+
+    def row(self, pkg):
+        out = []
+        for k in COLUMNS:
+            v = getattr(pkg, k)
+            if k in LISTS:
+                v = '\n'.join(v)
+            out.append(v)
+        return tuple(out)
+
+    def open(self):
+        if self.db is None:
+            self.db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+            self.db.execute('PRAGMA mmap_size = %d' % (256 << 20))
+            self.dbnames = dict()
+            self.indexes = dict()
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def fresh(self):
+        '''does the snapshot still describe the dbs on disk?'''
+        try:
+            meta = dict(self.open().execute('SELECT key, value FROM meta'))
+        except sqlite3.Error:
+            self.close()
+            return False
+        if meta.get('version') != str(VERSION) or not 'stamp' in meta:
+            return False
+        for path, mtime, size, sha in json.loads(meta['stamp']):
+            try:
+                st = os.stat(path)
+            except OSError:
+                if mtime is not None:
+                    return False
+                continue
+            if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                continue
+            if sha is None or digest(path) != sha:
+                return False
+        return True
+
+    def repos(self):
+        '''sync db names in pacman.conf order.'''
+        return [r[0] for r in self.open().execute('SELECT name FROM repos ORDER BY seq')]
+
+    def dbname(self, name):
+        try:
+            return self.dbnames[name]
+        except KeyError:
+            self.dbnames[name] = DBName(name)
+            return self.dbnames[name]
+
+    def select(self, where, args):
+        for row in self.open().execute(
+                'SELECT db, %s FROM pkgs WHERE %s ORDER BY seq' % (', '.join(COLUMNS), where), args):
+            yield Record(self.dbname(row[0]), row[1:])
+
+    def brief(self, where, args):
+        '''like select(), reading only the columns of a PkgRecord.'''
+        for name, version, arch, desc, installdate, licenses, db in self.open().execute(
+                'SELECT %s, db FROM pkgs WHERE %s ORDER BY seq' % (', '.join(BRIEF), where), args):
+            yield PkgRecord(name, version, arch, self.dbname(db), desc, installdate,
+                            licenses.split('\n') if licenses else [])
+
+    def pkgs(self, db):
+        return self.select('db = ?', (db,))
+
+    def listing(self, db):
+        return self.brief('db = ?', (db,))
+
+    def names(self, db):
+        '''the package names of db in seq order, read once per opened
+        snapshot.'''
+        try:
+            return self.indexes['names', db]
+        except KeyError:
+            row = self.open().execute('SELECT names FROM names WHERE db = ?', (db,)).fetchone()
+            self.indexes['names', db] = row[0].split('\n') if row and row[0] else []
+            return self.indexes['names', db]
+
+    def get(self, db, name):
+        return next(self.select('db = ? AND name = ?', (db, name)), None)
+
+    def named(self, names):
+        '''{(db, name): PkgRecord} for every package named in names, read in
+        a few queries rather than one per name.'''
+        out = dict()
+        names = list(names)
+        for i in range(0, len(names), BATCH):
+            batch = names[i:i+BATCH]
+            for pkg in self.brief('name IN (%s)' % ','.join('?' * len(batch)), batch):
+                out[pkg.db.name, pkg.name] = pkg
+        return out
+
+    def at(self, db, seq):
+        return next(self.brief('db = ? AND seq = ?', (db, seq)), None)
+
+    def index(self, db):
+        '''the NameIndex of db, as stored by build().'''
+        try:
+            return self.indexes[db]
+        except KeyError:
+            self.indexes[db] = StoredNames(self, db)
+            return self.indexes[db]
+
+    def tokens(self, db):
+        '''the TokenIndex of db, as stored by build().'''
+        try:
+            return self.indexes['tokens', db]
+        except KeyError:
+            self.indexes['tokens', db] = StoredTokens(self, db)
+            return self.indexes['tokens', db]
+
+def unique(func):
+    '''drop sync packages whose exact version is also installed, like
+    PkgCache.cached does.'''
+    def _unique(*args, **kwargs):
+        installed = set()
+        for pkg in func(*args, **kwargs):
+            if not (pkg.name, pkg.version) in installed:
+                if pkg.db.name == 'local':
+                    installed.add((pkg.name, pkg.version))
+                yield pkg
+    return _unique
+
+class SnapshotCache(object):
+    '''the PkgCache queries of the read-only commands, answered from a
+    Snapshot: same dbs, same order, same results.'''
+    def __init__(self, snap, blocked=(), local=True):
+        self.snap = snap
+        self.local = local
+        self.repos = dict((r, [snap.dbname(r), not r in blocked]) for r in snap.repos())
+
+    def dbs(self):
+        dbs = sorted(k for k, v in self.repos.items() if v[1])
+        if self.local:
+            dbs.insert(0, 'local')
+        return dbs
+
+    def local(self):
+        c = SnapshotCache(self.snap)
+        c.repos = dict()
+        return c
+
+    def repo(self, repo=None):
+        c = SnapshotCache(self.snap, local=repo in ('local', 'installed'))
+        c.repos = dict((k, list(v)) for k, v in self.repos.items() if k == repo)
+        return c
+
+    @unique
+    def all(self):
+        for db in self.dbs():
+            for pkg in self.snap.pkgs(db):
+                yield pkg
+
+    @unique
+    def listing(self):
+        for db in self.dbs():
+            for pkg in self.snap.listing(db):
+                yield pkg
+
+    @unique
+    def get(self, key):
+        for db in self.dbs():
+            pkg = self.snap.get(db, key)
+            if pkg:
+                yield pkg
+
+    def resolve(self, names, missing=None):
+        '''like PkgCache.resolve(): the rows of every name come out of a
+        few queries over the whole set.'''
+        dbs = self.dbs()
+        names = list(dict.fromkeys(names))
+        rows = self.snap.named(names)
+        for name in cancel.checkpoints(names):
+            installed = None
+            found = False
+            for db in dbs:
+                pkg = rows.get((db, name))
+                if not pkg:
+                    continue
+                found = True
+                if db == 'local':
+                    installed = pkg.version
+                elif pkg.version == installed:
+                    continue
+                yield pkg
+            if not found and missing is not None:
+                missing.append(name)
+
+    def first(self, key, pexprs=None):
+        '''like PkgCache.first(): pexprs is [(ops, version)] with ops made
+        of '<', '=' and '>'.'''
+        ops = {-1: '<', 0: '=', 1: '>'}
+        for pkg in self.get(key):
+            if all(ops[vercmp(pkg.version, v)] in op for op, v in pexprs or () if op):
+                return pkg
+
+    def packages(self, pids):
+        '''like PkgCache.packages().'''
+        dbs = set(self.dbs())
+        found = []
+        missing = []
+        for pid in pids:
+            try:
+                pn, pv, pa, pi = pid.split(';')
+            except ValueError:
+                missing.append((pid, ERROR_PACKAGE_ID_INVALID, "invalid package id '%s'" % pid))
+                continue
+            db = 'local' if pi == 'installed' else pi
+            pkg = self.snap.get(db, pn) if db in dbs else None
+            if pkg and pkg.version == pv and pkg.arch == pa:
+                found.append((pid, pkg))
+            else:
+                missing.append((pid, ERROR_PACKAGE_NOT_FOUND, "could not find '%s'" % pid))
+        return found, missing
+
+    def search(self, keys):
+        '''like PkgCache.search().'''
+        hits = []
+        for i, db in enumerate(self.dbs()):
+            for score, pos in self.snap.tokens(db).search(keys, self.snap.index(db)):
+                hits.append((score, i, pos, db))
+        hits.sort()
+        return unique(lambda: (self.snap.at(db, pos) for score, i, pos, db in hits))()
+
+    @unique
+    def match(self, keys):
+        for db in self.dbs():
+            for i in self.snap.index(db).match(keys):
+                yield self.snap.at(db, i)
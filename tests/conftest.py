@@ -0,0 +1,5 @@
+# the helper's modules live at the top of the tree, next to no package
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import json
+import pytest
+
+pytest.importorskip('packagekit.backend')
+
+import alpmBackend
+import cancel
+import fileindex
+import pacman
+import prefetch
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    '''the real backend __init__, with PackageKit asking for a background
+    job the way packagekitd does.'''
+    blacklist = tmp_path / 'blacklist.json'
+    blacklist.write_text(json.dumps({'blocked': ['testing']}))
+    monkeypatch.setenv('BACKGROUND', 'TRUE')
+    monkeypatch.setattr(alpmBackend, 'CACHEDIR', str(tmp_path) + '/')
+    monkeypatch.setattr(alpmBackend, 'BLACKLIST', str(blacklist))
+    monkeypatch.setattr(alpmBackend, 'PREFETCH', True)
+    return alpmBackend.PackageKitPacmanBackend('', str(tmp_path / 'pacman.conf'))
+
+def test_prefetcher_survives_base_init(backend):
+    assert isinstance(backend.prefetcher, prefetch.Background)
+
+def test_start_prefetch(backend, monkeypatch):
+    started = []
+    monkeypatch.setattr(prefetch.Background, 'start',
+                        lambda self, *args: started.append(args))
+    backend.pending = True
+    backend.start_prefetch()
+    assert not backend.pending
+    assert started == [(backend.conf, alpmBackend.PREFETCH_RATE,
+                        alpmBackend.PREFETCH_WORKERS, ['testing'])]
+
+def test_hold_cache_takes_prefetch_lock(backend, tmp_path):
+    with backend.hold_cache([], str(tmp_path)):
+        with prefetch.Background(str(tmp_path)).lock(wait=False) as held:
+            assert not held
+    with prefetch.Background(str(tmp_path)).lock(wait=False) as held:
+        assert held
+
+def test_get_files_falls_back_to_installed(backend, tmp_path, monkeypatch):
+    '''a sync id without a .files db is answered from the installed
+    package of the same version.'''
+    entry = tmp_path / 'db' / 'local' / 'foo-1.0-1'
+    entry.mkdir(parents=True)
+    (entry / 'files').write_text('%FILES%\nusr/\nusr/bin/foo\n\n')
+    index = fileindex.FileIndex()
+    index.update_local(str(tmp_path / 'db'))
+    out, errors = [], []
+    monkeypatch.setattr(backend, 'file_index', lambda repos: index)
+    monkeypatch.setattr(backend, 'status', lambda status: None)
+    monkeypatch.setattr(backend, 'allow_cancel', lambda allow: None)
+    monkeypatch.setattr(backend, 'files', lambda pid, text: out.append((pid, text)))
+    monkeypatch.setattr(backend, 'error', lambda code, text, exit=True: errors.append(text))
+    backend.get_files(['foo;1.0-1;x86_64;extra', 'foo;1.1-1;x86_64;extra'])
+    assert out == [('foo;1.0-1;x86_64;extra', 'usr/;usr/bin/foo')]
+    assert len(errors) == 1 and 'foo;1.1-1' in errors[0]
+
+class Transaction(object):
+    def __init__(self, handle, flags):
+        self.handle = handle
+        self.flags = flags
+        self.added = []
+
+    def add_pkg(self, pkg):
+        self.added.append(pkg)
+
+    def prepare(self):
+        pass
+
+    def commit(self):
+        # libalpm downloads into, and checks, the cache dirs it has now
+        self.handle.committed = (self.flags, list(self.added), list(self.handle.cachedirs))
+
+    def release(self):
+        pass
+
+class Handle(object):
+    cachedirs = ['/var/cache/pacman/pkg/']
+
+    def init_transaction(self, **flags):
+        return Transaction(self, flags)
+
+def test_download_checks_prefetched_files(backend, tmp_path, monkeypatch):
+    '''download-packages lets libalpm check what prefetch() brought in.'''
+    handle = Handle()
+    monkeypatch.setattr(backend, 'source', object())
+    monkeypatch.setattr(backend, '_handle', handle, raising=False)
+    fetched = []
+    monkeypatch.setattr(backend, 'prefetch', lambda pkgs, directory: fetched.append(directory) or {})
+    backend.download(['pkg'], str(tmp_path))
+    assert fetched == [str(tmp_path)]
+    flags, added, cachedirs = handle.committed
+    assert flags['downloadonly'] and added == ['pkg'] and cachedirs == [str(tmp_path)]
+    assert handle.cachedirs == ['/var/cache/pacman/pkg/']
+
+class DB(object):
+    def __init__(self, name):
+        self.name = name
+
+class Package(object):
+    def __init__(self, name, version, db, installdate=0):
+        self.name = name
+        self.version = version
+        self.arch = 'x86_64'
+        self.db = DB(db)
+        self.desc = 'summary of ' + name
+        self.installdate = installdate
+
+def test_package_line(backend, capsys):
+    '''package, info, package id, summary: the order PackageKit reads.'''
+    backend.package(Package('bash', '5.2-1', 'core'))
+    backend.package(Package('bash', '5.1-1', 'local', installdate=1), 'updating')
+    alpmBackend.sync_output()
+    out = capsys.readouterr().out.splitlines()
+    assert out == ['package\t%s\tbash;5.2-1;x86_64;core\tsummary of bash' % alpmBackend.INFO_AVAILABLE,
+                   'package\tupdating\tbash;5.1-1;x86_64;installed\tsummary of bash']
+
+class Update(Package):
+    def __init__(self, name, version, size=4):
+        Package.__init__(self, name, version, 'extra')
+        self.filename = '%s-%s-x86_64.pkg.tar.zst' % (name, version)
+        self.size = size
+
+class Updates(object):
+    def __init__(self, pkgs):
+        self.pkgs = pkgs
+
+    def updates(self):
+        return [(None, pkg) for pkg in self.pkgs]
+
+def test_get_updates_prefetches_once(backend, tmp_path, monkeypatch, capsys):
+    '''polling the same, already downloaded updates starts no prefetch.'''
+    handle = Handle()
+    handle.cachedirs = [str(tmp_path) + '/']
+    monkeypatch.setattr(backend, 'source', object())
+    monkeypatch.setattr(backend, '_handle', handle, raising=False)
+    monkeypatch.setattr(backend, 'status', lambda status: None)
+    monkeypatch.setattr(backend, 'allow_cancel', lambda allow: None)
+    pkgs = [Update('foo', '1.1-1'), Update('bar', '2.0-1')]
+    monkeypatch.setattr(backend, 'cache', lambda: Updates(pkgs))
+    backend.get_updates([])
+    assert backend.pending
+    backend.pending = False
+    for pkg in pkgs:
+        (tmp_path / pkg.filename).write_bytes(b'1234')
+    backend.get_updates([])
+    assert not backend.pending
+    # a new version of one of them
+    pkgs[0] = Update('foo', '1.2-1')
+    backend.get_updates([])
+    assert backend.pending
+    backend.pending = False
+    backend.get_updates([])
+    assert backend.pending
+    backend.pending = False
+    (tmp_path / pkgs[0].filename).write_bytes(b'1234')
+    backend.get_updates([])
+    assert not backend.pending
+    capsys.readouterr()
+
+def cancelled_at(n, pkgs):
+    '''pkgs, asking for cancellation like SIGQUIT does once n are out.'''
+    for i, pkg in enumerate(pkgs):
+        if i == n:
+            cancel.request()
+        yield pkg
+
+class Chain(object):
+    '''a cache where package i depends on package i + 1.'''
+    def satisfier(self, name, exprs):
+        return Package(str(int(name) + 1), '1-1', 'extra')
+
+def test_cancel_stops_iteration_until_dispatch(backend, monkeypatch):
+    pkgs = [Package(str(i), '1-1', 'extra') for i in range(1000)]
+    seen = []
+    with pytest.raises(cancel.Cancelled):
+        for pkg in pacman.PkgFilter([]).filter(cancelled_at(100, pkgs)):
+            seen.append(pkg)
+    assert 100 < len(seen) < 100 + 2 * cancel.EVERY
+    cancel.reset()
+    def edges(pkg):
+        if pkg.name == '100':
+            cancel.request()
+        return [pkg.name] if int(pkg.name) < 1000 else []
+    with pytest.raises(cancel.Cancelled):
+        pacman.Resolver(Chain(), edges).resolve([pkgs[0]])
+
+    # still requested: the next command starts from a clean flag
+    assert cancel.REQUESTED
+    done, errors = [], []
+    def command(cmd, args):
+        pkgs = [Package(str(i), '1-1', 'extra') for i in range(1000)]
+        if cmd == 'cancelled':
+            pkgs = cancelled_at(100, pkgs)
+        done.append((cmd, len(list(pacman.PkgFilter([]).filter(pkgs)))))
+    monkeypatch.setattr(backend, 'stale', lambda: False)
+    monkeypatch.setattr(backend, 'dispatch_command', command)
+    monkeypatch.setattr(backend, 'finished', lambda: None)
+    monkeypatch.setattr(backend, 'error', lambda code, text, exit=True: errors.append(code))
+    backend.dispatch('first', [])
+    backend.dispatch('cancelled', [])
+    backend.dispatch('next', [])
+    assert done == [('first', 1000), ('next', 1000)]
+    assert errors == [alpmBackend.ERROR_TRANSACTION_CANCELLED]
+    assert not cancel.REQUESTED
+
+class Owners(object):
+    '''a FileIndex answering every key with the same owners per repo.'''
+    def __init__(self, owners):
+        self.owners_of = owners
+
+    def has(self, repo):
+        return repo in self.owners_of
+
+    def owners(self, repo, keys):
+        return set(self.owners_of.get(repo, ()))
+
+def test_search_file_sorted(backend, monkeypatch):
+    from bench import FakeHandle
+    local = DB('local')
+    local.pkgcache = [Package(n, '1.0-1', 'local') for n in ('zsh', 'bash')]
+    extra = DB('extra')
+    extra.pkgcache = [Package(n, '1.0-1', 'extra') for n in ('zsh', 'dash', 'ash', 'mksh')]
+    co = pacman.PkgCache(FakeHandle(local, [extra]))
+    index = Owners({'local': [('zsh', '1.0-1'), ('bash', '1.0-1')],
+                    'extra': [('zsh', '1.0-1'), ('mksh', '1.0-1'), ('dash', '1.0-1'), ('ash', '1.0-1')]})
+    out = []
+    monkeypatch.setattr(backend, 'cache', lambda: co)
+    monkeypatch.setattr(backend, 'file_index', lambda repos: index)
+    monkeypatch.setattr(backend, 'status', lambda status: None)
+    monkeypatch.setattr(backend, 'allow_cancel', lambda allow: None)
+    monkeypatch.setattr(backend, 'package', lambda pkg: out.append(backend.pid(pkg)))
+    backend.search_file([], ['sh'])
+    assert out == ['ash;1.0-1;x86_64;extra', 'bash;1.0-1;x86_64;installed',
+                   'dash;1.0-1;x86_64;extra', 'mksh;1.0-1;x86_64;extra',
+                   'zsh;1.0-1;x86_64;installed']
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import instrument
+
+class DB(object):
+    def __init__(self, name):
+        self.name = name
+        self.servers = []
+        self.pkgcache = []
+
+class Handle(object):
+    def __init__(self):
+        self.cachedirs = ['/var/cache/pacman/pkg/']
+        self.local = DB('local')
+        self.sync = [DB('core')]
+
+    def get_localdb(self):
+        return self.local
+
+    def get_syncdbs(self):
+        return self.sync
+
+def test_counted_handle_passes_writes_on():
+    '''instrumenting must not change what the handle does.'''
+    handle = Handle()
+    counted = instrument.CountedHandle(handle)
+    counted.cachedirs = ['/tmp/dl']
+    assert handle.cachedirs == ['/tmp/dl']
+    assert counted.cachedirs == ['/tmp/dl']
+    assert not 'cachedirs' in vars(counted)
+    db = counted.get_syncdbs()[0]
+    db.servers = ['http://example.org']
+    assert handle.sync[0].servers == ['http://example.org']
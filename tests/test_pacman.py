@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import pytest
+
+pytest.importorskip('packagekit.enums')
+
+from bench import FakeDB, FakeHandle, FakePkg
+from packagekit.enums import FILTER_NEWEST
+from pacman import PkgCache, PkgFilter, ProvidesIndex
+
+def repo(name, *pkgs):
+    '''a FakeDB of (name, version, provides) triples.'''
+    db = FakeDB(name)
+    db.servers = []
+    db.pkgcache = [FakePkg(n, v, db, (), p) for n, v, p in pkgs]
+    return db
+
+CORE = [('bash', '5.2-1', ['sh']), ('dash', '0.5-1', ['sh']),
+        ('glibc', '2.38-1', ['glibc', 'libc.so=6-64']),
+        ('openssl', '3.1-1', ['libssl.so=3-64', 'openssl-3=3.1'])]
+
+def test_lookup_versioned():
+    index = ProvidesIndex(repo('core', *CORE).pkgcache)
+    assert list(index.lookup('bash', [('>=', '5.0')])) == ['bash']
+    assert list(index.lookup('bash', [('<', '5.0')])) == []
+    assert list(index.lookup('bash', [('=', '5.2-1')])) == ['bash']
+    assert list(index.lookup('libc.so', [('=', '6-64')])) == ['glibc']
+    assert list(index.lookup('libc.so', [('>', '6-64')])) == []
+    assert list(index.lookup('openssl-3', [('>=', '3'), ('<', '4')])) == ['openssl']
+    # unversioned provides satisfy no versioned dependency
+    assert list(index.lookup('sh', [('>=', '1')])) == []
+    assert list(index.lookup('sh')) == ['bash', 'dash']
+
+def test_lookup_own_name_once():
+    index = ProvidesIndex(repo('core', *CORE).pkgcache)
+    assert list(index.lookup('glibc')) == ['glibc']
+
+def test_provide_each_package_once():
+    core = repo('core', *CORE)
+    extra = repo('extra', ('zsh', '5.9-1', ['sh']))
+    local = repo('local', ('bash', '5.2-1', ['sh']))
+    co = PkgCache(FakeHandle(local, [core, extra]))
+    found = [(p.db.name, p.name) for p in co.provide(['sh', 'bash', 'glibc'])]
+    assert found == [('local', 'bash'), ('core', 'dash'), ('extra', 'zsh'), ('core', 'glibc')]
+
+def newest(local, *sync):
+    co = PkgCache(FakeHandle(repo('local', *local), list(sync)))
+    out = [(p.db.name, p.name, p.version) for p in PkgFilter([FILTER_NEWEST]).filter(co.all())]
+    # the same without the caches' dedupe in front
+    raw = [p for db in co.dbs() for p in db.pkgcache]
+    assert [(p.db.name, p.name, p.version) for p in PkgFilter([]).filter_newest(raw)] == out
+    return out
+
+def test_newest_installed_only():
+    assert newest([('bash', '5.2-1', [])]) == [('local', 'bash', '5.2-1')]
+
+def test_newest_with_equal_and_older_sync():
+    local = [('bash', '5.2-1', [])]
+    core = repo('core', ('bash', '5.2-1', []))
+    testing = repo('testing', ('bash', '5.1-1', []))
+    assert newest(local, core, testing) == [('local', 'bash', '5.2-1')]
+    assert newest(local, repo('core', ('bash', '5.1-1', []))) == [('local', 'bash', '5.2-1')]
+
+def test_newest_with_newer_sync():
+    local = [('bash', '5.2-1', [])]
+    core = repo('core', ('bash', '5.2-1', []))
+    testing = repo('testing', ('bash', '5.3-1', []))
+    assert newest(local, core, testing) == [('local', 'bash', '5.2-1'), ('testing', 'bash', '5.3-1')]
+    extra = repo('extra', ('zsh', '5.8-1', []))
+    testing = repo('testing', ('zsh', '5.9-1', []))
+    assert newest([], extra, testing) == [('testing', 'zsh', '5.9-1')]
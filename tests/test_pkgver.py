@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import functools
+import pytest
+
+from bench import VERCMP_CORPUS, synthetic_versions
+import pkgver
+
+@pytest.mark.parametrize('a,b,expected', VERCMP_CORPUS)
+def test_corpus(a, b, expected):
+    assert pkgver.vercmp(a, b) == expected
+    assert pkgver.vercmp(b, a) == -expected
+
+@pytest.mark.parametrize('a,b,expected', VERCMP_CORPUS)
+def test_keys_order_like_vercmp(a, b, expected):
+    ka, kb = pkgver.version_key(a), pkgver.version_key(b)
+    assert (ka > kb) - (ka < kb) == expected
+
+def test_against_pyalpm():
+    '''the corpus and a synthetic set, pair by pair, against libalpm.'''
+    pyalpm = pytest.importorskip('pyalpm')
+    if not hasattr(pyalpm, 'vercmp'):
+        pytest.skip('pyalpm without vercmp')
+    for a, b, expected in VERCMP_CORPUS:
+        assert pyalpm.vercmp(a, b) == expected
+    versions = synthetic_versions(200)
+    mismatch = [(a, b) for a in versions for b in versions
+                if pkgver.vercmp(a, b) != pyalpm.vercmp(a, b)]
+    assert mismatch == []
+    assert (sorted(versions, key=pkgver.version_key) ==
+            sorted(versions, key=functools.cmp_to_key(pyalpm.vercmp)))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import pytest
+
+pytest.importorskip('packagekit.enums')
+
+from bench import FakeDB, FakeHandle, FakePkg
+import roots
+
+def db(name, *pkgs):
+    out = FakeDB(name)
+    out.pkgcache = [FakePkg(pkg, '1.0-1', out) for pkg in pkgs]
+    return out
+
+def root(tmp_path, name, pool, core):
+    '''a root whose sync/extra.db is the same in every root and whose
+    sync/core.db is core.'''
+    dbpath = tmp_path / name / 'var' / 'lib' / 'pacman'
+    (dbpath / 'sync').mkdir(parents=True)
+    (dbpath / 'sync' / 'core.db').write_text(core)
+    (dbpath / 'sync' / 'extra.db').write_text('extra')
+    handle = FakeHandle(db('local', 'bash'),
+                        [db('core', 'bash', core), db('extra', 'gtk3', 'gtk4')])
+    handle.dbpath = str(dbpath)
+    out = roots.Root(name, str(tmp_path / name / 'pacman.conf'), str(tmp_path / name),
+                     str(dbpath), pool)
+    return out, out.new_cache(handle)
+
+def test_roots_share_sync_indexes(tmp_path):
+    pool = roots.SyncPool()
+    one, a = root(tmp_path, 'one', pool, 'core one')
+    two, b = root(tmp_path, 'two', pool, 'core two')
+    assert a.sync[1] is b.sync[1]
+    assert a.sync[0] is not b.sync[0]
+    assert [p.name for p in a.match(['gtk'])] == ['gtk3', 'gtk4']
+    assert [p.name for p in b.match(['gtk'])] == ['gtk3', 'gtk4']
+    names = sorted(key[1] for key in pool.indexes if key[0] == 'names')
+    assert names == ['core', 'core', 'extra', 'local', 'local']
+
+def test_forget_drops_one_root(tmp_path):
+    pool = roots.SyncPool()
+    one, a = root(tmp_path, 'one', pool, 'core one')
+    two, b = root(tmp_path, 'two', pool, 'core two')
+    list(a.match(['bash']))
+    list(b.match(['bash']))
+    before = set(pool.indexes)
+    pool.forget(a.tags['local'])
+    assert before - set(pool.indexes) == set([('names', 'local', a.tags['local'])])
+    assert ('names', 'local', b.tags['local']) in pool.indexes
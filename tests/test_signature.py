@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import os
+import pytest
+
+import signature
+
+def test_parse():
+    assert signature.parse('') == signature.DEFAULT
+    assert signature.parse('Never') == {'package': ('never', 'trustedonly'),
+                                        'database': ('never', 'trustedonly')}
+    assert signature.parse('Required DatabaseOptional TrustAll') == {
+        'package': ('required', 'trustall'), 'database': ('optional', 'trustall')}
+    assert signature.parse('DatabaseRequired PackageTrustAll')['database'] == ('required', 'trustedonly')
+
+def test_levels(tmp_path):
+    mirrors = tmp_path / 'mirrorlist'
+    mirrors.write_text('Server = http://example.org/$repo/os/$arch\nSigLevel = DatabaseRequired\n')
+    conf = tmp_path / 'pacman.conf'
+    conf.write_text('[options]\nSigLevel = Required DatabaseOptional # the default\n\n'
+                    '[core]\nInclude = %s\n\n[custom]\nSigLevel = Never\n'
+                    'Server = file:///srv/custom\n\n[extra]\nServer = http://example.org\n' % mirrors)
+    levels = signature.levels(str(conf))
+    assert levels['core']['database'] == ('required', 'trustedonly')
+    assert levels['custom']['database'] == ('never', 'trustedonly')
+    assert levels['extra'] == signature.DEFAULT
+    assert not 'options' in levels
+
+def test_check_without_signature(tmp_path):
+    path = str(tmp_path / 'core.db')
+    sig = str(tmp_path / 'core.db.sig')
+    assert signature.check(path, sig, ('never', 'trustedonly')) is None
+    assert signature.check(path, sig, ('optional', 'trustedonly')) is None
+    assert signature.check(path, None, ('required', 'trustedonly')) == 'missing signature'
+
+class DB(object):
+    def __init__(self, name, servers):
+        self.name = name
+        self.servers = servers
+        self.pkgcache = []
+
+class Handle(object):
+    def __init__(self, root, dbs):
+        self.dbpath = str(root)
+        self.lockfile = str(root / 'db.lck')
+        self.gpgdir = str(root / 'gnupg')
+        self.dbs = dbs
+
+    def get_localdb(self):
+        return DB('local', [])
+
+    def get_syncdbs(self):
+        return self.dbs
+
+def test_refresh_checks_signatures(tmp_path, monkeypatch):
+    pytest.importorskip('packagekit.enums')
+    from pacman import PkgCache
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    sync = tmp_path / 'sync'
+    sync.mkdir()
+    for repo, sig in (('core', 'good'), ('extra', 'bad'), ('community', None)):
+        (mirror / (repo + '.db')).write_text('new ' + repo)
+        if sig:
+            (mirror / (repo + '.db.sig')).write_text(sig)
+        (sync / (repo + '.db')).write_text('old ' + repo)
+        (sync / (repo + '.db.sig')).write_text('old')
+    (sync / 'extra.db.pk-new.part').write_text('left over')
+    checked = []
+    def verify(path, sig, gpgdir, trust):
+        checked.append(os.path.basename(path))
+        return None if open(sig).read() == 'good' else 'invalid signature'
+    monkeypatch.setattr(signature, 'verify', verify)
+    servers = ['file://' + str(mirror)]
+    handle = Handle(tmp_path, [DB(r, servers) for r in ('core', 'extra', 'community')])
+    levels = {'core': signature.parse('DatabaseRequired'),
+              'extra': signature.parse('DatabaseRequired')}
+    results = PkgCache(handle).refresh(True, levels=levels)
+    assert sorted(results) == ['community', 'core', 'extra']
+    assert sorted(checked) == ['core.db.pk-new', 'extra.db.pk-new']
+    assert results['core'].changed and not results['core'].error
+    assert (sync / 'core.db').read_text() == 'new core'
+    assert (sync / 'core.db.sig').read_text() == 'good'
+    assert not results['extra'].changed and 'invalid signature' in results['extra'].error
+    assert (sync / 'extra.db').read_text() == 'old extra'
+    assert (sync / 'extra.db.sig').read_text() == 'old'
+    # optional and unsigned: in, without the old signature
+    assert results['community'].changed and not results['community'].error
+    assert (sync / 'community.db').read_text() == 'new community'
+    assert not (sync / 'community.db.sig').exists()
+    assert sorted(os.listdir(str(sync))) == ['community.db', 'core.db', 'core.db.sig',
+                                             'extra.db', 'extra.db.sig']
+
+def test_refresh_fetches_changed_signatures_only(tmp_path, monkeypatch):
+    pytest.importorskip('packagekit.enums')
+    import http.client
+    from fetch import Fetcher
+    from pacman import PkgCache
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    sync = tmp_path / 'sync'
+    sync.mkdir()
+    for repo in ('core', 'extra', 'community'):
+        (mirror / (repo + '.db')).write_text('new ' + repo)
+        (mirror / (repo + '.db.sig')).write_text('sig')
+        (sync / (repo + '.db')).write_text('old ' + repo)
+        os.utime(str(sync / (repo + '.db')), (1e9, 1e9))
+    # core is newer here than on the mirror
+    os.utime(str(sync / 'core.db'), (2e9, 2e9))
+    asked = []
+    class Broken(Fetcher):
+        def _open(self, job, url, headers):
+            asked.append(os.path.basename(url))
+            if job.key == 'extra':
+                raise http.client.IncompleteRead(b'')
+            return Fetcher._open(self, job, url, headers)
+    monkeypatch.setattr(signature, 'verify', lambda path, sig, gpgdir, trust: None)
+    servers = ['file://' + str(mirror)]
+    handle = Handle(tmp_path, [DB(r, servers) for r in ('core', 'extra', 'community')])
+    results = PkgCache(handle).refresh(fetcher=Broken())
+    assert sorted(asked) == ['community.db', 'community.db.sig', 'core.db', 'extra.db']
+    assert not results['core'].changed and not results['core'].error
+    assert not results['extra'].changed and 'IncompleteRead' in results['extra'].error
+    assert results['community'].changed and not results['community'].error
+    assert (sync / 'extra.db').read_text() == 'old extra'
+    assert (sync / 'community.db.sig').read_text() == 'sig'
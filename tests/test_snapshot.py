@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# vim:set shiftwidth=4 tabstop=4 expandtab:
+#
+# Copyright (C) 2014 ck Lux <lux.r.ck@gmail.com>
+#
+# Licensed under the GNU General Public License Version 2
+
+import pytest
+
+pytest.importorskip('packagekit.enums')
+
+from bench import FakeDB, FakeHandle, synthetic_details
+from pacman import NameIndex, PkgCache, TokenIndex
+import snapshot
+
+TERMS = ['editor', 'text editor', 'gtk terminal', 'pyth', 'lib', 'group3', 'zzz']
+
+@pytest.fixture
+def snap(tmp_path):
+    pkgs = synthetic_details(2000)
+    db = pkgs[0].db
+    db.pkgcache = pkgs
+    local = FakeDB('local')
+    local.pkgcache = []
+    handle = FakeHandle(local, [db])
+    snap = snapshot.Snapshot(str(tmp_path / 'snapshot.db'))
+    snap.build(handle, [])
+    snap.handle = handle
+    yield snap
+    snap.close()
+
+def test_stored_tokens_search_like_built(snap):
+    pkgs = snap.handle.get_syncdbs()[0].pkgcache
+    names = NameIndex(p.name for p in pkgs)
+    built = TokenIndex(pkgs)
+    stored = snap.tokens('extra')
+    assert isinstance(stored, snapshot.StoredTokens)
+    for terms in TERMS:
+        assert stored.search(terms.split(), names) == built.search(terms.split(), names)
+
+def test_cache_takes_stored_index(snap):
+    asked = []
+    def stored(kind, db):
+        asked.append((kind, db))
+        return snap.tokens(db) if kind == 'tokens' else snap.index(db)
+    co = PkgCache(snap.handle, stored=stored)
+    assert [p.name for p in co.search(['editor'])] == \
+           [p.name for p in PkgCache(snap.handle).search(['editor'])]
+    assert [p.name for p in co.match(['gtk'])] == \
+           [p.name for p in PkgCache(snap.handle).match(['gtk'])]
+    assert ('tokens', 'extra') in asked and ('names', 'extra') in asked
+    assert co.index('tokens', snap.handle.get_syncdbs()[0], None) is snap.tokens('extra')
+
+def test_stored_names_match_like_built(snap):
+    pkgs = snap.handle.get_syncdbs()[0].pkgcache
+    built = NameIndex(p.name for p in pkgs)
+    stored = snap.index('extra')
+    assert isinstance(stored, snapshot.StoredNames)
+    assert stored.names == built.names
+    for key in ['gtk', 'python-gtk', 'x', 'zzz', 'ut.*s', 'UTILS']:
+        assert list(stored.match([key])) == list(built.match([key]))
+    assert list(stored.match(['lib', 'gtk'])) == list(built.match(['lib', 'gtk']))